@@ -4,6 +4,10 @@ import os
 import shutil
 import sys
 
+# Run log helpers are shared with the stage scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+from instrumentation import configure_run_log, stage
+
 
 def run_filtering(filtering_args):
     '''Run the filtering script with filtering_args dictionary.'''
@@ -15,44 +19,69 @@ def run_filtering(filtering_args):
 
     # Append existing arguments to the command
     for k,v in filtering_args.items():
-        if v:
+        if v is True:
+            command.append('--'+k)
+        elif v:
             command.append('--'+k)
             command.append(v)
     
     # Run
-    subprocess.run(command)
+    with stage('filtering', outputs=['data/mutational_matrices']) as record:
+        record['returncode'] = subprocess.run(command).returncode
+
+
+def signature_type(signature_context):
+    '''Signature type of a signature context, eg. SBS for SBS96.'''
+    return ''.join([c for c in signature_context if not c.isdigit()])
+
 
+def pipeline_datasets(signature_contexts, plots_dir, batch=False):
+    '''
+    Matrix file, dataset name and plots directory of every signature context, in batch mode of every cohort
+    with matrices in data/mutational_matrices/<cohort> (dataset <cohort>.<context> plotted into <plots_dir>/<cohort>).
+    '''
+    if not batch:
+        return [(f'data/mutational_matrices/{signature_type(context)}/MutSigMA.{context}.all', f'MutSigMA.{context}', plots_dir)
+                for context in signature_contexts]
 
-def run_assignment(assignment_args):
-    '''Run the assignment script with assignment_args dictionary.'''
-    signature_context = assignment_args['signature_context']  # Specific signature context of extraction, eg. SBS96
-    signature_type = ''.join([c for c in signature_context if not c.isdigit()])  # Signature type, eg. SBS
+    datasets = []
+    for cohort in sorted(os.listdir('data/mutational_matrices')) if os.path.isdir('data/mutational_matrices') else []:
+        for context in signature_contexts:
+            matrix_file = os.path.join('data/mutational_matrices', cohort, signature_type(context), f'{cohort}.{context}.all')
+            if os.path.exists(matrix_file):
+                datasets.append((matrix_file, f'{cohort}.{context}', os.path.join(plots_dir, cohort)))
+    return datasets
 
+
+def run_assignment(assignment_args, matrix_files):
+    '''Run the assignment script with assignment_args dictionary on matrix_files.'''
+    # One assigner fits all matrices in its pool, each against the type its file name tells
     command = [sys.executable, 'assign/assigner.py',
-               '-i', f'data/mutational_matrices/{signature_type}/MutSigMA.{signature_context}.all',
-               '-o', 'output',
-               '-s', signature_type]
+               '-i', *matrix_files,
+               '-o', 'output']
     
-    # Remove output dir if exists
-    if os.path.isdir('output'):
+    # Remove output dir if exists (incremental runs update the previous output)
+    if os.path.isdir('output') and not assignment_args['incremental']:
         shutil.rmtree('output')
     
     del assignment_args['signature_context']
 
     # Iterate througn the rest of arguments
     for k,v in assignment_args.items():
-        if v:
+        if v is True:
+            command.append('--'+k)
+        elif v:
             command.append('--'+k)
             command.append(v)
     
     # Run
-    subprocess.run(command)
+    with stage('assignment', outputs=['output']) as record:
+        record['returncode'] = subprocess.run(command).returncode
 
 
-def run_visualization(visualization_args):
-    '''Run the visualization script with visualization_args dictionary.'''
-    command = [sys.executable, 'visualization/visualizer.py',
-               '-i', str(os.path.join('output',os.listdir('output')[0]))]
+def run_visualization(visualization_args, datasets):
+    '''Run the visualization script with visualization_args dictionary for (dataset name, plots directory) datasets at the same time.'''
+    command = [sys.executable, 'visualization/visualizer.py']
     
     # Delete plots directory if exists
     if os.path.isdir('plots'):
@@ -62,11 +91,18 @@ def run_visualization(visualization_args):
     output = visualization_args['output']
     uid = visualization_args['id']
     first_n = visualization_args['first_n']
+    jobs = visualization_args['jobs']
+    pie_layout = visualization_args['pie_layout']
+    cluster_mode = visualization_args['cluster_mode']
+    cluster_threshold = visualization_args['cluster_threshold']
 
     non_boolean_args = {
-        '-o': output,
         '-d': uid,
-        '-f': str(first_n)
+        '-f': str(first_n),
+        '-j': str(jobs),
+        '-l': pie_layout,
+        '-m': cluster_mode,
+        '--cluster_threshold': str(cluster_threshold)
     }
 
     # Iterate and append to command non boolean args
@@ -78,13 +114,97 @@ def run_visualization(visualization_args):
     del visualization_args['output']
     del visualization_args['id']
     del visualization_args['first_n']
+    del visualization_args['jobs']
+    del visualization_args['pie_layout']
+    del visualization_args['cluster_mode']
+    del visualization_args['cluster_threshold']
 
     # Iterate through the rest of boolean arguments
     for k,v in visualization_args.items():
         if v:
             command.append('--'+k)
     
-    subprocess.run(command)
+    # Plot file names start with the dataset name, so the contexts of a cohort share its plots directory
+    with stage('visualization', outputs=[output]) as record:
+        processes, returncodes = [], []
+        for dataset_name, plots_dir in datasets:
+            # At most one visualizer per core
+            if len(processes) >= os.cpu_count():
+                returncodes.append(processes.pop(0).wait())
+            processes.append(subprocess.Popen(command + ['-i', str(os.path.join('output', dataset_name)), '-o', plots_dir]))
+        returncodes += [process.wait() for process in processes]
+        record['returncode'] = next((code for code in returncodes if code), 0)
+
+
+def run_in_process(filtering_args, assignment_args, visualization_args, request_filepaths=None):
+    '''
+    Run all three stages in this process, passing the matrix and activities between them in memory,
+    for every cohort of request_filepaths in batch mode.
+    '''
+    # Make the stage scripts importable
+    for stage_dir in ['data', 'assign', 'visualization']:
+        sys.path.insert(0, os.path.abspath(stage_dir))
+    import create_custom_database
+    from assigner import assign_matrices
+    from visualizer import visualize
+
+    signature_contexts = assignment_args['signature_context']
+
+    # Filtering, a single scan of the database builds the matrices of all contexts (and cohorts)
+    with stage('filtering', outputs=['data/mutational_matrices']) as record:
+        if request_filepaths:
+            cohort_matrices = create_custom_database.main_batch(request_filepaths, **filtering_args,
+                                                                contexts=signature_contexts)
+        else:
+            cohort_matrices = {'MutSigMA': create_custom_database.main(**filtering_args, contexts=signature_contexts)}
+        plots_dir = visualization_args['output']
+        datasets = [(matrices[context], f'{cohort}.{context}', signature_type(context),
+                     os.path.join(plots_dir, cohort) if request_filepaths else plots_dir)
+                    for cohort, matrices in cohort_matrices.items() for context in signature_contexts]
+        record['rows_out'] = max((dataset[0].shape[1] for dataset in datasets), default=0)
+    assert datasets, 'There are no mutational matrices to assign signatures to.'
+
+    # Assignment, the contexts are fitted concurrently in one worker pool
+    if os.path.isdir('output') and not assignment_args['incremental']:
+        shutil.rmtree('output')
+    print('Assigning signatures...')
+    with stage('assignment', rows_in=max(dataset[0].shape[1] for dataset in datasets), outputs=['output']) as record:
+        activities = assign_matrices([dataset[0] for dataset in datasets],
+                                     [os.path.join('output', dataset[1]) for dataset in datasets],
+                                     [dataset[2] for dataset in datasets],
+                                     signature_database=assignment_args['signature_database'],
+                                     exome=assignment_args['genome_type'] == 'exome',
+                                     engine=assignment_args['engine'],
+                                     exclude_signature_subgroups=assignment_args['exclude_signature_subgroups'],
+                                     cache_dir=None if assignment_args['no_cache'] else 'data/cache/assignments',
+                                     incremental=assignment_args['incremental'],
+                                     minimal_output=assignment_args['minimal_output'],
+                                     bootstrap=int(assignment_args['bootstrap'] or 0),
+                                     seed=int(assignment_args['seed']))
+        record['rows_out'] = max(len(context_activities) for context_activities in activities)
+
+    # Visualization
+    if os.path.isdir('plots'):
+        shutil.rmtree('plots')
+    for (_, dataset_name, _, dataset_plots_dir), dataset_activities in zip(datasets, activities):
+        with stage('visualization', rows_in=len(dataset_activities), outputs=[dataset_plots_dir]):
+            visualize(dataset_activities, dataset_name,
+                      output=dataset_plots_dir,
+                      boxplot=visualization_args['boxplot'],
+                      no_outliers=visualization_args['no_outliers'],
+                      barplot=visualization_args['barplot'],
+                      piechart=visualization_args['piechart'],
+                      sample_id=visualization_args['id'],
+                      first_n=visualization_args['first_n'],
+                      all_plots=visualization_args['all'],
+                      report=visualization_args['report'],
+                      show=visualization_args['show'],
+                      clustermap=visualization_args['cluster_signatures'],
+                      jobs=visualization_args['jobs'],
+                      pie_layout=visualization_args['pie_layout'],
+                      cluster_mode=visualization_args['cluster_mode'],
+                      cluster_threshold=visualization_args['cluster_threshold'],
+                      html_report=visualization_args['html'])
 
 
 if __name__ == '__main__':
@@ -98,19 +218,48 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--request-filepath',
                         default='data/request_file.txt',
                         help='Path to the request file of specified format')
+    parser.add_argument('-R', '--requests', default=None,
+                        help='Directory of request files, or a manifest file listing their paths, analysed in one run '
+                             'with a single database scan (one cohort per request file, eg. output/TCGA-BRCA.SBS96)')
     parser.add_argument('-m', '--mutations-database-filepath',
                         default='data/mutations.parquet.gzip',
                         help='Path to the mutations database')
+    parser.add_argument('-E', '--engine', choices=['sigprofiler', 'native'], default='sigprofiler',
+                        help='Matrix generation engine (native: in-memory SBS96, DBS78 and ID83 only)')
+    parser.add_argument('--reference-dir', default=None,
+                        help='Reference chromosomes directory for the native matrix engine')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of worker processes writing VCF files, or building cohorts\' native matrices with --requests '
+                             '(default: 1)')
+    parser.add_argument('--chunk-rows', type=int, default=0,
+                        help='Stream the selected mutations in chunks of this many rows instead of loading them at once '
+                             '(default: 0, disabled)')
+    parser.add_argument('-P', '--in-process', action='store_true',
+                        help='Run all stages in a single process, passing data between them in memory')
+    parser.add_argument('-S', '--save-matrices', action='store_true',
+                        help='Save native engine matrices to data/mutational_matrices in in-process mode')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Regenerate mutational matrices and assignments without reading or updating the caches')
     
     # Signature assignment arguments
     # parser.add_argument('-i','--input', required=True, help='Path to mutational matrix (SBS/DBS/ID) file or folder of files')
     # parser.add_argument('-o','--output', help='Output directory', default='output')
-    parser.add_argument('-k','--signature_context', choices=['SBS96', 'SBS288', 'SBS1536', 'DBS78', 'ID83'], default='SBS96',
-                        help='Specific signature type to extract')
+    parser.add_argument('-k','--signature_context', nargs='+', choices=['SBS96', 'SBS288', 'SBS1536', 'DBS78', 'ID83'],
+                        default=['SBS96'],
+                        help='Specific signature types to extract, one database scan builds the matrices of all of them '
+                             'and they are assigned concurrently (default: SBS96)')
     # parser.add_argument('-s','--signature_type', choices=['SBS', 'DBS', 'ID'], default='SBS', help='Type of signatures')
     parser.add_argument('-g','--genome_type', choices=['exome', 'genome'], default='genome', help='Exome or genome data')
     parser.add_argument('-d','--signature_database', help='Optional path to .txt file to include only selected signatures', default=None)
     parser.add_argument('-e','--exclude_signature_subgroups', help='Exclude signature subgroups you don\'t want to analyze', default=None)
+    parser.add_argument('-I','--incremental', action='store_true', help='Only fit samples new or changed since the previous run')
+    parser.add_argument('-A','--assignment-engine', choices=['sigprofiler', 'native'], default='sigprofiler',
+                        help='Signature fitting engine (native: in-process approximation of cosmic_fit\'s stepwise NNLS, no plots)')
+    parser.add_argument('-M','--minimal_output', action='store_true',
+                        help='Skip assignment plots and write only activities and sample statistics as one parquet file')
+    parser.add_argument('-B','--bootstrap', type=int, default=0,
+                        help='Number of bootstrap replicates for 95%% confidence intervals of activities (default: 0, disabled)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of bootstrap resampling (default: 0)')
 
     # Visualization arguments
     # parser.add_argument('-i', '--input', required=True, help='Path to Assignment_Solution folder')
@@ -123,22 +272,66 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--first_n', type=int, default=0, help='Generate pie charts for first N patients (default: 0)')
     parser.add_argument('-a', '--all', action='store_true', help='Generate all visualizations')
     parser.add_argument('-t', '--report', action='store_true', help='Generate summary report')
+    parser.add_argument('-H', '--html', action='store_true',
+                        help='Generate self-contained interactive HTML report (works offline)')
     parser.add_argument('-z', '--show', action='store_true', help='Display plots only (no saving)')
     parser.add_argument('-c', '--cluster_signatures', action='store_true', help='Generate clustering heatmap of signatures')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes rendering plots (default: 1)')
+    parser.add_argument('-l', '--pie_layout', choices=['files', 'grid', 'pdf'], default='files',
+                        help='Layout of --first_n pie charts: one file per patient, grid pages or one multipage pdf (default: files)')
+    parser.add_argument('-C', '--cluster_mode', choices=['auto', 'full', 'subsample', 'centroids'], default='auto',
+                        help='Clustering heatmap rows: every sample, a random subsample or k-means clusters of samples '
+                             '(default: auto, centroids above --cluster_threshold samples)')
+    parser.add_argument('--cluster_threshold', type=int, default=2000,
+                        help='Sample count above which auto cluster mode clusters centroids (default: 2000)')
+
+    # Instrumentation arguments
+    parser.add_argument('-L', '--run-log', default=None,
+                        help='Append wall time, CPU time, peak memory, rows and files written of every stage to this JSON-lines file')
+    parser.add_argument('--profile', nargs='+', default=None, metavar='STAGE',
+                        help='Profile these stages of any script (eg. filtering, matrices, assignment, plots, or all) '
+                             'into <run log>.<stage>.<pid>.<n>.prof files')
     
     args = parser.parse_args()
 
+    args.signature_context = list(dict.fromkeys(args.signature_context))
+    for signature_context in args.signature_context:
+        if args.engine == 'native' and signature_context not in ['SBS96', 'DBS78', 'ID83']:
+            parser.error(f'The native matrix engine does not support {signature_context} (use SBS96, DBS78 or ID83)')
+    if args.signature_database and len({signature_type(context) for context in args.signature_context}) > 1:
+        parser.error('--signature_database holds signatures of a single type, request contexts of that type only')
+    if args.profile and not args.run_log:
+        parser.error('--profile requires --run-log')
+    if args.requests and args.chunk_rows:
+        parser.error('--chunk-rows is not supported with --requests')
+
+    # Stage scripts inherit the run log settings, all their stages share one run id
+    if args.run_log:
+        configure_run_log(args.run_log, args.profile)
+
     # Sort arguments
     filtering_args = {
-        'request-filepath': args.request_filepath,
-        'database-filepath': args.mutations_database_filepath
+        'request-filepath': None if args.requests else args.request_filepath,
+        'requests': args.requests,
+        'database-filepath': args.mutations_database_filepath,
+        'engine': args.engine,
+        'reference-dir': args.reference_dir,
+        'workers': str(args.workers),
+        'chunk-rows': str(args.chunk_rows) if args.chunk_rows else None,
+        'no-cache': args.no_cache
     }
 
     assignment_args = {
         'signature_context': args.signature_context,
         'genome_type': args.genome_type,
         'signature_database': args.signature_database,
-        'exclude_signature_subgroups': args.exclude_signature_subgroups
+        'exclude_signature_subgroups': args.exclude_signature_subgroups,
+        'no_cache': args.no_cache,
+        'incremental': args.incremental,
+        'engine': args.assignment_engine,
+        'minimal_output': args.minimal_output,
+        'bootstrap': str(args.bootstrap) if args.bootstrap else None,
+        'seed': str(args.seed)
     }
 
     visualization_args = {
@@ -151,11 +344,37 @@ if __name__ == '__main__':
         'first_n': args.first_n,
         'all': args.all,
         'report': args.report,
+        'html': args.html,
         'show': args.show,
-        'cluster_signatures': args.cluster_signatures
+        'cluster_signatures': args.cluster_signatures,
+        'jobs': args.jobs,
+        'pie_layout': args.pie_layout,
+        'cluster_mode': args.cluster_mode,
+        'cluster_threshold': args.cluster_threshold
     }
 
+    # Run all stages in memory
+    if args.in_process:
+        filtering_args = {
+            'database_filepath': args.mutations_database_filepath,
+            'engine': args.engine,
+            'reference_dir': args.reference_dir,
+            'workers': args.workers,
+            'save_matrices': args.save_matrices,
+            'no_cache': args.no_cache
+        }
+        if args.requests:
+            from create_custom_database import find_request_files
+            run_in_process(filtering_args, assignment_args, visualization_args, find_request_files(args.requests))
+        else:
+            filtering_args.update(request_filepath=args.request_filepath, chunk_rows=args.chunk_rows)
+            run_in_process(filtering_args, assignment_args, visualization_args)
+        sys.exit(0)
+
     # Run all scripts
     run_filtering(filtering_args)
-    run_assignment(assignment_args)
-    run_visualization(visualization_args)
+    datasets = pipeline_datasets(args.signature_context, args.output, batch=bool(args.requests))
+    if not datasets:
+        sys.exit('There are no mutational matrices to assign signatures to.')
+    run_assignment(assignment_args, [dataset[0] for dataset in datasets])
+    run_visualization(visualization_args, [dataset[1:] for dataset in datasets])
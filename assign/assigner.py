@@ -1,53 +1,632 @@
 import argparse
+import contextlib
+import hashlib
+import importlib.metadata
+import json
 import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import re
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
+import shutil
+import signal
+import socket
+import socketserver
+import stat
 import sys
+import tempfile
+import threading
+
+# Shared cache helpers live next to the database scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+from cache import CACHE_SIZE_MB, cache_key, lookup_cache_entry, store_cache_entry
+from instrumentation import configure_run_log, stage
+from native_fit import bootstrap_intervals, load_signatures, native_fit, preload_signatures
+
+# Copy of the fitted matrix kept in each output folder for incremental runs
+INPUT_MATRIX_FILENAME = 'Input_Matrix.txt'
+
+# Per-sample output tables (first column holds sample names) merged by incremental runs
+SAMPLE_TABLES = [
+    os.path.join('Assignment_Solution', 'Activities', 'Assignment_Solution_Activities.txt'),
+    os.path.join('Assignment_Solution', 'Activities', 'Decomposed_MutationType_Probabilities.txt'),
+    os.path.join('Assignment_Solution', 'Solution_Stats', 'Assignment_Solution_Samples_Stats.txt')
+]
+ASSIGNMENT_LOG = os.path.join('Assignment_Solution', 'Solution_Stats', 'Assignment_Solution_Signature_Assignment_log.txt')
+
+# Single table of activities and sample statistics written instead of the output tree in minimal output mode
+MINIMAL_OUTPUT_FILENAME = 'Assignment_Solution.parquet'
+
+# Typed copy of the activities table, uncompressed so that readers can memory-map it
+ACTIVITIES_FEATHER = os.path.join('Assignment_Solution', 'Activities', 'Assignment_Solution_Activities.feather')
+
+# Minimum number of samples per shard when splitting a matrix across the pool
+MIN_SHARD_SAMPLES = 25
+
+# Bootstrap confidence level and number of samples per pool task
+CONFIDENCE_LEVEL = 0.95
+BOOTSTRAP_CHUNK_SAMPLES = 50
+
+# Bootstrap bounds tables written next to the activities table
+CI_TABLES = {
+    'CI_Lower': os.path.join('Assignment_Solution', 'Activities', 'Assignment_Solution_Activities_CI_Lower.txt'),
+    'CI_Upper': os.path.join('Assignment_Solution', 'Activities', 'Assignment_Solution_Activities_CI_Upper.txt')
+}
+
+# Signature type named by a matrix file of the matrix generators, eg. MutSigMA.DBS78.all
+MATRIX_TYPE_PATTERN = re.compile(r'(SBS|DBS|ID)\d+\.all$', re.IGNORECASE)
+
+# pyplot is not thread-safe, matrices fitted concurrently plot one at a time
+PLOT_LOCK = threading.Lock()
 
 class SilentStdoutStderr:
     """Silecning stdout and stderr (SigProfilerAssignment prints too much output)"""
+    # sys.stdout is shared by threads fitting matrices concurrently: the first one in silences it, the last one out restores it
+    lock = threading.Lock()
+    depth = 0
     def __enter__(self):
-        self.devnull = open(os.devnull, 'w')
-        self.old_stdout = sys.stdout
-        self.old_stderr = sys.stderr
-        sys.stdout = self.devnull
-        sys.stderr = self.devnull
+        with SilentStdoutStderr.lock:
+            if SilentStdoutStderr.depth == 0:
+                SilentStdoutStderr.devnull = open(os.devnull, 'w')
+                SilentStdoutStderr.old_stdout = sys.stdout
+                SilentStdoutStderr.old_stderr = sys.stderr
+                sys.stdout = SilentStdoutStderr.devnull
+                sys.stderr = SilentStdoutStderr.devnull
+            SilentStdoutStderr.depth += 1
     def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout = self.old_stdout
-        sys.stderr = self.old_stderr
-        self.devnull.close()
+        with SilentStdoutStderr.lock:
+            SilentStdoutStderr.depth -= 1
+            if SilentStdoutStderr.depth == 0:
+                sys.stdout = SilentStdoutStderr.old_stdout
+                sys.stderr = SilentStdoutStderr.old_stderr
+                SilentStdoutStderr.devnull.close()
+
+def file_digest(file_path):
+    '''Return SHA-256 hex digest of file contents'''
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def assignment_cache_key(input, context_type, database, gen_ex, exclude, engine='sigprofiler', minimal_output=False,
+                         bootstrap=0, seed=0):
+    '''Build assignment cache key from the matrix contents and assignment parameters'''
+    if isinstance(input, pd.DataFrame):
+        matrix_digest = hashlib.sha256(input.to_csv(sep='\t').encode()).hexdigest()
+    else:
+        matrix_digest = file_digest(input)
+
+    return cache_key(matrix=matrix_digest,
+                     context_type=context_type,
+                     signature_database=file_digest(database) if database else None,
+                     exome=gen_ex,
+                     exclude_signature_subgroups=exclude,
+                     genome_build='GRCh38',
+                     engine=engine,
+                     minimal_output=minimal_output,
+                     bootstrap=(bootstrap, seed) if bootstrap else None,
+                     # Read from the package metadata, so that native runs do not import SigProfilerAssignment
+                     sigprofilerassignment=importlib.metadata.version('SigProfilerAssignment') if engine == 'sigprofiler' else None)
 
-def analyze(args):
-    '''Function to analyze a single file using SigProfilerAssignment'''
-    input, output, context_type, database, gen_ex, exclude = args
+def restore_cache_entry(cached_dir, output):
+    '''Replace output with a copy of a cache entry, leaving no file of a previous run next to the cached results'''
+    restored_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)), prefix='.restore_')
+    try:
+        shutil.copytree(cached_dir, restored_dir, dirs_exist_ok=True)
+        shutil.rmtree(output)
+        os.rename(restored_dir, output)
+    finally:
+        if os.path.exists(restored_dir):
+            shutil.rmtree(restored_dir)
+
+def run_cosmic_fit(samples, output, context_type, database, gen_ex, exclude, make_plots=True, cpu=-1):
+    '''Assign COSMIC signatures to samples (matrix path or dataframe) using SigProfilerAssignment'''
     from SigProfilerAssignment import Analyzer as Analyze
-    os.makedirs(output, exist_ok=True)
 
     #assign activities
-    with SilentStdoutStderr():
+    with PLOT_LOCK if make_plots else contextlib.nullcontext(), SilentStdoutStderr():
         Analyze.cosmic_fit(
-            samples=input,
+            samples=samples,
             output=output,
             context_type=context_type,
             genome_build='GRCh38',
             signature_database=database,
             exome=gen_ex,
             collapse_to_SBS96=False,
+            make_plots=make_plots,
             verbose=False,
-            exclude_signature_subgroups=exclude
+            exclude_signature_subgroups=exclude,
+            cpu=cpu
         )
 
+def preload_engine(context_type, gen_ex, database, engine):
+    '''Import the fitting engine and preload reference signatures into this process'''
+    if engine == 'native':
+        preload_signatures(context_type, gen_ex, database)
+    else:
+        from SigProfilerAssignment import Analyzer
+        from sigProfilerPlotting import plotActivity, tmbplot
+
+def init_worker(context_types, gen_ex, database, engine):
+    '''Pool initializer paying the fitting engine import and reference loading (of every context type) once per worker'''
+    # Interrupts are handled by the main process, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for context_type in context_types:
+        preload_engine(context_type, gen_ex, database, engine)
+
+def start_pool(workers, context_types, gen_ex, database, engine):
+    '''Start a pool of workers with the fitting engine and reference signatures preloaded (no pool, None, for 0 workers)'''
+    if workers == 0:
+        return contextlib.nullcontext()
+    return Pool(processes=workers, initializer=init_worker, initargs=(sorted(set(context_types)), gen_ex, database, engine))
+
+def fit_shard(args):
+    '''Fit a shard of samples on a single core (pool task)'''
+    samples, output, context_type, database, gen_ex, exclude, make_plots = args
+    with stage('fit_shard', rows_in=samples.shape[1], outputs=[output]):
+        run_cosmic_fit(samples, output, context_type, database, gen_ex, exclude, make_plots=make_plots, cpu=1)
+    return output
+
+def shard_count(n_samples, shards):
+    '''Limit number of sample shards so that each shard holds at least MIN_SHARD_SAMPLES samples'''
+    return max(1, min(shards, n_samples // MIN_SHARD_SAMPLES))
+
+def fit_samples(samples, matrix, output, context_type, database, gen_ex, exclude, shards=1, pool=None, make_plots=True,
+                engine='sigprofiler'):
+    '''Fit samples into output, splitting matrix sample columns into shards fitted in the pool'''
+    # The native engine fits all samples at once without plots
+    if engine == 'native':
+        native_fit(samples, output, context_type, database, gen_ex, exclude)
+        return
+
+    # Samples without mutations have no assignment records
+    matrix = matrix.loc[:, matrix.sum().to_numpy() > 0]
+    shards = shard_count(matrix.shape[1], shards)
+    if shards == 1:
+        run_cosmic_fit(samples, output, context_type, database, gen_ex, exclude, make_plots=make_plots)
+        return
+
+    # Only the first shard plots reference signatures, activity plots are redrawn after merging
+    with tempfile.TemporaryDirectory(dir=output) as shards_dir:
+        tasks = [(matrix.iloc[:, columns], os.path.join(shards_dir, f'shard_{i}'), context_type, database, gen_ex, exclude,
+                  make_plots and i == 0)
+                 for i, columns in enumerate(np.array_split(np.arange(matrix.shape[1]), shards))]
+
+        # Create own pool if not given one
+        if pool is None:
+            with Pool(processes=min(shards, cpu_count()), initializer=init_worker,
+                      initargs=([context_type], gen_ex, database, engine)) as own_pool:
+                shard_dirs = list(tqdm(own_pool.imap(fit_shard, tasks), total=shards, desc='Analysing shards'))
+        else:
+            shard_dirs = list(tqdm(pool.imap(fit_shard, tasks), total=shards, desc='Analysing shards'))
+
+        merge_shards(shard_dirs, output, gen_ex, make_plots)
+
+def read_sample_table(table_path):
+    '''Read a per-sample output table as text'''
+    return pd.read_csv(table_path, sep='\t', dtype=str, keep_default_na=False)
+
+def merge_shards(shard_dirs, output, gen_ex, make_plots=True):
+    '''Merge shard outputs into a single SigProfilerAssignment output tree'''
+    # Shared files (reference signatures, their plots, job metadata) come from the first shard
+    shutil.copytree(shard_dirs[0], output, dirs_exist_ok=True)
+
+    for table in SAMPLE_TABLES:
+        tables = [read_sample_table(os.path.join(shard_dir, table)) for shard_dir in shard_dirs]
+        pd.concat(tables, ignore_index=True).fillna('0').to_csv(os.path.join(output, table), sep='\t', index=False)
+
+    with open(os.path.join(output, ASSIGNMENT_LOG), 'w') as log:
+        for shard_dir in shard_dirs:
+            with open(os.path.join(shard_dir, ASSIGNMENT_LOG)) as shard_log:
+                log.write(shard_log.read())
+
+    if make_plots:
+        plot_activities(output, gen_ex)
+
+def plot_activities(output, gen_ex):
+    '''Plot tumor mutational burden and activities of all samples like SigProfilerAssignment does'''
+    from sigProfilerPlotting import plotActivity as plot_ac
+    from sigProfilerPlotting import tmbplot as tmb
+    activities_dir = os.path.join(output, 'Assignment_Solution', 'Activities')
+    activities_file = os.path.join(activities_dir, 'Assignment_Solution_Activities.txt')
+
+    exposures = pd.read_csv(activities_file, sep='\t', index_col=0).rename_axis('Samples', axis='columns')
+    with PLOT_LOCK, SilentStdoutStderr():
+        tmb.plotTMB(pd.melt(exposures), scale='exome' if gen_ex else 'genome', Yrange='adapt',
+                    output=os.path.join(activities_dir, 'Assignment_Solution_TMB_plot.pdf'))
+        plot_ac.plotActivity(activities_file, output_file=os.path.join(activities_dir, 'Assignment_Solution_Activity_Plots.pdf'),
+                             bin_size=50, log=False)
+
+def bootstrap_chunk(args):
+    '''Bootstrap confidence intervals of a chunk of samples (pool task)'''
+    return bootstrap_intervals(*args)
+
+def write_bootstrap_intervals(matrix, output, context_type, database, gen_ex, exclude, replicates, seed, pool=None,
+                              minimal_output=False):
+    '''
+    Refit replicates multinomially resampled from each sample's counts on the signatures assigned to the sample,
+    and write CONFIDENCE_LEVEL intervals of the activities (chunks of samples fitted in pool if given)
+    '''
+    activities = read_activities(output)
+    signatures = load_signatures(matrix.index, context_type, database, gen_ex, exclude)
+    signatures = signatures.reindex(columns=activities.columns, fill_value=0).to_numpy()
+    counts = matrix[activities.index].to_numpy(dtype=float)
+    exposures = activities.to_numpy(dtype=float).T
+
+    # One seed per sample keeps intervals independent of chunking
+    seed_sequences = np.random.SeedSequence(seed).spawn(counts.shape[1])
+    chunks = np.array_split(np.arange(counts.shape[1]), max(1, counts.shape[1] // BOOTSTRAP_CHUNK_SAMPLES))
+    tasks = [(signatures, counts[:, chunk], exposures[:, chunk], replicates, seed_sequences[chunk[0]:chunk[-1] + 1],
+              CONFIDENCE_LEVEL) for chunk in chunks if len(chunk)]
+    chunk_bounds = list(tqdm(pool.imap(bootstrap_chunk, tasks) if pool else map(bootstrap_chunk, tasks),
+                             total=len(tasks), desc='Bootstrapping'))
+
+    bounds = {name: pd.DataFrame(np.hstack([chunk[i] for chunk in chunk_bounds]).T.round(2), index=activities.index,
+                                 columns=activities.columns)
+              for i, name in enumerate(CI_TABLES)}
+    if minimal_output:
+        table = pd.read_parquet(os.path.join(output, MINIMAL_OUTPUT_FILENAME))
+        table = pd.concat([table['Activities'], *bounds.values(), table['Solution_Stats']], axis=1,
+                          keys=['Activities', *bounds, 'Solution_Stats'])
+        table.to_parquet(os.path.join(output, MINIMAL_OUTPUT_FILENAME))
+    else:
+        for name, table_path in CI_TABLES.items():
+            bounds[name].to_csv(os.path.join(output, table_path), sep='\t')
+
+def has_previous_results(output):
+    '''Check if output holds a previous assignment with its input matrix'''
+    return all(os.path.exists(os.path.join(output, f)) for f in [INPUT_MATRIX_FILENAME] + SAMPLE_TABLES)
+
+def write_minimal_output(fit_dir, output):
+    '''Write activities and sample statistics of the output tree in fit_dir as a single parquet table in output'''
+    activities = pd.read_csv(os.path.join(fit_dir, SAMPLE_TABLES[0]), sep='\t', index_col=0)
+    stats = pd.read_csv(os.path.join(fit_dir, SAMPLE_TABLES[2]), sep='\t', index_col=0).rename_axis(activities.index.name)
+    for column in ['L1_Norm_%', 'L2_Norm_%']:
+        stats[column] = stats[column].str.rstrip('%').astype(float)
+
+    table = pd.concat({'Activities': activities, 'Solution_Stats': stats}, axis=1)
+    table.to_parquet(os.path.join(output, MINIMAL_OUTPUT_FILENAME))
+
+def write_activities_feather(output):
+    '''Write the activities table of output as feather, with int32 columns for whole counts (float32 otherwise)'''
+    activities = pd.read_csv(os.path.join(output, SAMPLE_TABLES[0]), sep='\t', index_col=0)
+    values = activities.apply(pd.to_numeric, errors='coerce').fillna(0)
+    whole_counts = (values % 1 == 0).all().all() and values.abs().max().max() < np.iinfo(np.int32).max
+    values = values.astype(np.int32 if whole_counts else np.float32)
+    feather.write_feather(pa.Table.from_pandas(values), os.path.join(output, ACTIVITIES_FEATHER),
+                          compression='uncompressed')
+
+def read_activities(output):
+    '''Read the activities of an assignment output folder (minimal output, feather copy or text table)'''
+    minimal_output_file = os.path.join(output, MINIMAL_OUTPUT_FILENAME)
+    if os.path.exists(minimal_output_file):
+        return pd.read_parquet(minimal_output_file)['Activities']
+    activities_file, feather_file = os.path.join(output, SAMPLE_TABLES[0]), os.path.join(output, ACTIVITIES_FEATHER)
+    if os.path.exists(feather_file) and os.path.getmtime(feather_file) >= os.path.getmtime(activities_file):
+        return feather.read_table(feather_file, memory_map=True).to_pandas()
+    return pd.read_csv(activities_file, sep='\t', index_col=0)
+
+def merge_sample_table(table_path, fitted_table_path, kept_samples, samples):
+    '''Replace refitted samples' records of a per-sample output table and order records as samples'''
+    # Read as text to keep the records of reused samples unchanged
+    table = read_sample_table(table_path)
+    sample_column = table.columns[0]
+    table = table[table[sample_column].isin(kept_samples)]
+
+    if fitted_table_path:
+        fitted_table = read_sample_table(fitted_table_path)
+        table = pd.concat([table, fitted_table], ignore_index=True).fillna('0')
+
+    sample_order = pd.Categorical(table[sample_column], categories=samples).codes
+    table.iloc[sample_order.argsort(kind='stable')].to_csv(table_path, sep='\t', index=False)
+
+def fit_changed_samples(matrix, output, context_type, database, gen_ex, exclude, shards=1, pool=None, engine='sigprofiler'):
+    '''Fit only new or changed samples of the matrix and merge them into the previous results in output'''
+    previous_matrix = pd.read_csv(os.path.join(output, INPUT_MATRIX_FILENAME), sep='\t', index_col=0)
+    common_samples = matrix.columns.intersection(previous_matrix.columns, sort=False)
+    unchanged = (matrix[common_samples] == previous_matrix[common_samples].reindex(matrix.index)).all()
+    kept_samples = common_samples[unchanged.to_numpy()]
+    changed_samples = matrix.columns.difference(kept_samples, sort=False)
+    print(f"{os.path.basename(output)}: fitting {len(changed_samples)} new or changed sample(s), reusing {len(kept_samples)}")
+
+    # Samples without mutations have no assignment records
+    changed_samples = changed_samples[matrix[changed_samples].sum().to_numpy() > 0]
+    if len(changed_samples) == 0:
+        for table in SAMPLE_TABLES:
+            merge_sample_table(os.path.join(output, table), None, kept_samples, matrix.columns)
+        return
+
+    with tempfile.TemporaryDirectory(dir=output) as fit_dir:
+        fit_samples(matrix[changed_samples], matrix[changed_samples], fit_dir, context_type, database, gen_ex, exclude,
+                    shards, pool, make_plots=False, engine=engine)
+        for table in SAMPLE_TABLES:
+            merge_sample_table(os.path.join(output, table), os.path.join(fit_dir, table), kept_samples, matrix.columns)
+
+def analyze(args, pool=None):
+    '''
+    Function to analyze a single file using SigProfilerAssignment
+
+    cache_dir=None disables the cache, incremental=True only fits samples changed since the previous run in output,
+    shards>1 splits samples into shards fitted in parallel (in pool if given),
+    engine='native' fits samples in process by an approximation of cosmic_fit instead of SigProfilerAssignment,
+    minimal_output=True skips plots and writes only activities and sample statistics as one parquet table,
+    bootstrap>0 adds confidence intervals of activities from that many resampled replicates (seeded by seed)
+    '''
+    (input, output, context_type, database, gen_ex, exclude, cache_dir, cache_size, incremental, shards, engine, minimal_output,
+     bootstrap, seed) = args
+    os.makedirs(output, exist_ok=True)
+
+    with stage('assignment', outputs=[output]) as record:
+        matrix = input if isinstance(input, pd.DataFrame) else pd.read_csv(input, sep='\t', index_col=0)
+        record.update(matrix=os.path.basename(output), rows_in=matrix.shape[1], engine=engine)
+
+        # Reuse cached results of the same matrix and parameters
+        key = (assignment_cache_key(input, context_type, database, gen_ex, exclude, engine, minimal_output, bootstrap, seed)
+               if cache_dir else None)
+        cached_dir = lookup_cache_entry(cache_dir, key) if cache_dir else None
+        record['cached'] = bool(cached_dir)
+        if cached_dir:
+            restore_cache_entry(cached_dir, output)
+        elif minimal_output:
+            with tempfile.TemporaryDirectory(dir=output) as fit_dir:
+                fit_samples(input, matrix, fit_dir, context_type, database, gen_ex, exclude, shards, pool, make_plots=False,
+                            engine=engine)
+                write_minimal_output(fit_dir, output)
+        elif incremental and has_previous_results(output):
+            fit_changed_samples(matrix, output, context_type, database, gen_ex, exclude, shards, pool, engine)
+        else:
+            fit_samples(input, matrix, output, context_type, database, gen_ex, exclude, shards, pool, engine=engine)
+
+        # Keep per-sample counts for incremental runs, a minimal output table of a previous run would shadow the new tables
+        if not minimal_output:
+            matrix.to_csv(os.path.join(output, INPUT_MATRIX_FILENAME), sep='\t')
+            if os.path.exists(os.path.join(output, MINIMAL_OUTPUT_FILENAME)):
+                os.remove(os.path.join(output, MINIMAL_OUTPUT_FILENAME))
+            write_activities_feather(output)
+
+        if bootstrap and not cached_dir:
+            with stage('bootstrap', rows_in=matrix.shape[1], outputs=[output]):
+                write_bootstrap_intervals(matrix, output, context_type, database, gen_ex, exclude, bootstrap, seed, pool,
+                                          minimal_output)
+
+        if cache_dir and not cached_dir:
+            store_cache_entry(cache_dir, key, lambda entry_dir: shutil.copytree(output, entry_dir, dirs_exist_ok=True),
+                              cache_size)
+
+        # Samples without mutations have no assignment records
+        record['rows_out'] = int((matrix.sum() > 0).sum())
+
+def assign_matrix(matrix, output, context_type='SBS', signature_database=None, exome=False, exclude_signature_subgroups=None,
+                  cache_dir='data/cache/assignments', cache_size=CACHE_SIZE_MB, incremental=False, shards=1, engine='sigprofiler',
+                  minimal_output=False, bootstrap=0, seed=0, pool=None):
+    '''Assign COSMIC signatures to an in-memory mutational matrix and return the activities dataframe'''
+    analyze((matrix, output, context_type, signature_database, exome, exclude_signature_subgroups, cache_dir, cache_size,
+             incremental, shards, engine, minimal_output, bootstrap, seed), pool)
+    return read_activities(output)
+
+def assign_matrices(matrices, outputs, context_types, signature_database=None, exome=False, engine='sigprofiler', **kwargs):
+    '''
+    Assign COSMIC signatures to several in-memory mutational matrices (eg. one per context) concurrently,
+    their sample shards sharing one worker pool (one matrix per worker if there are as many matrices as cores),
+    and return the activities dataframes in the order of matrices
+    '''
+    options = dict(signature_database=signature_database, exome=exome, engine=engine, **kwargs)
+    tasks = list(zip(matrices, outputs, context_types))
+
+    # The workers fit one matrix each: the native engine fits a whole matrix in the calling process,
+    # and as many matrices as cores keep the pool busy without sample shards. A single matrix is fitted here
+    if engine == 'native' or len(matrices) >= cpu_count():
+        if len(tasks) == 1:
+            return [assign_matrix(*tasks[0], **options)]
+        with start_pool(min(cpu_count(), len(tasks)), context_types, exome, signature_database, engine) as pool:
+            return list(tqdm(pool.imap(assign_matrix_task, [(*task, options) for task in tasks]), total=len(tasks),
+                             desc="Analysing"))
+
+    # One worker per sample shard, matrices too small to split into shards are fitted here
+    shards = [shard_count(int((matrix.sum() > 0).sum()), cpu_count()) for matrix in matrices]
+    workers = min(cpu_count(), sum(count for count in shards if count > 1))
+    with start_pool(workers, context_types, exome, signature_database, engine) as pool:
+        return analyze_concurrently(lambda task: assign_matrix(*task, shards=cpu_count(), pool=pool, **options), tasks)
+
+def assign_matrix_task(args):
+    '''Assign COSMIC signatures to an in-memory mutational matrix in a worker (pool task)'''
+    matrix, output, context_type, options = args
+    return assign_matrix(matrix, output, context_type, **options)
+
+def analyze_concurrently(function, tasks):
+    '''Run function on every task in its own thread (pool tasks of all of them interleave) and return the results in order'''
+    if len(tasks) == 1:
+        return [function(tasks[0])]
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        return list(tqdm(executor.map(function, tasks), total=len(tasks), desc="Analysing"))
+
+def matrix_signature_type(file_path, default='SBS'):
+    '''Signature type named by a matrix file (eg. DBS for MutSigMA.DBS78.all), default if the name does not tell'''
+    match = MATRIX_TYPE_PATTERN.search(os.path.basename(file_path))
+    return match.group(1).upper() if match else default
+
+def find_matrix_files(input_path):
+    '''Return mutational matrix (.all) files of a file or folder path'''
+    if os.path.isfile(input_path):
+        files_to_process = [input_path] if os.path.splitext(input_path)[1].lower() == '.all' else []
+    elif os.path.isdir(input_path):
+        files_to_process = [
+            os.path.join(input_path, f)
+            for f in os.listdir(input_path)
+            if os.path.isfile(os.path.join(input_path, f)) and os.path.splitext(os.path.join(input_path, f))[1].lower() == '.all'
+        ]
+    else:
+        raise ValueError(f"Provided {input_path} is not a file or directory")
+
+    if not files_to_process:
+        raise ValueError(f"Provided {input_path} does not contain any suitable file(s)")
+    return files_to_process
+
+def find_input_files(inputs):
+    '''Return mutational matrix (.all) files of one or several file or folder paths'''
+    return [file_path for input_path in ([inputs] if isinstance(inputs, str) else inputs)
+            for file_path in find_matrix_files(input_path)]
+
+def signature_types(args):
+    '''Signature types of the matrix files of parsed arguments: the given type, else the types their names tell'''
+    if args.signature_type:
+        return [args.signature_type]
+    if not args.input:
+        return ['SBS']
+    return sorted({matrix_signature_type(file_path) for file_path in find_input_files(args.input)})
+
+def run_assignment(args, pool):
+    '''
+    Assign signatures to the matrix file(s) of parsed arguments (or a server request) using pool,
+    each file fitted against the given signature type or the type its name tells (SBS by default)
+    '''
+    files_to_process = find_input_files(args.input)
+    print(f"Found {len(files_to_process)} file(s) to process: {', '.join([os.path.basename(f) for f in files_to_process])}")
+    gen_ex = False if args.genome_type == 'genome' else True
+    cache_dir = None if args.no_cache else args.cache_dir
+    # Files fitted concurrently share the pool, so each one is split across all of it
+    shards = args.sample_shards or (cpu_count() if len(files_to_process) < cpu_count() else 1)
+    tasks = []
+    for file_path in files_to_process:
+        output_dir = os.path.join(args.output, os.path.splitext(os.path.basename(file_path))[0])
+        signature_type = args.signature_type or matrix_signature_type(file_path)
+        tasks.append((file_path, output_dir, signature_type, args.signature_database, gen_ex, args.exclude_signature_subgroups,
+                      cache_dir, args.cache_size, args.incremental, shards, args.engine, args.minimal_output, args.bootstrap,
+                      args.seed))
+
+    # The native engine fits a whole matrix in the calling process, several native matrices are fitted by the workers
+    if shards > 1 and (args.engine != 'native' or len(tasks) == 1):
+        # Fewer files than cores: split each file's samples across the pool, files are fitted concurrently
+        # so that the shards of a large matrix (eg. SBS96) and the steps run here for each file overlap
+        analyze_concurrently(lambda task: analyze(task, pool), tasks)
+    elif len(tasks) == 1:
+        analyze(tasks[0], pool)
+    else:
+        list(tqdm(pool.imap_unordered(analyze, tasks), total=len(tasks), desc="Analysing"))
+    return [task[1] for task in tasks]
+
+def matrix_sample_count(file_path):
+    '''Number of sample columns of a matrix file, read from its header'''
+    with open(file_path) as f:
+        return len(f.readline().rstrip('\n').split('\t')) - 1
+
+def worker_count(args):
+    '''
+    Number of workers the matrix files of parsed arguments need, as run_assignment fits them: one per sample shard
+    or one per file, none for a single file fitted in this process. A server (no input) keeps one per core
+    '''
+    if not args.input:
+        return cpu_count()
+    files = find_input_files(args.input)
+    shards = args.sample_shards or (cpu_count() if len(files) < cpu_count() else 1)
+    if shards > 1 and (args.engine != 'native' or len(files) == 1):
+        # The native engine fits a whole matrix in this process
+        if args.engine == 'native':
+            return 0
+        counts = [shard_count(matrix_sample_count(file_path), shards) for file_path in files]
+        return min(cpu_count(), sum(count for count in counts if count > 1))
+    return min(cpu_count(), len(files)) if len(files) > 1 else 0
+
+def worker_pool(args):
+    '''Create a pool of workers with the fitting engine and reference signatures of args preloaded (None if not needed)'''
+    gen_ex = False if args.genome_type == 'genome' else True
+    return start_pool(worker_count(args), signature_types(args), gen_ex, args.signature_database, args.engine)
+
+def handle_request(line, defaults, pool):
+    '''Run one JSON assignment request (command line option names as keys) and return the JSON response'''
+    try:
+        request = json.loads(line)
+        unknown = set(request) - set(vars(defaults))
+        if unknown:
+            raise ValueError(f"Unknown request option(s): {', '.join(sorted(unknown))}")
+        outputs = run_assignment(argparse.Namespace(**{**vars(defaults), **request}), pool)
+        response = {'status': 'ok', 'outputs': outputs}
+    except Exception as e:
+        response = {'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+    return json.dumps(response)
+
+def remove_stale_socket(socket_path):
+    '''Remove a socket left by a server that is no longer running, exit if socket_path is anything else'''
+    if not os.path.lexists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        sys.exit(f"{socket_path} exists and is not a socket, choose another --serve path")
+
+    # A server still accepting connections keeps its socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+    sys.exit(f"An assignment server is already listening on {socket_path}")
+
+def serve(defaults, socket_path=None):
+    '''
+    Serve assignment requests with warm workers, one JSON object per line from stdin
+    (responses on stdout) or from connections to a Unix socket at socket_path
+    '''
+    if socket_path is not None:
+        remove_stale_socket(socket_path)
+    else:
+        # Keep stdout for responses, progress output of this process and the workers goes to stderr
+        responses = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        sys.stdout.flush()
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    with worker_pool(defaults) as pool:
+        # Requests with few samples are fitted in this process
+        for signature_type in signature_types(defaults):
+            preload_engine(signature_type, defaults.genome_type == 'exome', defaults.signature_database, defaults.engine)
+
+        if socket_path is None:
+            print('Assignment server reading requests from stdin')
+            for line in sys.stdin:
+                if line.strip():
+                    responses.write(handle_request(line, defaults, pool) + '\n')
+                    responses.flush()
+            return
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        self.wfile.write((handle_request(line, defaults, pool) + '\n').encode())
+
+        with socketserver.UnixStreamServer(socket_path, RequestHandler) as server:
+            print(f'Assignment server listening on {socket_path}')
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(socket_path)
+
 def main():
     '''
     Assign COSMIC signatures to mutational data.
 
     Arguments:
-    -i/--input: Path to mutational matrix (SBS/DBS/ID) file or folder of files
+    -i/--input: Paths to mutational matrix (SBS/DBS/ID) files or folders of files
     -o/--output: Output directory
-    -s/--signature_type: Type of signatures (SBS/DBS/ID)
+    -s/--signature_type: Type of signatures (SBS/DBS/ID), by default the type in each matrix file name (SBS otherwise)
     -g/--genome_type: Exome or genome data
     -d/--signature_database: Optional path to .txt file to include only selected signatures
     -e/--exclude_signature_subgroups: Exclude signature subgroups you don't want to analyze
+    -n/--no_cache: Re-run assignment without reading or updating the cache
+    --cache_dir: Assignment results cache directory
+    --cache_size: Maximum cache size in MB
+    -u/--incremental: Only fit samples that are new or changed since the previous run in the output directory
+    -j/--sample_shards: Number of sample shards per matrix fitted in parallel
+    --engine: Signature fitting engine (sigprofiler or native)
+    -m/--minimal_output: Skip plots and write only activities and sample statistics as one parquet file
+    -b/--bootstrap: Number of bootstrap replicates for confidence intervals of activities
+    --seed: Random seed of bootstrap resampling
+    --serve: Serve JSON-lines requests from stdin, or from a Unix socket if a path is given
+    --run_log: Append wall time, CPU time, peak memory, rows and files written of every stage to a JSON-lines file
+    --profile: Profile these stages (assignment, fit_shard, bootstrap, or all) into cProfile files next to the run log
     '''
     # create parser
     parser = argparse.ArgumentParser(
@@ -55,43 +634,50 @@ def main():
         description='Assign COSMIC signatures to mutation data')
     
     # Add parser arguments
-    parser.add_argument('-i','--input', required=True, help='Path to mutational matrix (SBS/DBS/ID) file or folder of files')
+    parser.add_argument('-i','--input', nargs='+', help='Paths to mutational matrix (SBS/DBS/ID) files or folders of files')
     parser.add_argument('-o','--output', help='Output directory', default='output')
-    parser.add_argument('-s','--signature_type', choices=['SBS', 'DBS', 'ID'], default='SBS', help='Type of signatures')
+    parser.add_argument('-s','--signature_type', choices=['SBS', 'DBS', 'ID'], default=None,
+                        help='Type of signatures (default: the type in each matrix file name, eg. DBS for MutSigMA.DBS78.all, SBS otherwise)')
     parser.add_argument('-g','--genome_type', choices=['exome', 'genome'], default='genome', help='Exome or genome data')
     parser.add_argument('-d','--signature_database', help='Optional path to .txt file to include only selected signatures', default=None)
     parser.add_argument('-e','--exclude_signature_subgroups', help='Exclude signature subgroups you don\'t want to analyze', default=None)
+    parser.add_argument('-n','--no_cache', action='store_true', help='Re-run assignment without reading or updating the cache')
+    parser.add_argument('--cache_dir', help='Assignment results cache directory', default='data/cache/assignments')
+    parser.add_argument('--cache_size', type=float, help='Maximum cache size in MB', default=CACHE_SIZE_MB)
+    parser.add_argument('-u','--incremental', action='store_true',
+                        help='Only fit samples that are new or changed since the previous run in the output directory')
+    parser.add_argument('-j','--sample_shards', type=int, default=0,
+                        help='Number of sample shards per matrix fitted in parallel (default: CPU count if fewer files than CPUs, 1 disables)')
+    parser.add_argument('--engine', choices=['sigprofiler', 'native'], default='sigprofiler',
+                        help='Signature fitting engine (native: in-process approximation of cosmic_fit\'s stepwise NNLS, no plots)')
+    parser.add_argument('-m','--minimal_output', action='store_true',
+                        help='Skip plots and write only activities and sample statistics as one parquet file')
+    parser.add_argument('-b','--bootstrap', type=int, default=0,
+                        help='Number of bootstrap replicates for 95%% confidence intervals of activities (default: 0, disabled)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of bootstrap resampling (default: 0)')
+    parser.add_argument('--serve', nargs='?', const='-', metavar='SOCKET',
+                        help='Keep workers warm and serve JSON-lines requests (option names as keys) from stdin, or from a Unix socket')
+    parser.add_argument('--run_log', default=None,
+                        help='Append wall time, CPU time, peak memory, rows and files written of every stage to this JSON-lines file')
+    parser.add_argument('--profile', nargs='+', default=None, metavar='STAGE',
+                        help='Profile these stages (assignment, fit_shard, bootstrap, or all) into <run log>.<stage>.<pid>.<n>.prof files')
     
     args = parser.parse_args()
-    gen_ex = False if args.genome_type == 'genome' else True
-    print( os.path.isdir(args.input) )
-    # checking file(s) and its (their) format
-    input_path = args.input
-    if os.path.isfile(input_path):
-        files_to_process = [input_path] if os.path.splitext(input_path)[1].lower() == '.all' else []
-    elif os.path.isdir(input_path):
-        files_to_process = [
-            os.path.join(input_path, f)
-            for f in os.listdir(input_path)
-            if os.path.isfile(os.path.join(input_path, f)) and os.path.splitext(os.path.join(input_path, f))[1].lower() == '.all'
-        ]
-    else:
-        raise ValueError(f"Provided {input_path} is not a file or directory")
-    
-    if not files_to_process:
-        raise ValueError(f"Provided {input_path} does not contain any suitable file(s)")
-    else:
-        print(f"Found {len(files_to_process)} file(s) to process: {', '.join([os.path.basename(f) for f in files_to_process])}")
-        context_type = args.signature_type
-        tasks = []
-        for file_path in files_to_process:
-            output_dir = os.path.join(args.output, os.path.splitext(os.path.basename(file_path))[0])
-            tasks.append((file_path, output_dir, context_type, args.signature_database, gen_ex, args.exclude_signature_subgroups))
-
-        # Multiprocessing analysis
-        with Pool(processes=cpu_count()) as pool:
-            list(tqdm(pool.imap_unordered(analyze, tasks), total=len(tasks), desc="Analysing"))
-        print(f"Analysis completed. Results saved in {args.output}")
+    if args.profile and not args.run_log:
+        parser.error('--profile requires --run_log')
+    if args.run_log:
+        # Set before the worker pool starts, so workers log their stages too
+        configure_run_log(args.run_log, args.profile)
+    if args.serve:
+        serve(args, None if args.serve == '-' else args.serve)
+        return
+    if not args.input:
+        parser.error('the following arguments are required: -i/--input')
+
+    # Multiprocessing analysis
+    with worker_pool(args) as pool:
+        run_assignment(args, pool)
+    print(f"Analysis completed. Results saved in {args.output}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,441 @@
+import importlib.util
+import os
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# COSMIC reference release shipped with SigProfilerAssignment
+COSMIC_VERSION = '3.6'
+
+# Mutation types of the COSMIC reference signatures per signature type
+REFERENCE_MUTATION_TYPES = {'SBS': 96, 'DBS': 78, 'ID': 83}
+
+# Penalties of SigProfilerAssignment's cosmic_fit, in reconstruction L2 error relative to the sample's L2 norm:
+# increase allowed when removing signatures from the initial fit, decrease needed to add a signature
+# and increase allowed when removing a signature in the add-remove layers
+INITIAL_REMOVE_PENALTY = 0.05
+ADD_PENALTY = 0.05
+REMOVE_PENALTY = 0.01
+
+# SBS signatures cosmic_fit never removes, and groups of SBS signatures it adds together
+BACKGROUND_SIGNATURES = ['SBS1', 'SBS5']
+CONNECTED_SIGNATURES = [['SBS2', 'SBS13'], ['SBS7a', 'SBS7b', 'SBS7c', 'SBS7d'], ['SBS10a', 'SBS10b'], ['SBS17a', 'SBS17b']]
+
+# Samples fitted together, and NNLS problems (sample and signature set pairs) solved together
+FIT_CHUNK_SAMPLES = 200
+NNLS_BATCH_PROBLEMS = 20000
+
+# Gradient (relative to the largest W^T c value of a problem) below which NNLS adds no signature
+NNLS_TOLERANCE = 1e-10
+
+# Samples per chunk of the decomposed probabilities table (samples x mutation types x signatures)
+DECOMPOSED_CHUNK_SAMPLES = 500
+
+# Signature subgroups that can be excluded from the fit, as listed by SigProfilerAssignment
+SIGNATURE_SUBGROUPS = {
+    'MMR_deficiency_signatures': {'SBS': ['6', '14', '15', '20', '21', '26', '44'], 'DBS': ['7', '10'], 'ID': ['7']},
+    'POL_deficiency_signatures': {'SBS': ['10a', '10b', '10c', '10d', '28'], 'DBS': ['3'], 'ID': []},
+    'HR_deficiency_signatures': {'SBS': ['3'], 'DBS': ['13'], 'ID': ['6']},
+    'BER_deficiency_signatures': {'SBS': ['30', '36'], 'DBS': [], 'ID': []},
+    'Chemotherapy_signatures': {'SBS': ['11', '25', '31', '35', '86', '87', '90', '99'], 'DBS': ['5'], 'ID': []},
+    'Immunosuppressants_signatures': {'SBS': ['32'], 'DBS': [], 'ID': []},
+    'Treatment_signatures': {'SBS': ['11', '25', '31', '32', '35', '86', '87', '90', '99'], 'DBS': ['5'], 'ID': []},
+    'APOBEC_signatures': {'SBS': ['2', '13'], 'DBS': [], 'ID': []},
+    'Tobacco_signatures': {'SBS': ['4', '29', '92', '100', '109'], 'DBS': ['2'], 'ID': ['3']},
+    'UV_signatures': {'SBS': ['7a', '7b', '7c', '7d', '38'], 'DBS': ['1'], 'ID': ['13']},
+    'AA_signatures': {'SBS': ['22', '22a', '22b'], 'DBS': ['20'], 'ID': ['23']},
+    'Colibactin_signatures': {'SBS': ['88'], 'DBS': [], 'ID': ['18']},
+    'Artifact_signatures': {'SBS': ['27', '43', '45', '46', '47', '48', '49', '50', '51', '52', '53', '54', '55', '56',
+                                    '57', '58', '59', '60', '95'], 'DBS': ['14'], 'ID': []},
+    'Lymphoid_signatures': {'SBS': ['9', '84', '85'], 'DBS': [], 'ID': []},
+}
+
+def reference_signatures_path(n_types, gen_ex=False):
+    '''Path of the COSMIC reference signatures file of SigProfilerAssignment for n_types mutation types'''
+    package_dir = importlib.util.find_spec('SigProfilerAssignment').submodule_search_locations[0]
+    reference_dir = os.path.join(package_dir, 'data', 'Reference_Signatures')
+    exome = '_exome' if gen_ex else ''
+
+    if n_types == 96:
+        return os.path.join(reference_dir, 'GRCh38', f'COSMIC_v{COSMIC_VERSION}_SBS_GRCh38{exome}.txt')
+    if n_types == 78:
+        return os.path.join(reference_dir, 'GRCh38', f'COSMIC_v{COSMIC_VERSION}_DBS_GRCh38{exome}.txt')
+    if n_types == 83:
+        return os.path.join(reference_dir, 'GRCh37', f'COSMIC_v{COSMIC_VERSION}_ID_GRCh37.txt')
+    raise ValueError(f'The native engine has no COSMIC reference for {n_types} mutation types, use a signature database')
+
+@lru_cache(maxsize=None)
+def read_signatures(file_path):
+    '''Read a signatures file once per process'''
+    return pd.read_csv(file_path, sep='\t', index_col=0)
+
+def preload_signatures(context_type, gen_ex=False, database=None):
+    '''Read the reference signatures of context_type (or the signature database) into the per-process cache'''
+    read_signatures(database or reference_signatures_path(REFERENCE_MUTATION_TYPES[context_type], gen_ex))
+
+def excluded_signatures(exclude, context_type):
+    '''Signature names of the excluded subgroups (list or comma-separated string of subgroup names)'''
+    if not exclude:
+        return []
+    if isinstance(exclude, str):
+        exclude = [subgroup.strip() for subgroup in exclude.split(',')]
+
+    unknown = set(exclude) - set(SIGNATURE_SUBGROUPS)
+    if unknown:
+        raise ValueError(f"Unknown signature subgroup(s): {', '.join(sorted(unknown))}")
+    return [f'{context_type}{suffix}' for subgroup in exclude for suffix in SIGNATURE_SUBGROUPS[subgroup][context_type]]
+
+def load_signatures(mutation_types, context_type, database=None, gen_ex=False, exclude=None):
+    '''Load reference signatures (COSMIC or the signature database) with rows in the order of mutation_types'''
+    signatures = read_signatures(database or reference_signatures_path(len(mutation_types), gen_ex))
+    signatures = signatures.drop(columns=excluded_signatures(exclude, context_type), errors='ignore')
+
+    missing = pd.Index(mutation_types).difference(signatures.index)
+    if len(missing):
+        raise ValueError(f"Signatures have no rows for mutation type(s): {', '.join(missing[:5])}")
+    return signatures.reindex(mutation_types)
+
+def round_conserve_sum(exposures):
+    '''Round exposures (problems x signatures) keeping each row's rounded total, as roundConserveSum of SigProfilerAssignment'''
+    rounded = np.ceil(exposures)
+    excess = np.floor(rounded.sum(axis=1) - np.round(exposures.sum(axis=1)) + 1e-10).astype(int)
+    order = np.argsort(exposures - rounded, axis=1, kind='stable')
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(exposures.shape[1]), axis=1)
+    return rounded - (ranks < excess[:, np.newaxis])
+
+def round_to_totals(exposures, totals):
+    '''Round exposures (problems x signatures), correcting each row's largest exposure so that the row adds up to its total'''
+    rounded = np.round(exposures)
+    largest = exposures.argmax(axis=1)
+    rounded[np.arange(len(rounded)), largest] += np.round(totals) - rounded.sum(axis=1)
+    return rounded
+
+def normalize(weights, totals):
+    '''Scale NNLS weights (problems x signatures) so that each row adds up to its total number of mutations'''
+    sums = weights.sum(axis=1, keepdims=True)
+    return np.divide(weights, sums, out=np.zeros_like(weights), where=sums > 0) * totals[:, np.newaxis]
+
+def solve_passive(gram, projections, passive):
+    '''Least squares solutions of the normal equations restricted to each problem's passive signatures'''
+    solution = np.zeros(projections.shape)
+    size = passive.sum(axis=1).max(initial=0)
+    if size == 0:
+        return solution
+
+    # Passive signatures first, padded with identity rows and columns up to the largest passive set
+    order = np.argsort(~passive, axis=1, kind='stable')[:, :size]
+    valid = np.take_along_axis(passive, order, axis=1)
+    system = np.where(valid[:, :, np.newaxis] & valid[:, np.newaxis, :],
+                      gram[order[:, :, np.newaxis], order[:, np.newaxis, :]], np.eye(size))
+    rhs = np.where(valid, np.take_along_axis(projections, order, axis=1), 0)
+    np.put_along_axis(solution, order, np.where(valid, np.linalg.solve(system, rhs[:, :, np.newaxis])[:, :, 0], 0), axis=1)
+    return solution
+
+def batched_nnls(gram, projections, allowed, initial=None):
+    '''
+    Solve NNLS problems min ||W x - c|| together by the Lawson-Hanson active-set method on the normal equations.
+    gram is W^T W, rows of projections hold W^T c of each problem and allowed masks the signatures each problem may use.
+    Non-negative initial values warm-start the search from their non-zero signatures
+    '''
+    exposures = np.zeros(projections.shape) if initial is None else np.where(allowed, initial, 0)
+    passive = exposures > 0
+    pending = passive.any(axis=1)
+    tolerance = NNLS_TOLERANCE * np.abs(projections).max(axis=1, initial=0)
+
+    for _ in range(3 * gram.shape[0]):
+        # Solve the changed passive sets, stepping back towards the solution while it has negative values
+        while pending.any():
+            rows = np.flatnonzero(pending)
+            solution = solve_passive(gram, projections[rows], passive[rows])
+            negative = passive[rows] & (solution <= 0)
+            feasible = ~negative.any(axis=1)
+            exposures[rows[feasible]] = solution[feasible]
+            pending[rows[feasible]] = False
+
+            rows, solution, negative = rows[~feasible], solution[~feasible], negative[~feasible]
+            current = exposures[rows]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratios = np.nan_to_num(np.where(negative, current / (current - solution), np.inf), nan=0)
+            steps = ratios.min(axis=1, keepdims=True)
+            current = current + steps * (solution - current)
+            passive[rows] &= ~(negative & (ratios <= steps)) & (current > 0)
+            exposures[rows] = current * passive[rows]
+
+        # Add the signature with the largest positive gradient of every problem that has one
+        gradient = np.where(allowed & ~passive, projections - exposures @ gram, -np.inf)
+        best = gradient.argmax(axis=1)
+        rows = np.flatnonzero(gradient[np.arange(len(best)), best] > tolerance)
+        if len(rows) == 0:
+            break
+        passive[rows, best[rows]] = True
+        pending[rows] = True
+
+    return exposures
+
+def fit_problems(signatures, gram, counts, allowed, initial=None):
+    '''
+    NNLS weights of problems (rows of counts fitted to the allowed signatures), solved in batches of NNLS_BATCH_PROBLEMS,
+    and their reconstruction L2 errors relative to the counts' L2 norms
+    '''
+    weights = np.zeros(allowed.shape)
+    errors = np.zeros(len(allowed))
+    for start in range(0, len(allowed), NNLS_BATCH_PROBLEMS):
+        batch = slice(start, start + NNLS_BATCH_PROBLEMS)
+        weights[batch] = batched_nnls(gram, counts[batch] @ signatures, allowed[batch],
+                                      None if initial is None else initial[batch])
+        errors[batch] = (np.linalg.norm(counts[batch] - weights[batch] @ signatures.T, axis=1)
+                         / np.linalg.norm(counts[batch], axis=1))
+    return weights, errors
+
+def background_positions(exposures, indices):
+    '''
+    Positions among each row's non-zero exposures of the first exposure equal to the exposure at each index
+    (-1 for none), as get_changed_background_sig_idx of SigProfilerAssignment tracks the signatures it never removes
+    '''
+    values = np.where(indices >= 0, np.take_along_axis(exposures, np.maximum(indices, 0), axis=1), 0)
+    nonzero = exposures != 0
+    matches = nonzero[:, np.newaxis, :] & (exposures[:, np.newaxis, :] == values[:, :, np.newaxis])
+    positions = np.take_along_axis(np.cumsum(nonzero, axis=1), matches.argmax(axis=2), axis=1) - 1
+    return np.where(matches.any(axis=2) & (indices >= 0), positions, -1)
+
+def remove_signatures(signatures, gram, counts, exposures, errors, kept, penalty):
+    '''
+    Remove signatures from fitted problems one at a time, as remove_all_single_signatures of SigProfilerAssignment:
+    the removal increasing the relative error the least is made while the increase is at most penalty.
+    exposures are the rounded exposures of the fits, kept the indices of signatures that are not removed.
+    Returns the exposures (scaled NNLS weights after removals) and relative errors (kept without removals)
+    '''
+    totals = counts.sum(axis=1)
+    active = exposures > 0
+    weights, current_errors = fit_problems(signatures, gram, counts, active, exposures)
+    removed_exposures, removed_errors = exposures.copy(), errors.copy()
+    removed = np.zeros(len(exposures), dtype=bool)
+    protected = np.tile(kept, (len(exposures), 1))
+    running = active.sum(axis=1) > 1
+
+    while running.any():
+        rows = np.flatnonzero(running)
+        protected[rows] = background_positions(exposures[rows], protected[rows])
+        positions = np.cumsum(active[rows], axis=1) - 1
+        removable = active[rows] & ~(positions[:, :, np.newaxis] == protected[rows][:, np.newaxis, :]).any(axis=2)
+        pair_rows, pair_signatures = np.nonzero(removable)
+        problems = rows[pair_rows]
+        allowed = active[problems]
+        allowed[np.arange(len(problems)), pair_signatures] = False
+        pair_weights, pair_errors = fit_problems(signatures, gram, counts[problems], allowed, weights[problems])
+
+        # Removals lowering the error are not taken, the first of the smallest increases is
+        increases = np.full(removable.shape, np.inf)
+        increase = pair_errors - current_errors[problems]
+        increases[pair_rows, pair_signatures] = np.where(increase >= 0, increase, np.inf)
+        best = increases.argmin(axis=1)
+        accepted = increases[np.arange(len(rows)), best] <= penalty
+
+        removals = np.flatnonzero(accepted[pair_rows] & (pair_signatures == best[pair_rows]))
+        removed_rows = problems[removals]
+        weights[removed_rows] = pair_weights[removals]
+        current_errors[removed_rows] = removed_errors[removed_rows] = pair_errors[removals]
+        removed_exposures[removed_rows] = normalize(pair_weights[removals], totals[removed_rows])
+        protected[removed_rows] = background_positions(removed_exposures[removed_rows], protected[removed_rows])
+        active[removed_rows] = pair_weights[removals] > 0
+        removed[removed_rows] = True
+        running[rows[~accepted]] = False
+        running &= active.sum(axis=1) > 1
+
+    return removed_exposures, removed_errors
+
+def connect_signatures(selected, groups):
+    '''Add the other signatures of connected groups (masks) to selected signatures (problems x signatures)'''
+    selected = selected.copy()
+    for group in groups:
+        selected[(selected & group).any(axis=1)] |= group
+    return selected
+
+def fit_chunk(signatures, gram, counts, kept_indices, groups):
+    '''
+    Fit a chunk of samples (rows of counts) by the stepwise procedure of SigProfilerAssignment's cosmic_fit:
+    an NNLS fit on all signatures and an initial removal, then add-remove layers. A layer tries adding each other
+    signature to the selected ones (with kept signatures and connected groups), keeps it if the relative error drops
+    by more than ADD_PENALTY, then removes signatures and selects the candidate with the lowest error.
+    Layers stop when they no longer lower the error. Returns the rounded exposures (samples x signatures)
+    '''
+    n_samples, n_signatures = len(counts), signatures.shape[1]
+    totals = counts.sum(axis=1)
+    kept = np.isin(np.arange(n_signatures), kept_indices)
+    weights, errors = fit_problems(signatures, gram, counts, np.ones((n_samples, n_signatures), dtype=bool))
+    exposures, errors = remove_signatures(signatures, gram, counts, round_conserve_sum(normalize(weights, totals)),
+                                          errors, np.empty(0, dtype=int), INITIAL_REMOVE_PENALTY)
+
+    selected = (exposures > 0) | kept
+    best_errors = np.full(n_samples, np.inf)
+    running = np.ones(n_samples, dtype=bool)
+    while running.any():
+        rows = np.flatnonzero(running)
+        base = connect_signatures(selected[rows] | kept, groups)
+        base_weights, base_errors = fit_problems(signatures, gram, counts[rows], base, exposures[rows])
+
+        # Candidates are the signatures the previous layer did not select, those in the base fit add nothing
+        candidates = ~selected[rows]
+        pair_rows, pair_signatures = np.nonzero(candidates & ~base)
+        allowed = base[pair_rows]
+        allowed[np.arange(len(pair_rows)), pair_signatures] = True
+        added_weights, added_errors = fit_problems(signatures, gram, counts[rows[pair_rows]], allowed,
+                                                   base_weights[pair_rows])
+        added = base_errors[pair_rows] - added_errors > ADD_PENALTY
+        added_rows = rows[pair_rows[added]]
+
+        # Candidates which are not added leave the base fit, it goes through the removal once per sample
+        problems = np.concatenate([rows, added_rows])
+        layer_exposures, layer_errors = remove_signatures(
+            signatures, gram, counts[problems],
+            round_to_totals(normalize(np.concatenate([base_weights, added_weights[added]]), totals[problems]),
+                            totals[problems]),
+            np.concatenate([base_errors, added_errors[added]]), kept_indices,
+            REMOVE_PENALTY)
+
+        # The first candidate (in signature order) with the lowest error wins the layer
+        choices = np.where(candidates, np.arange(len(rows))[:, np.newaxis], -1)
+        choices[pair_rows[added], pair_signatures[added]] = len(rows) + np.arange(len(added_rows))
+        candidate_errors = np.where(choices >= 0, layer_errors[choices], np.inf)
+        best = candidate_errors.argmin(axis=1)
+        best_choices = choices[np.arange(len(rows)), best]
+        improved = candidate_errors[np.arange(len(rows)), best] < best_errors[rows]
+
+        improved_rows = rows[improved]
+        exposures[improved_rows] = layer_exposures[best_choices[improved]]
+        best_errors[improved_rows] = layer_errors[best_choices[improved]]
+        selected[improved_rows] = exposures[improved_rows] > 0
+        running[rows[~improved]] = False
+
+    return round_conserve_sum(exposures)
+
+def fit_exposures(signatures, counts, context_type='SBS'):
+    '''
+    Fit all samples (columns of counts) to signatures (dataframe) in chunks of FIT_CHUNK_SAMPLES samples and return
+    exposures (signatures x samples) adding up to the samples' mutation counts. Samples without mutations are skipped
+    '''
+    names = list(signatures.columns)
+    signatures = signatures.to_numpy(dtype=float)
+    gram = signatures.T @ signatures
+
+    # cosmic_fit never removes the background SBS signatures and adds connected SBS signatures together
+    kept = [names.index(name) for name in BACKGROUND_SIGNATURES if name in names and context_type == 'SBS']
+    groups = [np.isin(names, group) for group in CONNECTED_SIGNATURES] if context_type == 'SBS' else []
+
+    exposures = np.zeros((len(names), counts.shape[1]))
+    samples = np.flatnonzero(counts.sum(axis=0) > 0)
+    for start in range(0, len(samples), FIT_CHUNK_SAMPLES):
+        chunk = samples[start:start + FIT_CHUNK_SAMPLES]
+        exposures[:, chunk] = fit_chunk(signatures, gram, counts[:, chunk].T, np.array(kept, dtype=int), groups).T
+    return exposures
+
+def bootstrap_intervals(signatures, counts, exposures, replicates, seed_sequences, confidence=0.95):
+    '''
+    Confidence intervals of exposures (signatures x samples) from multinomial resamples of each sample's counts,
+    refitted on the signatures assigned to the sample. Returns lower and upper bound arrays shaped like exposures
+    '''
+    lower, upper = np.zeros(exposures.shape), np.zeros(exposures.shape)
+    alpha = (1 - confidence) / 2
+    for i, seed_sequence in enumerate(seed_sequences):
+        total = counts[:, i].sum()
+        active = np.flatnonzero(exposures[:, i] > 0)
+        if total == 0 or len(active) == 0:
+            continue
+
+        # Resample and refit all replicates at once, least squares is the NNLS solution when it has no negative exposure.
+        # Replicates with a negative exposure are solved together by NNLS, starting from their clipped least squares
+        resampled = np.random.default_rng(seed_sequence).multinomial(int(total), counts[:, i] / total, size=replicates)
+        active_signatures = signatures[:, active]
+        fitted = np.linalg.lstsq(active_signatures, resampled.T, rcond=None)[0].T
+        negative = (fitted < 0).any(axis=1)
+        if negative.any():
+            fitted[negative] = batched_nnls(active_signatures.T @ active_signatures, resampled[negative] @ active_signatures,
+                                            np.ones((negative.sum(), len(active)), dtype=bool), np.maximum(fitted[negative], 0))
+
+        fitted = normalize(fitted, np.full(replicates, total))
+        lower[active, i], upper[active, i] = np.quantile(fitted, [alpha, 1 - alpha], axis=0)
+
+    return lower, upper
+
+def sample_stats(counts, reconstructed, samples):
+    '''Reconstruction statistics per sample in the SigProfilerAssignment Samples_Stats format'''
+    def norm(values):
+        return np.linalg.norm(values, axis=0)
+
+    l1_norm = np.abs(counts - reconstructed).sum(axis=0).round(3)
+    l2_norm = norm(counts - reconstructed).round(3)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosine = np.nan_to_num((counts * reconstructed).sum(axis=0) / (norm(counts) * norm(reconstructed)))
+        p = counts / counts.sum(axis=0)
+        q = reconstructed / reconstructed.sum(axis=0)
+        kl_divergence = np.where(p > 0, p * np.log(p / q), 0).sum(axis=0)
+        centered_counts = counts - counts.mean(axis=0)
+        centered_reconstructed = reconstructed - reconstructed.mean(axis=0)
+        correlation = ((centered_counts * centered_reconstructed).sum(axis=0)
+                       / (norm(centered_counts) * norm(centered_reconstructed)))
+
+    return pd.DataFrame({
+        'Sample Names': samples,
+        'Total Mutations': counts.sum(axis=0).astype(int),
+        'Cosine Similarity': cosine.round(3),
+        'L1 Norm': l1_norm,
+        'L1_Norm_%': [f'{value}%' for value in (l1_norm / counts.sum(axis=0) * 100).round(3)],
+        'L2 Norm': l2_norm,
+        'L2_Norm_%': [f'{value}%' for value in (l2_norm / norm(counts) * 100).round(3)],
+        'KL Divergence': np.where(np.isinf(kl_divergence), 1000, kl_divergence).round(5),
+        'Correlation': correlation.round(3)
+    })
+
+def decomposed_probabilities(signatures, exposures, samples, mutation_types):
+    '''Probability of each signature generating each mutation type per sample (Decomposed_MutationType_Probabilities)'''
+    # (samples, mutation types, signatures) contributions normalized over signatures
+    contributions = signatures.to_numpy()[np.newaxis, :, :] * exposures.T[:, np.newaxis, :]
+    totals = contributions.sum(axis=2, keepdims=True)
+    probabilities = np.divide(contributions, totals, out=np.zeros_like(contributions), where=totals > 0)
+
+    table = pd.DataFrame(probabilities.reshape(-1, signatures.shape[1]), columns=signatures.columns)
+    table.insert(0, 'MutationType', np.tile(mutation_types, len(samples)))
+    table.insert(0, 'Sample Names', np.repeat(samples, len(mutation_types)))
+    return table
+
+def native_fit(samples, output, context_type, database=None, gen_ex=False, exclude=None):
+    '''
+    Assign reference signatures to samples (matrix path or dataframe) by an NNLS approximation of cosmic_fit
+    and write the SigProfilerAssignment Assignment_Solution tables into output
+    '''
+    matrix = samples if isinstance(samples, pd.DataFrame) else pd.read_csv(samples, sep='\t', index_col=0)
+
+    # Samples without mutations have no assignment records
+    matrix = matrix.loc[:, matrix.sum().to_numpy() > 0]
+    signatures = load_signatures(matrix.index, context_type, database, gen_ex, exclude)
+    counts = matrix.to_numpy(dtype=float)
+
+    exposures = fit_exposures(signatures, counts, context_type)
+    reconstructed = signatures.to_numpy() @ exposures
+
+    solution_dir = os.path.join(output, 'Assignment_Solution')
+    for subdir in ['Activities', 'Signatures', 'Solution_Stats']:
+        os.makedirs(os.path.join(solution_dir, subdir), exist_ok=True)
+
+    activities = pd.DataFrame(exposures.T.astype(int), index=pd.Index(matrix.columns, name='Samples'),
+                              columns=signatures.columns)
+    activities.to_csv(os.path.join(solution_dir, 'Activities', 'Assignment_Solution_Activities.txt'), sep='\t')
+    # Written in chunks of samples so that memory does not grow with the cohort
+    decomposed_path = os.path.join(solution_dir, 'Activities', 'Decomposed_MutationType_Probabilities.txt')
+    for start in range(0, max(matrix.shape[1], 1), DECOMPOSED_CHUNK_SAMPLES):
+        chunk = slice(start, start + DECOMPOSED_CHUNK_SAMPLES)
+        decomposed_probabilities(signatures, exposures[:, chunk], matrix.columns[chunk], matrix.index).to_csv(
+            decomposed_path, sep='\t', index=False, mode='w' if start == 0 else 'a', header=start == 0)
+    signatures.rename_axis('MutationType').to_csv(
+        os.path.join(solution_dir, 'Signatures', 'Assignment_Solution_Signatures.txt'), sep='\t')
+    sample_stats(counts, reconstructed, matrix.columns).to_csv(
+        os.path.join(solution_dir, 'Solution_Stats', 'Assignment_Solution_Samples_Stats.txt'), sep='\t', index=False)
+
+    # Assigned signatures per sample take the place of the stepwise assignment log
+    with open(os.path.join(solution_dir, 'Solution_Stats', 'Assignment_Solution_Signature_Assignment_log.txt'), 'w') as log:
+        for sample, sample_activities in activities.iterrows():
+            assigned = sample_activities[sample_activities > 0]
+            log.write(f"{sample}\t{', '.join(f'{name}:{count}' for name, count in assigned.items())}\n")
+
+    return activities
@@ -0,0 +1,312 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime
+from importlib import metadata
+
+# Plots are only saved, never displayed
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+# Pipeline modules live next to this folder
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+for stage_dir in ['data', 'assign', 'visualization']:
+    sys.path.insert(0, os.path.join(REPO_DIR, stage_dir))
+from instrumentation import children_peak_rss_mb, peak_rss_mb
+from synthetic_cohort import generate_cohort, write_cohort, write_stub_reference
+
+# Pipeline stages in order, with the stages whose outputs they read
+STAGES = {
+    'filter': [],
+    'vcf': ['filter'],
+    'matrices': ['filter'],
+    'assignment': ['matrices'],
+    'visualization': ['assignment']
+}
+DEFAULT_SIZES = [10, 100, 1000, 20000]
+
+# Output of every stage (key of stage_paths) whose files are counted
+STAGE_OUTPUTS = {
+    'filter': 'filtered',
+    'vcf': 'vcf',
+    'matrices': 'matrices',
+    'assignment': 'output',
+    'visualization': 'plots'
+}
+
+# Packages whose versions are recorded with the results
+PACKAGES = ['numpy', 'pandas', 'pyarrow', 'scipy', 'matplotlib', 'seaborn', 'SigProfilerAssignment',
+            'SigProfilerMatrixGenerator']
+
+# Relative slowdown (or memory growth) over the baseline reported as a regression, ignoring changes below
+# MIN_REGRESSION_SECONDS and MIN_REGRESSION_MB
+REGRESSION_TOLERANCE = 0.25
+MIN_REGRESSION_SECONDS = 0.1
+MIN_REGRESSION_MB = 20
+
+
+def stage_paths(cohort_dir: str) -> dict[str, str]:
+    '''Files and folders of a cohort's benchmark run.'''
+    return {
+        'database': os.path.join(cohort_dir, 'mutations.parquet.gzip'),
+        'reference': os.path.join(os.path.dirname(cohort_dir), 'reference'),
+        'filtered': os.path.join(cohort_dir, 'filtered.parquet'),
+        'vcf': os.path.join(cohort_dir, 'VCF'),
+        'matrices': os.path.join(cohort_dir, 'mutational_matrices'),
+        'output': os.path.join(cohort_dir, 'output', 'MutSigMA.SBS96'),
+        'plots': os.path.join(cohort_dir, 'plots')
+    }
+
+
+def run_stage(stage: str, cohort_dir: str, options: dict) -> float:
+    '''Run a pipeline stage on the cohort in cohort_dir and return its wall time (reading inputs is not timed).'''
+    import pandas as pd
+    paths = stage_paths(cohort_dir)
+
+    if stage == 'filter':
+        from utils import filter_database
+        start = time.perf_counter()
+        data = filter_database(database_filepath=paths['database'])
+        elapsed = time.perf_counter() - start
+        data.to_parquet(paths['filtered'])
+
+    elif stage == 'vcf':
+        from utils import extract_vcf
+        data = pd.read_parquet(paths['filtered'])
+        shutil.rmtree(paths['vcf'], ignore_errors=True)
+        start = time.perf_counter()
+        extract_vcf(data, workers=options['workers'], output_dir=paths['vcf'])
+        elapsed = time.perf_counter() - start
+
+    elif stage == 'matrices':
+        from matrices import generate_native_matrices
+        data = pd.read_parquet(paths['filtered'])
+        start = time.perf_counter()
+        generate_native_matrices(data, paths['matrices'], reference_dir=paths['reference'])
+        elapsed = time.perf_counter() - start
+
+    elif stage == 'assignment':
+        from assigner import assign_matrix
+        from matrices import load_matrix
+        matrix = load_matrix(paths['matrices'], 'SBS96')
+        shutil.rmtree(paths['output'], ignore_errors=True)
+        start = time.perf_counter()
+        assign_matrix(matrix, paths['output'], 'SBS', cache_dir=None, shards=options['workers'],
+                      engine=options['assignment_engine'], minimal_output=options['minimal_output'])
+        elapsed = time.perf_counter() - start
+
+    else:
+        from visualizer import find_input_file, load_data, visualize
+        shutil.rmtree(paths['plots'], ignore_errors=True)
+        start = time.perf_counter()
+        input_file, dataset_name = find_input_file(paths['output'])
+        visualize(load_data(input_file), dataset_name, output=paths['plots'], all_plots=True, jobs=options['workers'])
+        elapsed = time.perf_counter() - start
+
+    return elapsed
+
+
+def output_size(path: str) -> tuple[int, int]:
+    '''Number of files and total bytes under path (a file or a folder).'''
+    if os.path.isfile(path):
+        return 1, os.path.getsize(path)
+
+    n_files, n_bytes = 0, 0
+    for folder, _, files in os.walk(path):
+        n_files += len(files)
+        n_bytes += sum(os.path.getsize(os.path.join(folder, file)) for file in files)
+    return n_files, n_bytes
+
+
+def measure_stage(stage: str, cohort_dir: str, options: dict) -> dict:
+    '''Run a stage in this (fresh) process with its output logged to a file, return wall time, peak RSS and output size.'''
+    with open(os.path.join(cohort_dir, f'{stage}.log'), 'w') as log, redirect_stdout(log), redirect_stderr(log):
+        seconds = run_stage(stage, cohort_dir, options)
+
+    # Worker pools of the stage (VCF export, assignment shards, plots) are reported separately
+    children_rss = children_peak_rss_mb()
+    output_files, output_bytes = output_size(stage_paths(cohort_dir)[STAGE_OUTPUTS[stage]])
+    return {
+        'seconds': round(seconds, 4),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'children_peak_rss_mb': round(children_rss, 1),
+        'output_files': output_files,
+        'output_kb': round(output_bytes / 1024, 1)
+    }
+
+
+def required_stages(selected: list[str]) -> list[str]:
+    '''Selected stages together with the stages producing their inputs, in pipeline order.'''
+    required = set()
+    pending = list(selected)
+    while pending:
+        stage = pending.pop()
+        if stage not in required:
+            required.add(stage)
+            pending.extend(STAGES[stage])
+    return [stage for stage in STAGES if stage in required]
+
+
+def benchmark_cohort(n_patients: int, work_dir: str, sequences: dict, options: dict) -> list[dict]:
+    '''Generate a cohort of n_patients and time the selected stages, each in a fresh spawned process.'''
+    cohort_dir = os.path.join(work_dir, f'patients_{n_patients}')
+    os.makedirs(cohort_dir, exist_ok=True)
+    cohort = generate_cohort(n_patients, sequences, options['mutations_per_patient'], options['seed'])
+    write_cohort(cohort, stage_paths(cohort_dir)['database'])
+    print(f'\n{n_patients} patients, {len(cohort)} mutations')
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for stage in required_stages(options['stages']):
+        runs = []
+        try:
+            for _ in range(options['repeat'] if stage in options['stages'] else 1):
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    runs.append(executor.submit(measure_stage, stage, cohort_dir, options).result())
+        except Exception as error:
+            # A killed stage process (eg. out of memory) fails this stage and the stages reading its outputs
+            message = 'stage process died (out of memory?)' if isinstance(error, BrokenProcessPool) else repr(error)
+            print(f'  {stage:<14} failed: {message}')
+            results.append({'patients': n_patients, 'mutations': len(cohort), 'stage': stage, 'error': message})
+            break
+        if stage not in options['stages']:
+            continue
+
+        result = {
+            'patients': n_patients,
+            'mutations': len(cohort),
+            'stage': stage,
+            'seconds': min(run['seconds'] for run in runs),
+            'runs': [run['seconds'] for run in runs],
+            'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+            'children_peak_rss_mb': max(run['children_peak_rss_mb'] for run in runs),
+            'output_files': runs[-1]['output_files'],
+            'output_kb': runs[-1]['output_kb']
+        }
+        results.append(result)
+        print(f"  {stage:<14} {result['seconds']:>9.3f} s  {result['peak_rss_mb']:>8.1f} MB  "
+              f"{result['output_files']:>6} files {result['output_kb']:>10.1f} kB")
+
+    return results
+
+
+def environment() -> dict:
+    '''Interpreter, machine, package versions and commit the benchmark ran with.'''
+    versions = {}
+    for package in PACKAGES:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'packages': versions,
+        'commit': commit or None
+    }
+
+
+def compare_results(results: list[dict], baseline_filepath: str, tolerance: float = REGRESSION_TOLERANCE) -> bool:
+    '''Print current results against a baseline results file, return True if any stage regressed.'''
+    with open(baseline_filepath) as f:
+        baseline = {(result['patients'], result['stage']): result for result in json.load(f)['results']}
+
+    print(f'\nComparison with {baseline_filepath}:')
+    regressed = False
+    for result in results:
+        previous = baseline.get((result['patients'], result['stage']))
+        if previous is None:
+            continue
+        if 'error' in result or 'error' in previous:
+            regressed |= 'error' in result and 'error' not in previous
+            print(f"  {result['patients']:>6} {result['stage']:<14} {previous.get('error', 'ok')} -> {result.get('error', 'ok')}")
+            continue
+        slower = (result['seconds'] > previous['seconds'] * (1 + tolerance)
+                  and result['seconds'] - previous['seconds'] > MIN_REGRESSION_SECONDS)
+        larger = (result['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + tolerance)
+                  and result['peak_rss_mb'] - previous['peak_rss_mb'] > MIN_REGRESSION_MB)
+        regressed |= slower or larger
+        print(f"  {result['patients']:>6} {result['stage']:<14} "
+              f"{previous['seconds']:>9.3f} -> {result['seconds']:>9.3f} s ({result['seconds'] / max(previous['seconds'], 1e-9):.2f}x)  "
+              f"{previous['peak_rss_mb']:>8.1f} -> {result['peak_rss_mb']:>8.1f} MB"
+              f"{'  REGRESSION' if slower or larger else ''}")
+
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='run_benchmarks.py',
+        description='Time MutSigMA pipeline stages on synthetic TCGA-like cohorts (offline, stub reference genome).'
+    )
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help=f'Cohort sizes in patients (default: {" ".join(map(str, DEFAULT_SIZES))})')
+    parser.add_argument('-m', '--mutations-per-patient', type=int, default=100,
+                        help='Median number of mutations per patient (default: 100)')
+    parser.add_argument('-t', '--stages', nargs='+', choices=list(STAGES), default=list(STAGES),
+                        help='Stages to time (default: all)')
+    parser.add_argument('-A', '--assignment-engine', choices=['sigprofiler', 'native'], default='native',
+                        help='Signature fitting engine (default: native)')
+    parser.add_argument('--minimal-output', action='store_true',
+                        help='Assign with --minimal_output (a single parquet table instead of the output tree and plots)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Worker processes of the VCF export, assignment shards and plots (default: 1)')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Runs of every stage, the fastest is reported (default: 1)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic cohorts (default: 0)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Results JSON file (default: benchmarks/results/benchmark_<date>_<time>.json)')
+    parser.add_argument('-c', '--compare', default=None,
+                        help='Baseline results JSON file, exit with status 1 if any stage regressed')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help=f'Relative slowdown or memory growth reported as a regression (default: {REGRESSION_TOLERANCE})')
+    parser.add_argument('--work-dir', default=None,
+                        help='Directory for cohorts and stage outputs, kept after the run (default: temporary directory)')
+    args = parser.parse_args()
+
+    options = {
+        'mutations_per_patient': args.mutations_per_patient,
+        'stages': args.stages,
+        'assignment_engine': args.assignment_engine,
+        'minimal_output': args.minimal_output,
+        'workers': args.workers,
+        'repeat': args.repeat,
+        'seed': args.seed
+    }
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='mutsigma_benchmark_')
+    try:
+        sequences = write_stub_reference(os.path.join(work_dir, 'reference'), seed=args.seed)
+        results = []
+        for n_patients in args.sizes:
+            results.extend(benchmark_cohort(n_patients, work_dir, sequences, options))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(REPO_DIR, 'benchmarks', 'results',
+                                         f'benchmark_{datetime.now():%Y%m%d_%H%M%S}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'environment': environment(),
+                   'options': {**options, 'sizes': args.sizes}, 'results': results}, f, indent=2)
+    print(f'\nBenchmark results saved: {output}')
+
+    if args.compare and compare_results(results, args.compare, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,198 @@
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Pipeline modules live next to this folder
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'data'))
+sys.path.insert(0, os.path.join(REPO_DIR, 'assign'))
+from matrices import BASES, SBS_SUBSTITUTIONS
+from native_fit import read_signatures, reference_signatures_path
+
+# Projects with their primary site and the SBS signatures their patients are simulated from
+PROJECTS = {
+    'TCGA-BRCA': ('Breast', ['SBS1', 'SBS2', 'SBS3', 'SBS5', 'SBS13']),
+    'TCGA-LUAD': ('Bronchus and lung', ['SBS1', 'SBS2', 'SBS4', 'SBS5', 'SBS13', 'SBS40a']),
+    'TCGA-SKCM': ('Skin', ['SBS1', 'SBS5', 'SBS7a', 'SBS7b', 'SBS38']),
+    'TCGA-COAD': ('Colon', ['SBS1', 'SBS5', 'SBS6', 'SBS10a', 'SBS15', 'SBS44']),
+    'TCGA-STAD': ('Stomach', ['SBS1', 'SBS5', 'SBS17a', 'SBS17b', 'SBS18']),
+    'TCGA-LIHC': ('Liver and intrahepatic bile ducts', ['SBS1', 'SBS5', 'SBS12', 'SBS16', 'SBS22a']),
+    'TCGA-BLCA': ('Bladder', ['SBS1', 'SBS2', 'SBS5', 'SBS13']),
+    'TCGA-UCEC': ('Corpus uteri', ['SBS1', 'SBS5', 'SBS10a', 'SBS10b', 'SBS14', 'SBS44']),
+    'TCGA-GBM': ('Brain', ['SBS1', 'SBS5', 'SBS11', 'SBS40a']),
+    'TCGA-OV': ('Ovary', ['SBS1', 'SBS3', 'SBS5', 'SBS40a'])
+}
+
+# Stub reference genome: one-line sequence files of random bases
+CHROMOSOMES = [str(c) for c in range(1, 23)] + ['X', 'Y']
+REFERENCE_LENGTH = 200_000
+
+# Mutation mix and mutation count distribution (log-normal, clipped)
+DBS_FRACTION = 0.03
+INDEL_FRACTION = 0.07
+MUTATIONS_SIGMA = 1.2
+MUTATIONS_RANGE = (5, 5000)
+
+COMPLEMENT = np.array([3, 2, 1, 0])
+BASE_LETTERS = np.array(list(BASES))
+
+
+def write_stub_reference(reference_dir: str, length: int = REFERENCE_LENGTH, seed: int = 0) -> dict[str, np.ndarray]:
+    '''Write random one-line chromosome files readable by the native matrix engine, return their base codes.'''
+    rng = np.random.default_rng(seed)
+    os.makedirs(reference_dir, exist_ok=True)
+
+    sequences = {}
+    for chromosome in CHROMOSOMES:
+        sequences[chromosome] = rng.integers(0, 4, length).astype(np.uint8)
+        with open(os.path.join(reference_dir, f'{chromosome}.txt'), 'wb') as f:
+            f.write(BASE_LETTERS[sequences[chromosome]].astype('S1').tobytes())
+
+    return sequences
+
+
+def context_positions(genome: np.ndarray, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Group positions of the concatenated genome by pyrimidine-strand trinucleotide context
+    (left * 8 + (center == T) * 4 + right), skipping the first and last base of every chromosome.
+
+    Returns genome indices sorted by context and the start offset of every context.
+    '''
+    index = np.arange(1, len(genome) - 1)
+    index = index[~np.isin(index, np.r_[offsets[1:-1] - 1, offsets[1:-1]])]
+    left, center, right = genome[index - 1], genome[index], genome[index + 1]
+    purine = (center == 0) | (center == 2)
+    pyrimidine_left = np.where(purine, COMPLEMENT[right], left).astype(np.int64)
+    pyrimidine_right = np.where(purine, COMPLEMENT[left], right).astype(np.int64)
+    contexts = pyrimidine_left * 8 + (np.where(purine, COMPLEMENT[center], center) == 3) * 4 + pyrimidine_right
+
+    order = np.argsort(contexts, kind='stable')
+    return index[order], np.searchsorted(contexts[order], np.arange(33))
+
+
+def simulate_sbs(type_codes: np.ndarray, sequences: dict[str, np.ndarray], rng: np.random.Generator) \
+        -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''Place SBS96 mutation types at random reference positions with a matching context (chromosome, position, ref, alt).'''
+    genome = np.concatenate(list(sequences.values()))
+    offsets = np.cumsum([0] + [len(sequence) for sequence in sequences.values()])
+    positions, starts = context_positions(genome, offsets)
+
+    left, substitution, right = type_codes // 24, (type_codes // 4) % 6, type_codes % 4
+    contexts = left * 8 + (substitution >= 3) * 4 + right
+    picks = positions[starts[contexts] + (rng.random(len(type_codes)) *
+                                          (starts[contexts + 1] - starts[contexts])).astype(np.int64)]
+    chromosomes = np.searchsorted(offsets, picks, side='right') - 1
+    reference = genome[picks]
+    alt = np.array([BASES.index(s[2]) for s in SBS_SUBSTITUTIONS])[substitution]
+
+    # Mutations at purine reference bases are reported on the other strand
+    purine = (reference == 0) | (reference == 2)
+    alt = np.where(purine, COMPLEMENT[alt], alt)
+    return chromosomes, picks - offsets[chromosomes] + 1, BASE_LETTERS[reference], BASE_LETTERS[alt]
+
+
+def random_alleles(sequences: dict[str, np.ndarray], kind: str, n: int, rng: np.random.Generator) \
+        -> tuple[np.ndarray, np.ndarray, list[str], list[str]]:
+    '''Random doublet substitutions ('dbs') or MAF-style indels ('indel') of 1-5 bases matching the reference.'''
+    chromosomes = rng.integers(0, len(CHROMOSOMES), n)
+    pos = rng.integers(10, REFERENCE_LENGTH - 10, n)
+    lengths = np.full(n, 2) if kind == 'dbs' else rng.choice([1, 1, 1, 2, 2, 3, 4, 5], n)
+    deletion = rng.random(n) < 0.6
+
+    ref, alt = [], []
+    for c, p, length, is_deletion in zip(chromosomes, pos, lengths, deletion):
+        bases = sequences[CHROMOSOMES[c]][p:p + length]
+        if kind == 'dbs':
+            ref.append(''.join(BASE_LETTERS[bases]))
+            alt.append(''.join(BASE_LETTERS[(bases + rng.integers(1, 4, 2)) % 4]))
+        elif is_deletion:
+            ref.append(''.join(BASE_LETTERS[bases]))
+            alt.append('-')
+        else:
+            ref.append('-')
+            alt.append(''.join(BASE_LETTERS[rng.integers(0, 4, length)]))
+
+    return chromosomes, pos + 1, ref, alt
+
+
+def generate_cohort(n_patients: int, sequences: dict[str, np.ndarray], mutations_per_patient: int = 100,
+                    seed: int = 0) -> pd.DataFrame:
+    '''
+    Simulate a TCGA-like mutations table of n_patients spread across PROJECTS.
+
+    Mutation counts per patient are log-normal around mutations_per_patient. SBS mutations follow a mix of
+    2-4 of the project's COSMIC signatures, doublets and indels are placed at random reference positions.
+    '''
+    rng = np.random.default_rng(seed)
+    cosmic = read_signatures(reference_signatures_path(96))
+    project_names = list(PROJECTS)
+
+    patient_projects = rng.integers(0, len(PROJECTS), n_patients)
+    barcodes = np.array([f'TCGA-{i // 10000:02d}-{i % 10000:04d}' for i in range(n_patients)])
+    n_mutations = np.clip(rng.lognormal(np.log(mutations_per_patient), MUTATIONS_SIGMA, n_patients),
+                          *MUTATIONS_RANGE).astype(np.int64)
+    n_dbs = rng.binomial(n_mutations, DBS_FRACTION)
+    n_indels = rng.binomial(n_mutations - n_dbs, INDEL_FRACTION / (1 - DBS_FRACTION))
+    n_sbs = n_mutations - n_dbs - n_indels
+
+    # Per-patient SBS96 spectra from a Dirichlet mix of signatures active in the project
+    spectra = np.empty((n_patients, 96))
+    for i, project in enumerate(patient_projects):
+        signatures = PROJECTS[project_names[project]][1]
+        active = rng.choice(signatures, rng.integers(2, min(4, len(signatures)) + 1), replace=False)
+        spectra[i] = cosmic[active].to_numpy() @ rng.dirichlet(np.ones(len(active)))
+    counts = rng.multinomial(n_sbs, spectra / spectra.sum(axis=1, keepdims=True))
+    type_codes = np.repeat(np.tile(np.arange(96), n_patients), counts.ravel())
+
+    parts = [(np.repeat(np.arange(n_patients), n_sbs), *simulate_sbs(type_codes, sequences, rng)),
+             (np.repeat(np.arange(n_patients), n_dbs), *random_alleles(sequences, 'dbs', n_dbs.sum(), rng)),
+             (np.repeat(np.arange(n_patients), n_indels), *random_alleles(sequences, 'indel', n_indels.sum(), rng))]
+    patients = np.concatenate([part[0] for part in parts])
+    chromosomes = np.concatenate([part[1] for part in parts])
+
+    data = pd.DataFrame({
+        'project_short_name': np.array(project_names)[patient_projects[patients]],
+        'case_barcode': barcodes[patients],
+        'primary_site': np.array([PROJECTS[p][0] for p in project_names])[patient_projects[patients]],
+        'Chromosome': np.char.add('chr', np.array(CHROMOSOMES)[chromosomes]),
+        'Start_Position': np.concatenate([part[2] for part in parts]),
+        'Reference_Allele': np.concatenate([np.asarray(part[3], dtype=object) for part in parts]),
+        'Tumor_Seq_Allele2': np.concatenate([np.asarray(part[4], dtype=object) for part in parts]),
+        # Unused columns, as in the real database
+        'Hugo_Symbol': 'SYNTHETIC',
+        'Variant_Classification': 'Missense_Mutation'
+    })
+
+    # The real database is ordered by project and patient
+    return data.sort_values(['project_short_name', 'case_barcode', 'Chromosome', 'Start_Position'], kind='stable',
+                            ignore_index=True)
+
+
+def write_cohort(data: pd.DataFrame, database_filepath: str, row_group_size: int = 100_000):
+    '''Save a mutations table like data/mutations.parquet.gzip.'''
+    os.makedirs(os.path.dirname(database_filepath) or '.', exist_ok=True)
+    data.to_parquet(database_filepath, compression='gzip', index=False, row_group_size=row_group_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='synthetic_cohort.py',
+        description='Generate a synthetic TCGA-like mutations database and a stub reference genome.'
+    )
+    parser.add_argument('-n', '--patients', type=int, default=100, help='Number of patients (default: 100)')
+    parser.add_argument('-m', '--mutations-per-patient', type=int, default=100,
+                        help='Median number of mutations per patient (default: 100)')
+    parser.add_argument('-o', '--database-filepath', default='benchmarks/cohort/mutations.parquet.gzip',
+                        help='Output mutations database (default: benchmarks/cohort/mutations.parquet.gzip)')
+    parser.add_argument('-g', '--reference-dir', default='benchmarks/cohort/reference',
+                        help='Output stub reference genome directory (default: benchmarks/cohort/reference)')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed (default: 0)')
+    args = parser.parse_args()
+
+    sequences = write_stub_reference(args.reference_dir, seed=args.seed)
+    cohort = generate_cohort(args.patients, sequences, args.mutations_per_patient, args.seed)
+    write_cohort(cohort, args.database_filepath)
+    print(f'Synthetic cohort of {args.patients} patients ({len(cohort)} mutations) saved in {args.database_filepath}, '
+          f'stub reference genome in {args.reference_dir}')
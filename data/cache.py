@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import shutil
+
+# Default cache size limit
+CACHE_SIZE_MB = 1024
+
+
+def database_fingerprint(database_filepath: str) -> list[tuple[str, int, int]]:
+    '''Fingerprint a database file or partitioned database directory by file paths, sizes and modification times.'''
+    if os.path.isfile(database_filepath):
+        file_stat = os.stat(database_filepath)
+        return [(os.path.abspath(database_filepath), file_stat.st_size, file_stat.st_mtime_ns)]
+
+    fingerprint = []
+    for root, _, files in os.walk(database_filepath):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            file_stat = os.stat(file_path)
+            fingerprint.append((os.path.relpath(file_path, database_filepath), file_stat.st_size, file_stat.st_mtime_ns))
+
+    return sorted(fingerprint)
+
+
+def cache_key(**key_parts) -> str:
+    '''Hash JSON-serializable key parts into a cache key.'''
+    key_json = json.dumps(key_parts, sort_keys=True, default=str)
+    return hashlib.sha256(key_json.encode()).hexdigest()
+
+
+def lookup_cache_entry(cache_dir: str, key: str) -> str | None:
+    '''Return the cache entry directory for key (marking it as recently used), or None on a miss.'''
+    entry_dir = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry_dir):
+        return None
+
+    os.utime(entry_dir)
+    return entry_dir
+
+
+def store_cache_entry(cache_dir: str, key: str, write_entry, max_size_mb: float = CACHE_SIZE_MB) -> str:
+    '''
+    Store a new cache entry and evict least recently used entries over max_size_mb.
+
+    write_entry - function writing the entry files into the directory it is given
+    '''
+    entry_dir = os.path.join(cache_dir, key)
+    staging_dir = f'{entry_dir}.tmp{os.getpid()}'
+
+    # Write into a staging directory first so interrupted runs never leave a partial entry
+    os.makedirs(staging_dir)
+    try:
+        write_entry(staging_dir)
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.rename(staging_dir, entry_dir)
+    finally:
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)
+
+    evict_cache_entries(cache_dir, max_size_mb, keep=key)
+    return entry_dir
+
+
+def directory_size(path: str) -> int:
+    '''Return total size of files under path in bytes.'''
+    return sum(os.path.getsize(os.path.join(root, file_name))
+               for root, _, files in os.walk(path) for file_name in files)
+
+
+def evict_cache_entries(cache_dir: str, max_size_mb: float = CACHE_SIZE_MB, keep: str | None = None):
+    '''Remove least recently used cache entries until the cache fits in max_size_mb.'''
+    entries = sorted((entry for entry in os.scandir(cache_dir) if entry.is_dir() and '.tmp' not in entry.name),
+                     key=lambda entry: entry.stat().st_mtime_ns)
+    entry_sizes = {entry.name: directory_size(entry.path) for entry in entries}
+    cache_size = sum(entry_sizes.values())
+
+    for entry in entries:
+        if cache_size <= max_size_mb * 1024 ** 2:
+            break
+        if entry.name == keep:
+            continue
+        shutil.rmtree(entry.path, ignore_errors=True)
+        cache_size -= entry_sizes[entry.name]
@@ -11,16 +11,65 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--request-filepath',
                         default='data/request_file.txt',
                         help='Path to the request file of specified format')
+    parser.add_argument('-R', '--requests',
+                        default=None,
+                        help='Directory of request files, or a manifest file listing their paths, built in one database scan '
+                             '(one cohort per request file, matrices saved in data/mutational_matrices/<cohort>)')
     parser.add_argument('-d', '--database-filepath',
                         default='data/mutations.parquet.gzip',
                         help='Path to the mutations database')
+    parser.add_argument('-e', '--engine',
+                        choices=['sigprofiler', 'native'],
+                        default='sigprofiler',
+                        help='Matrix generation engine (native: in-memory SBS96, DBS78 and ID83 only)')
+    parser.add_argument('-g', '--reference-dir',
+                        default=None,
+                        help='Reference chromosomes directory for the native engine (default: SigProfilerMatrixGenerator GRCh38 install)')
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes writing VCF files, or building cohorts\' native matrices with --requests (default: 1)')
+    parser.add_argument('-n', '--no-cache',
+                        action='store_true',
+                        help='Regenerate mutational matrices without reading or updating the cache')
+    parser.add_argument('--cache-dir',
+                        default='data/cache/matrices',
+                        help='Mutational matrices cache directory (default: data/cache/matrices)')
+    parser.add_argument('--cache-size',
+                        type=float,
+                        default=1024,
+                        help='Maximum cache size in MB, least recently used matrices are evicted first (default: 1024)')
+    parser.add_argument('-c', '--chunk-rows',
+                        type=int,
+                        default=0,
+                        help='Stream the selected records in chunks of this many rows instead of loading them at once (default: 0, disabled)')
+    parser.add_argument('--run-log',
+                        default=None,
+                        help='Append wall time, CPU time, peak memory, rows and files written of every stage to this JSON-lines file')
+    parser.add_argument('--profile',
+                        nargs='+',
+                        default=None,
+                        metavar='STAGE',
+                        help='Profile these stages (filter, vcf, matrices, cache, or all) into <run log>.<stage>.<pid>.<n>.prof files')
     args = parser.parse_args()
+    if args.profile and not args.run_log:
+        parser.error('--profile requires --run-log')
+    if args.requests and args.chunk_rows:
+        parser.error('--chunk-rows is not supported with --requests')
 
 
 import os
 import shutil
-from utils import filter_database, extract_vcf
-from SigProfilerMatrixGenerator.scripts import SigProfilerMatrixGeneratorFunc as matGen
+import pandas as pd
+from collections.abc import Iterable, Iterator
+from contextlib import nullcontext
+from multiprocessing import Pool
+from utils import (NO_RECORDS_MESSAGE, filter_database, filter_database_requests, extract_vcf, iter_filtered_batches,
+                   iter_patient_chunks, stream_vcf)
+from matrices import (NATIVE_CONTEXTS, generate_native_matrices, load_matrix, matrix_filepath, save_all_matrices,
+                      stream_native_matrices)
+from cache import cache_key, database_fingerprint, lookup_cache_entry, store_cache_entry
+from instrumentation import configure_run_log, stage
 
 def parse_request_file(request_filepath: str) -> dict[str: list[str]|None]:
     '''Parse user-created request file into parameter dictionary.'''
@@ -47,45 +96,277 @@ def parse_request_file(request_filepath: str) -> dict[str: list[str]|None]:
     return parameters_parsed
 
 
-def main(request_filepath: str, database_filepath: str):
+def find_request_files(requests_path: str) -> list[str]:
+    '''Return the request files of a batch: files of a directory, or paths listed in a manifest file (relative to it).'''
+    if os.path.isdir(requests_path):
+        request_filepaths = [os.path.join(requests_path, f) for f in sorted(os.listdir(requests_path))
+                             if os.path.isfile(os.path.join(requests_path, f)) and not f.startswith('.')]
+    else:
+        with open(requests_path, 'r') as f:
+            request_filepaths = [os.path.join(os.path.dirname(requests_path), line.strip()) for line in f
+                                 if line.strip() and not line.startswith('#')]
+
+    assert request_filepaths, f'There are no request files in {requests_path}.'
+    return request_filepaths
+
+
+def cohort_name(request_filepath: str) -> str:
+    '''Name of a batch cohort: its request file name without extension, eg. TCGA-BRCA for requests/TCGA-BRCA.txt.'''
+    return os.path.splitext(os.path.basename(request_filepath))[0]
+
+
+def matrices_cache_key(request_parameters: dict, database: list, engine: str, reference_dir: str | None,
+                       project: str = 'MutSigMA') -> str:
+    '''Cache key of a request's matrices (database fingerprint), matrices named after a batch cohort are cached apart.'''
+    key_parts = {
+        'request': request_parameters,
+        'database': database,
+        'genome_build': 'GRCh38',
+        'engine': engine,
+        'reference_dir': os.path.abspath(reference_dir) if reference_dir else None
+    }
+    if project != 'MutSigMA':
+        key_parts['project'] = project
+    return cache_key(**key_parts)
+
+
+def count_rows(chunks: Iterable[pd.DataFrame], record: dict) -> Iterator[pd.DataFrame]:
+    '''Pass streamed chunks through, adding their records to the rows_in of a stage record.'''
+    record['rows_in'] = 0
+    for chunk in chunks:
+        record['rows_in'] += len(chunk)
+        yield chunk
+
+
+def main(request_filepath: str, database_filepath: str, engine: str = 'sigprofiler', reference_dir: str | None = None,
+         workers: int = 1, contexts: list[str] | None = None, save_matrices: bool = True, no_cache: bool = False,
+         cache_dir: str = 'data/cache/matrices', cache_size: float = 1024, chunk_rows: int = 0,
+         run_log: str | None = None, profile: list[str] | None = None) -> dict[str, pd.DataFrame]:
     '''
     Create a custom mutational database for further mutational signature extraction.
         
     Arguments:
     request_filepath - path to the request file of specified format (README)
     mutations_filepath - path to the mutations database (default='data/mutations.parquet.gzip')
+    engine - matrix generation engine, 'sigprofiler' (VCF files + SigProfilerMatrixGenerator) or 'native'
+    reference_dir - reference chromosomes directory for the native engine
+    workers - number of worker processes writing VCF files
+    contexts - matrix contexts to return, eg. ['SBS96'] (native engine default: SBS96, DBS78 and ID83)
+    save_matrices - save matrices into 'data/mutational_matrices'
+    no_cache - regenerate matrices without reading or updating the cache
+    cache_dir - mutational matrices cache directory
+    cache_size - maximum cache size in MB
+    chunk_rows - stream the selected records in chunks of at most this many rows (0 loads them at once)
+    run_log - JSON-lines file the measurements of every stage are appended to
+    profile - stages profiled into cProfile files next to the run log ('all' for every stage)
+
+    Returns requested mutational matrices as a {context: dataframe} dictionary.
     '''
+    if run_log:
+        configure_run_log(run_log, profile)
+
     # Parse requested parameters
     request_parameters = parse_request_file(request_filepath)
-    request_parameters['database_filepath'] = database_filepath
+    matrix_dir = 'data/mutational_matrices'
+    if engine == 'native':
+        contexts = contexts or NATIVE_CONTEXTS
+
+    # Delete previous output directory if exists
+    if os.path.exists(matrix_dir):
+        shutil.rmtree(matrix_dir)
+
+    # Reuse cached matrices of the same request and database
+    key = matrices_cache_key(request_parameters, database_fingerprint(database_filepath), engine, reference_dir)
+    cached_dir = None if no_cache else lookup_cache_entry(cache_dir, key)
+    if cached_dir and all(os.path.exists(matrix_filepath(cached_dir, context)) for context in contexts or []):
+        print('Using cached mutational matrices...')
+        with stage('cache', outputs=[matrix_dir]) as record:
+            if save_matrices:
+                shutil.copytree(cached_dir, matrix_dir)
+            matrices = {context: load_matrix(cached_dir, context) for context in contexts or []}
+            record['rows_out'] = max((matrix.shape[1] for matrix in matrices.values()), default=0)
+        return matrices
+
+    # Filter database based on requested parameters, or stream the matching records in chunks
+    if chunk_rows:
+        data = None
+        batches = iter_filtered_batches(**request_parameters, database_filepath=database_filepath, chunk_rows=chunk_rows)
+    else:
+        with stage('filter') as record:
+            data = filter_database(**request_parameters, database_filepath=database_filepath)
+            record['rows_out'] = len(data)
+
+    # Build matrices in memory, skipping the VCF round-trip
+    if engine == 'native':
+        print('Generating mutational matrices...')
+        with stage('matrices', rows_in=None if data is None else len(data), outputs=[matrix_dir]) as record:
+            if data is None:
+                # Per-patient counts are added up chunk by chunk
+                matrices = stream_native_matrices(count_rows(iter_patient_chunks(batches), record),
+                                                  matrix_dir if save_matrices else None,
+                                                  reference_dir=reference_dir, contexts=contexts)
+            else:
+                matrices = generate_native_matrices(data, matrix_dir if save_matrices else None,
+                                                    reference_dir=reference_dir, contexts=contexts)
+            record['rows_out'] = max((matrix.shape[1] for matrix in matrices.values()), default=0)
+        if not no_cache:
+            with stage('cache', outputs=[cache_dir]):
+                store_cache_entry(cache_dir, key, lambda entry_dir: save_all_matrices(matrices, entry_dir), cache_size)
+        print('Mutational matrix extraction complete!')
+        return matrices
+
+    from SigProfilerMatrixGenerator.scripts import SigProfilerMatrixGeneratorFunc as matGen
 
-    # Filter database based on requested parameters
-    data = filter_database(**request_parameters)
-    
     # VCF extraction
-    extract_vcf(data)
+    with stage('vcf', rows_in=None if data is None else len(data), outputs=['data/VCF']) as record:
+        if data is None:
+            # Each chunk's records are appended to the patients' VCF files
+            record['rows_out'] = stream_vcf(count_rows(batches, record), workers=workers)
+        else:
+            extract_vcf(data, workers=workers)
+            record['rows_out'] = data['case_barcode'].nunique()
+        rows = record['rows_in']
 
     # Generate mutational matrices
-    matrices = matGen.SigProfilerMatrixGeneratorFunc("MutSigMA",
-                                                     "GRCh38",
-                                                     "data/VCF")
+    with stage('matrices', rows_in=rows, outputs=['data/VCF']) as record:
+        matrices = matGen.SigProfilerMatrixGeneratorFunc("MutSigMA",
+                                                         "GRCh38",
+                                                         "data/VCF")
+        record['rows_out'] = max((matrix.shape[1] for matrix in matrices.values()), default=0)
     
     # VCF cleanup - OPTIONAL
     # Move output mutational matrices to 'data/'
     print('Cleaning up output matrices...')
+    shutil.move('data/VCF/output', matrix_dir)
+    if not no_cache:
+        with stage('cache', outputs=[cache_dir]):
+            store_cache_entry(cache_dir, key, lambda entry_dir: shutil.copytree(matrix_dir, entry_dir, dirs_exist_ok=True),
+                              cache_size)
 
-    # Delete previous output directory if exists
+    # Remove VCF files
+    shutil.rmtree('data/VCF')
+    print('Mutational matrix extraction complete!')
+
+    return {context: load_matrix(matrix_dir, context) for context in contexts or []}
+
+
+def generate_cohort_matrices(task: tuple) -> tuple[str, dict[str, pd.DataFrame]]:
+    '''Build the native matrices of a batch cohort, saved into its directory unless it is None (pool task).'''
+    cohort, data, cohort_dir, reference_dir, contexts = task
+    with stage('matrices', rows_in=len(data), outputs=[cohort_dir] if cohort_dir else []) as record:
+        cohort_matrices = generate_native_matrices(data, cohort_dir, reference_dir=reference_dir, contexts=contexts,
+                                                   project=cohort)
+        record.update(cohort=cohort, rows_out=max((matrix.shape[1] for matrix in cohort_matrices.values()), default=0))
+    return cohort, cohort_matrices
+
+
+def main_batch(request_filepaths: list[str], database_filepath: str, engine: str = 'sigprofiler',
+               reference_dir: str | None = None, workers: int = 1, contexts: list[str] | None = None,
+               save_matrices: bool = True, no_cache: bool = False, cache_dir: str = 'data/cache/matrices',
+               cache_size: float = 1024, run_log: str | None = None,
+               profile: list[str] | None = None) -> dict[str, dict[str, pd.DataFrame]]:
+    '''
+    Create the mutational matrices of several requests (cohorts) with a single scan of the database.
+
+    Arguments are those of main, except:
+    request_filepaths - paths to the request files, one per cohort named after the file (eg. TCGA-BRCA for TCGA-BRCA.txt)
+    workers - number of worker processes writing VCF files, or building the native matrices of cohorts in parallel
+
+    Each cohort's matrices are saved into 'data/mutational_matrices/<cohort>' and named after the cohort
+    (eg. SBS/TCGA-BRCA.SBS96.all). Streaming is not supported, the records of all requests are read at once.
+
+    Returns requested mutational matrices as a {cohort: {context: dataframe}} dictionary,
+    cohorts without matching records are left out.
+    '''
+    if run_log:
+        configure_run_log(run_log, profile)
+
+    # Parse requested parameters
+    cohorts = {cohort_name(request_filepath): parse_request_file(request_filepath) for request_filepath in request_filepaths}
+    assert len(cohorts) == len(request_filepaths), 'Request files of a batch need distinct names.'
     matrix_dir = 'data/mutational_matrices'
+    if engine == 'native':
+        contexts = contexts or NATIVE_CONTEXTS
 
+    # Delete previous output directory if exists
     if os.path.exists(matrix_dir):
         shutil.rmtree(matrix_dir)
-    
-    shutil.move('data/VCF/output', matrix_dir)
 
-    # Remove VCF files
-    shutil.rmtree('data/VCF')
-    print('Mutational matrix extraction complete!')
+    # Reuse cached matrices, the other cohorts are filtered together
+    database = database_fingerprint(database_filepath)
+    matrices, keys = {}, {}
+    for cohort, request_parameters in cohorts.items():
+        key = matrices_cache_key(request_parameters, database, engine, reference_dir, cohort)
+        cached_dir = None if no_cache else lookup_cache_entry(cache_dir, key)
+        if cached_dir and all(os.path.exists(matrix_filepath(cached_dir, context, cohort)) for context in contexts or []):
+            print(f'{cohort}: using cached mutational matrices...')
+            with stage('cache', outputs=[os.path.join(matrix_dir, cohort)]) as record:
+                if save_matrices:
+                    shutil.copytree(cached_dir, os.path.join(matrix_dir, cohort))
+                matrices[cohort] = {context: load_matrix(cached_dir, context, cohort) for context in contexts or []}
+                record.update(cohort=cohort, rows_out=max((m.shape[1] for m in matrices[cohort].values()), default=0))
+        else:
+            keys[cohort] = key
+    if not keys:
+        return matrices
+
+    # Filter database based on requested parameters of all cohorts at once
+    with stage('filter') as record:
+        selections = filter_database_requests([cohorts[cohort] for cohort in keys], database_filepath)
+        record['rows_out'] = sum(len(data) for data in selections if data is not None)
 
+    cohort_data = {}
+    for cohort, data in zip(keys, selections):
+        if data is None:
+            print(f'{cohort}: {NO_RECORDS_MESSAGE} Skipping the cohort.')
+        else:
+            cohort_data[cohort] = data
+
+    # Build matrices in memory, skipping the VCF round-trip, cohorts are built in parallel by the workers
+    if engine == 'native':
+        print('Generating mutational matrices...')
+        tasks = [(cohort, data, os.path.join(matrix_dir, cohort) if save_matrices else None, reference_dir, contexts)
+                 for cohort, data in cohort_data.items()]
+        with Pool(min(workers, len(tasks))) if workers > 1 and len(tasks) > 1 else nullcontext() as pool:
+            for cohort, cohort_matrices in (pool.imap(generate_cohort_matrices, tasks) if pool
+                                            else map(generate_cohort_matrices, tasks)):
+                if not no_cache:
+                    with stage('cache', outputs=[cache_dir]):
+                        store_cache_entry(cache_dir, keys[cohort],
+                                          lambda entry_dir: save_all_matrices(cohort_matrices, entry_dir, cohort), cache_size)
+                matrices[cohort] = cohort_matrices
+        print('Mutational matrix extraction complete!')
+        return matrices
+
+    from SigProfilerMatrixGenerator.scripts import SigProfilerMatrixGeneratorFunc as matGen
+
+    for cohort, data in cohort_data.items():
+        cohort_dir = os.path.join(matrix_dir, cohort)
+        print(f'{cohort}: generating mutational matrices...')
+
+        # VCF extraction and matrix generation in the cohort's own VCF directory
+        vcf_dir = os.path.join('data/VCF', cohort)
+        with stage('vcf', rows_in=len(data), outputs=[vcf_dir]) as record:
+            extract_vcf(data, workers=workers, output_dir=vcf_dir)
+            record.update(cohort=cohort, rows_out=data['case_barcode'].nunique())
+        with stage('matrices', rows_in=len(data), outputs=[vcf_dir]) as record:
+            generated = matGen.SigProfilerMatrixGeneratorFunc(cohort, "GRCh38", vcf_dir)
+            record.update(cohort=cohort, rows_out=max((matrix.shape[1] for matrix in generated.values()), default=0))
+        shutil.move(os.path.join(vcf_dir, 'output'), cohort_dir)
+        if not no_cache:
+            with stage('cache', outputs=[cache_dir]):
+                store_cache_entry(cache_dir, keys[cohort],
+                                  lambda entry_dir: shutil.copytree(cohort_dir, entry_dir, dirs_exist_ok=True), cache_size)
+        shutil.rmtree(vcf_dir)
+        matrices[cohort] = {context: load_matrix(cohort_dir, context, cohort) for context in contexts or []}
+
+    print('Mutational matrix extraction complete!')
+    return matrices
 
 if __name__ == '__main__':
-    main(**vars(args))
+    requests = vars(args).pop('requests')
+    if requests:
+        del args.request_filepath, args.chunk_rows
+        main_batch(find_request_files(requests), **vars(args))
+    else:
+        main(**vars(args))
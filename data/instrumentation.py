@@ -0,0 +1,179 @@
+import cProfile
+import itertools
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Run log settings are kept in the environment so pool workers and stage subprocesses log into the same file
+RUN_LOG_ENV = 'MUTSIGMA_RUN_LOG'
+PROFILE_ENV = 'MUTSIGMA_PROFILE'
+RUN_ID_ENV = 'MUTSIGMA_RUN_ID'
+
+# Stages of each thread of this process that are still running, innermost last
+_thread_stages = threading.local()
+
+# Running stages of all threads, the peak memory is only reset when no other thread measures it,
+# and a single profiler can be active at a time
+_open_stage_count = 0
+_profiling = False
+_open_stage_lock = threading.Lock()
+
+# Numbers profiles of repeated stages in this process
+_profile_numbers = itertools.count(1)
+
+
+def configure_run_log(run_log: str | None = None, profile: list[str] | None = None):
+    '''
+    Log stages of this process and the processes it starts as JSON lines into run_log,
+    profiling the stages named in profile ('all' for every stage) into <run_log>.<stage>.<pid>.<n>.prof files.
+    '''
+    if run_log:
+        os.makedirs(os.path.dirname(os.path.abspath(run_log)), exist_ok=True)
+        os.environ[RUN_LOG_ENV] = os.path.abspath(run_log)
+    if profile:
+        os.environ[PROFILE_ENV] = ','.join(profile)
+    # Stages of one pipeline run share its id, set by the first configured process
+    os.environ.setdefault(RUN_ID_ENV, uuid.uuid4().hex[:12])
+
+
+def peak_rss_mb() -> float:
+    '''Peak resident memory of this process in MB (VmHWM, unlike ru_maxrss it does not carry over from the parent).'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def children_peak_rss_mb() -> float:
+    '''Largest peak resident memory of the finished child processes in MB.'''
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def reset_peak_rss():
+    '''Reset the peak resident memory of this process to its current size (Linux only, ignored elsewhere).'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def files_written(paths: list[str], since_ns: int) -> tuple[int, int]:
+    '''Count files under paths (files or directories) modified since since_ns, return their number and total size.'''
+    count, size = 0, 0
+    for path in paths:
+        if os.path.isfile(path):
+            file_paths = [path]
+        else:
+            file_paths = (os.path.join(root, file_name) for root, _, files in os.walk(path) for file_name in files)
+        for file_path in file_paths:
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                continue
+            if file_stat.st_mtime_ns >= since_ns:
+                count += 1
+                size += file_stat.st_size
+    return count, size
+
+
+def write_run_log_record(record: dict):
+    '''Append a record to the run log as one JSON line (single write, so concurrent processes do not interleave).'''
+    with open(os.environ[RUN_LOG_ENV], 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+@contextmanager
+def stage(name: str, rows_in: int | None = None, outputs: list[str] | None = None):
+    '''
+    Measure a pipeline stage and append it to the run log (no-op unless configure_run_log was called).
+
+    Records wall and CPU time, peak memory of this process and of child processes finished during the stage,
+    rows in and out and the number and size of files written under outputs. Yields the record dictionary,
+    so the stage can set 'rows_out' or other fields.
+    '''
+    global _open_stage_count, _profiling
+    record = {'rows_in': rows_in, 'rows_out': None}
+    if RUN_LOG_ENV not in os.environ:
+        yield record
+        return
+
+    if not hasattr(_thread_stages, 'stack'):
+        _thread_stages.stack = []
+    _open_stages = _thread_stages.stack
+
+    profile_stages = os.environ.get(PROFILE_ENV, '').split(',')
+    profiler = None
+
+    with _open_stage_lock:
+        # Enclosing profiled stages include the inner ones
+        if (name in profile_stages or 'all' in profile_stages) and not _profiling:
+            profiler = cProfile.Profile()
+            _profiling = True
+        # Peak memory of an enclosing stage is kept over the reset, stages running in other threads share the process peak
+        if _open_stages:
+            _open_stages[-1]['peak'] = max(_open_stages[-1]['peak'], peak_rss_mb())
+        if _open_stage_count == len(_open_stages):
+            reset_peak_rss()
+        _open_stage_count += 1
+        _open_stages.append({'peak': 0.0})
+
+    started = datetime.now(timezone.utc)
+    start_ns, start_wall, start_times = time.time_ns(), time.perf_counter(), os.times()
+    start_children_rss = children_peak_rss_mb()
+    status = 'ok'
+    try:
+        if profiler:
+            profiler.enable()
+        yield record
+    except BaseException as e:
+        status = f'error: {type(e).__name__}: {e}'
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            _profiling = False
+        wall_seconds = time.perf_counter() - start_wall
+        end_times = os.times()
+        with _open_stage_lock:
+            _open_stage_count -= 1
+            peak = max(_open_stages.pop()['peak'], peak_rss_mb())
+            if _open_stages:
+                _open_stages[-1]['peak'] = max(_open_stages[-1]['peak'], peak)
+        children_rss = children_peak_rss_mb()
+        n_files, n_bytes = files_written(outputs or [], start_ns)
+
+        record = {
+            'run_id': os.environ.get(RUN_ID_ENV),
+            'script': os.path.basename(sys.argv[0]),
+            'stage': name,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'started': started.isoformat(timespec='milliseconds'),
+            'status': status,
+            'wall_seconds': round(wall_seconds, 4),
+            'cpu_seconds': round(sum(end_times[:2]) - sum(start_times[:2]), 4),
+            'children_cpu_seconds': round(sum(end_times[2:4]) - sum(start_times[2:4]), 4),
+            'peak_rss_mb': round(peak, 1),
+            # Only known when a finished child process set a new maximum
+            'children_peak_rss_mb': round(children_rss, 1) if children_rss > start_children_rss else None,
+            **record,
+            'files_written': n_files,
+            'bytes_written': n_bytes
+        }
+        if profiler:
+            record['profile'] = f'{os.environ[RUN_LOG_ENV]}.{name}.{os.getpid()}.{next(_profile_numbers)}.prof'
+            profiler.dump_stats(record['profile'])
+        write_run_log_record(record)
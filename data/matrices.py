@@ -0,0 +1,478 @@
+import os
+from collections.abc import Iterable
+import numpy as np
+import pandas as pd
+from utils import convert_to_vcf
+
+# Contexts supported by the native matrix engine
+NATIVE_CONTEXTS = ['SBS96', 'DBS78', 'ID83']
+
+# Base codes: A=0, C=1, G=2, T=3, N=4 (reference) and 5 (anything else in an allele, never matches)
+BASES = 'ACGT'
+N_CODE = 4
+
+# Reference bytes -> base codes. Bytes 0-19 follow the SigProfilerMatrixGenerator transcriptional
+# strand encoding (base = byte % 4, 16-19 = N), letters cover plain one-line sequence files.
+REFERENCE_CODES = np.full(256, N_CODE, dtype=np.uint8)
+REFERENCE_CODES[:16] = np.arange(16) % 4
+for code, base in enumerate(BASES):
+    REFERENCE_CODES[ord(base)] = REFERENCE_CODES[ord(base.lower())] = code
+
+ALLELE_CODES = np.full(256, 5, dtype=np.uint8)
+for code, base in enumerate(BASES):
+    ALLELE_CODES[ord(base)] = code
+
+# Mutation types in the order of the SigProfilerMatrixGenerator output files
+SBS_SUBSTITUTIONS = ['C>A', 'C>G', 'C>T', 'T>A', 'T>C', 'T>G']
+SBS96_TYPES = [f'{left}[{sub}]{right}' for left in BASES for sub in SBS_SUBSTITUTIONS for right in BASES]
+
+DBS78_TYPES = [
+    'AC>CA', 'AC>CG', 'AC>CT', 'AC>GA', 'AC>GG', 'AC>GT', 'AC>TA', 'AC>TG', 'AC>TT',
+    'AT>CA', 'AT>CC', 'AT>CG', 'AT>GA', 'AT>GC', 'AT>TA',
+    'CC>AA', 'CC>AG', 'CC>AT', 'CC>GA', 'CC>GG', 'CC>GT', 'CC>TA', 'CC>TG', 'CC>TT',
+    'CG>AT', 'CG>GC', 'CG>GT', 'CG>TA', 'CG>TC', 'CG>TT',
+    'CT>AA', 'CT>AC', 'CT>AG', 'CT>GA', 'CT>GC', 'CT>GG', 'CT>TA', 'CT>TC', 'CT>TG',
+    'GC>AA', 'GC>AG', 'GC>AT', 'GC>CA', 'GC>CG', 'GC>TA',
+    'TA>AT', 'TA>CG', 'TA>CT', 'TA>GC', 'TA>GG', 'TA>GT',
+    'TC>AA', 'TC>AG', 'TC>AT', 'TC>CA', 'TC>CG', 'TC>CT', 'TC>GA', 'TC>GG', 'TC>GT',
+    'TG>AA', 'TG>AC', 'TG>AT', 'TG>CA', 'TG>CC', 'TG>CT', 'TG>GA', 'TG>GC', 'TG>GT',
+    'TT>AA', 'TT>AC', 'TT>AG', 'TT>CA', 'TT>CC', 'TT>CG', 'TT>GA', 'TT>GC', 'TT>GG'
+]
+
+ID83_TYPES = (
+    [f'1:{indel}:{base}:{repeats}' for indel in ('Del', 'Ins') for base in 'CT' for repeats in range(6)]
+    + [f'{length}:{indel}:R:{repeats}' for indel in ('Del', 'Ins') for length in range(2, 6) for repeats in range(6)]
+    + [f'{length}:Del:M:{homology}' for length in range(2, 6) for homology in range(1, length if length < 5 else 6)]
+)
+
+
+def reverse_complement(sequence: str) -> str:
+    '''Reverse complement of a DNA sequence.'''
+    return sequence[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+
+
+def _dbs78_lookup() -> np.ndarray:
+    '''Map (ref dinucleotide, alt dinucleotide) codes to DBS78 row indices (-1 if not a doublet).'''
+    lookup = np.full(256, -1, dtype=np.int64)
+    type_index = {mutation_type: i for i, mutation_type in enumerate(DBS78_TYPES)}
+
+    for ref in (a + b for a in BASES for b in BASES):
+        for alt in (a + b for a in BASES for b in BASES):
+            if ref[0] == alt[0] or ref[1] == alt[1]:
+                continue
+            mutation_type = f'{ref}>{alt}'
+            if mutation_type not in type_index:
+                mutation_type = f'{reverse_complement(ref)}>{reverse_complement(alt)}'
+            code = (BASES.index(ref[0]) * 4 + BASES.index(ref[1])) * 16 + BASES.index(alt[0]) * 4 + BASES.index(alt[1])
+            lookup[code] = type_index[mutation_type]
+
+    return lookup
+
+
+DBS78_LOOKUP = _dbs78_lookup()
+
+
+class ReferenceGenome:
+    '''
+    Memory-mapped reference genome stored as one file per chromosome ('<chromosome>.txt', one byte per base).
+
+    Works with the chromosome files installed by SigProfilerMatrixGenerator and with plain
+    one-line sequence files (e.g. small stubs for tests).
+    '''
+    def __init__(self, reference_dir: str):
+        self.reference_dir = reference_dir
+        self._chromosomes = {}
+
+    def __contains__(self, chromosome: str) -> bool:
+        return os.path.isfile(os.path.join(self.reference_dir, f'{chromosome}.txt'))
+
+    def chromosome(self, chromosome: str) -> np.ndarray:
+        '''Raw bytes of a chromosome (memory-mapped, loaded lazily).'''
+        if chromosome not in self._chromosomes:
+            self._chromosomes[chromosome] = np.memmap(os.path.join(self.reference_dir, f'{chromosome}.txt'),
+                                                      dtype=np.uint8, mode='r')
+        return self._chromosomes[chromosome]
+
+    def bases(self, chromosome: str, indices: np.ndarray) -> np.ndarray:
+        '''Base codes at 0-based indices (negative indices count from the chromosome end, out of range is N).'''
+        sequence = self.chromosome(chromosome)
+        indices = np.asarray(indices, dtype=np.int64)
+        inside = (indices < len(sequence)) & (indices >= -len(sequence))
+        codes = np.full(indices.shape, N_CODE, dtype=np.uint8)
+        codes[inside] = REFERENCE_CODES[sequence[indices[inside]]]
+        return codes
+
+
+def default_reference_dir(genome_build: str = 'GRCh38') -> str:
+    '''Chromosome directory of a reference genome installed with SigProfilerMatrixGenerator.'''
+    from SigProfilerMatrixGenerator.scripts import ref_install
+    return str(ref_install.reference_dir().get_tsb_dir() / genome_build)
+
+
+def encode_alleles(alleles: pd.Series, length: int) -> np.ndarray:
+    '''Encode equal-length allele strings into a (mutations x length) base code array.'''
+    buffer = ''.join(alleles).encode('ascii', errors='replace')
+    return ALLELE_CODES[np.frombuffer(buffer, dtype=np.uint8).reshape(len(alleles), length)]
+
+
+def normalize_chromosomes(chromosomes: pd.Series) -> pd.Series:
+    '''Convert VCF chromosome names into reference file names (SigProfilerMatrixGenerator rules).'''
+    chromosomes = chromosomes.astype(str)
+    chromosomes = chromosomes.where(chromosomes.str.len() <= 2, chromosomes.str[3:])
+    return chromosomes.where(~chromosomes.isin(['M', 'm', 'mt']), 'MT')
+
+
+def split_mutations(data: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    '''
+    Split mutations into single base substitutions (doublets split into two SNVs) and indels.
+
+    Invalid substitutions and consecutive duplicate records of a patient are dropped,
+    the same way VCF files are read by SigProfilerMatrixGenerator.
+    '''
+    vcf = convert_to_vcf(data)
+    records = pd.DataFrame({
+        'sample': vcf['ID'].astype(str),
+        'chrom': vcf['Chromosome'].astype(str),
+        'pos': vcf['Position'].astype(np.int64),
+        'ref': vcf['Ref'].astype(str),
+        'alt': vcf['Alt'].astype(str)
+    })
+
+    ref_length = records['ref'].str.len()
+    alt_length = records['alt'].str.len()
+    single = (ref_length == 1) & (alt_length == 1) & (records['ref'] != '-') & (records['alt'] != '-')
+    double = ((ref_length == 2) & (alt_length == 2)
+              & ~records['ref'].str.contains('-', regex=False) & ~records['alt'].str.contains('-', regex=False))
+
+    # Substitutions need A/C/G/T bases which differ between ref and alt
+    valid = records['ref'].str.fullmatch('[ACGT]+') & records['alt'].str.fullmatch('[ACGT]+')
+    valid &= (records['ref'].str[0] != records['alt'].str[0]) & (records['ref'].str[-1] != records['alt'].str[-1])
+    records = records.loc[~(single | double) | valid]
+    substitution = (single | double).loc[records.index]
+
+    # Drop substitutions repeating the previous record of the same patient
+    previous = records.groupby('sample', sort=False).shift(1)
+    duplicate = substitution & (records[['chrom', 'pos', 'ref', 'alt']] == previous).all(axis=1)
+    records = records.loc[~duplicate]
+    substitution = substitution.loc[records.index]
+
+    records = records.assign(chrom=normalize_chromosomes(records['chrom']))
+    substitutions = records.loc[substitution]
+    indels = records.loc[~substitution]
+
+    # Doublets are split into two adjacent single base substitutions
+    doublets = substitutions['ref'].str.len() == 2
+    first = substitutions.assign(ref=substitutions['ref'].str[0], alt=substitutions['alt'].str[0])
+    second = substitutions.loc[doublets]
+    second = second.assign(pos=second['pos'] + 1, ref=second['ref'].str[1], alt=second['alt'].str[1])
+    snvs = pd.concat([first, second]).sort_index(kind='stable')
+
+    return snvs.reset_index(drop=True), indels.reset_index(drop=True)
+
+
+def count_matrix(sample_codes: np.ndarray, type_codes: np.ndarray, samples: list[str],
+                 mutation_types: list[str]) -> pd.DataFrame:
+    '''Count mutations per type and sample into a mutational matrix.'''
+    counts = np.bincount(sample_codes * len(mutation_types) + type_codes,
+                         minlength=len(samples) * len(mutation_types))
+    counts = counts.reshape(len(samples), len(mutation_types)).T.astype(np.int64)
+    return pd.DataFrame(counts, index=pd.Index(mutation_types, name='MutationType'), columns=samples)
+
+
+def build_sbs96(snvs: pd.DataFrame, reference: ReferenceGenome, samples: list[str]) -> pd.DataFrame:
+    '''Build the SBS96 matrix from single base substitutions.'''
+    sample_index = {sample: i for i, sample in enumerate(samples)}
+    sample_codes, type_codes = [], []
+
+    for chrom, group in snvs.groupby('chrom', sort=False):
+        if chrom not in reference:
+            continue
+        pos = group['pos'].to_numpy()
+        ref = encode_alleles(group['ref'], 1)[:, 0]
+        alt = encode_alleles(group['alt'], 1)[:, 0]
+
+        # Pentanucleotide around the mutation, it has to be in range, without N and match the ref base
+        in_range = (pos >= 3) & (pos + 1 < len(reference.chromosome(chrom)))
+        context = reference.bases(chrom, np.where(in_range, pos, 3)[:, None] + np.arange(-3, 2))
+        keep = in_range & (context < N_CODE).all(axis=1) & (context[:, 2] == ref)
+
+        # Report mutations on the pyrimidine strand
+        purine = (ref == 0) | (ref == 2)
+        left = np.where(purine, 3 - context[:, 3], context[:, 1]).astype(np.int64)
+        right = np.where(purine, 3 - context[:, 1], context[:, 3]).astype(np.int64)
+        ref = np.where(purine, 3 - ref, ref)
+        alt = np.where(purine, 3 - alt, alt)
+        substitution = np.where(ref == 1, 0, 3) + alt - (alt > ref)
+
+        sample_codes.append(group['sample'].map(sample_index).to_numpy()[keep])
+        type_codes.append((left * 24 + substitution * 4 + right)[keep])
+
+    return count_matrix(np.concatenate(sample_codes or [np.empty(0, np.int64)]).astype(np.int64),
+                        np.concatenate(type_codes or [np.empty(0, np.int64)]).astype(np.int64),
+                        samples, SBS96_TYPES)
+
+
+def find_doublets(sample_codes: np.ndarray, pos: np.ndarray) -> np.ndarray:
+    '''
+    Find doublet base substitutions in (sample, position) sorted SNVs.
+
+    Returns indices of the first SNV of every doublet. Adjacent SNVs which are part of
+    longer multi-nucleotide clusters (within 5 bp) are excluded.
+    '''
+    distance = np.diff(pos)
+    dinuc = np.flatnonzero(distance == 1)
+    mnv = np.flatnonzero((distance > 0) & (distance <= 5))
+
+    if len(mnv) > 1:
+        consecutive_next = np.append(mnv[1:] == mnv[:-1] + 1, False)
+        consecutive_previous = np.insert(mnv[:-1] == mnv[1:] - 1, 0, False)
+        same_next = np.append(sample_codes[mnv[1:]] == sample_codes[mnv[:-1]], False)
+        same_previous = np.insert(sample_codes[mnv[:-1]] == sample_codes[mnv[1:]], 0, False)
+        in_mnv = np.where(consecutive_next, same_next,
+                          np.where(consecutive_previous, same_previous, distance[mnv] != 1))
+        dinuc = np.setdiff1d(dinuc, mnv[in_mnv])
+
+    return dinuc[sample_codes[dinuc] == sample_codes[dinuc + 1]]
+
+
+def build_dbs78(snvs: pd.DataFrame, reference: ReferenceGenome, samples: list[str]) -> pd.DataFrame:
+    '''Build the DBS78 matrix from adjacent single base substitutions of the same sample.'''
+    sample_index = {sample: i for i, sample in enumerate(samples)}
+    sample_codes, type_codes = [], []
+
+    for chrom, group in snvs.groupby('chrom', sort=False):
+        if chrom not in reference:
+            continue
+        codes = group['sample'].map(sample_index).to_numpy()
+        pos = group['pos'].to_numpy()
+        order = np.lexsort((pos, codes))
+        codes, pos = codes[order], pos[order]
+        ref = encode_alleles(group['ref'], 1)[order, 0].astype(np.int64)
+        alt = encode_alleles(group['alt'], 1)[order, 0].astype(np.int64)
+
+        first = find_doublets(codes, pos)
+
+        # Flanking bases have to be in range and without N
+        start = pos[first]
+        in_range = start + 1 < len(reference.chromosome(chrom))
+        flanks = reference.bases(chrom, np.where(in_range, start, 2)[:, None] + np.array([-2, 1]))
+        keep = in_range & (flanks < N_CODE).all(axis=1)
+
+        dinuc = (ref[first] * 4 + ref[first + 1]) * 16 + alt[first] * 4 + alt[first + 1]
+        sample_codes.append(codes[first][keep])
+        type_codes.append(DBS78_LOOKUP[dinuc[keep]])
+
+    return count_matrix(np.concatenate(sample_codes or [np.empty(0, np.int64)]).astype(np.int64),
+                        np.concatenate(type_codes or [np.empty(0, np.int64)]).astype(np.int64),
+                        samples, DBS78_TYPES)
+
+
+def matching_units(reference: ReferenceGenome, chrom: str, start: np.ndarray, units: np.ndarray) -> np.ndarray:
+    '''Check which reference windows starting at 0-based start equal their repeat unit.'''
+    window = reference.bases(chrom, start[:, None] + np.arange(units.shape[1]))
+    return (window == units).all(axis=1)
+
+
+def count_repeats(reference: ReferenceGenome, chrom: str, start: np.ndarray, units: np.ndarray,
+                  right_start: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Count repeat units adjacent to indels of one unit length.
+
+    Returns repeats to the left of start, repeats from right_start onwards and a mask
+    of indels whose right flank runs out of the chromosome.
+    '''
+    n = units.shape[1]
+    length = len(reference.chromosome(chrom))
+
+    # Repeats to the left
+    left = np.zeros(len(start), dtype=np.int64)
+    pos = start.copy()
+    active = pos - n > 0
+    while active.any():
+        rows = np.flatnonzero(active)
+        match = matching_units(reference, chrom, pos[rows] - n, units[rows])
+        active[rows] = match
+        left[rows[match]] += 1
+        pos[rows[match]] -= n
+        active &= pos - n > 0
+
+    # Repeats to the right
+    right = np.zeros(len(start), dtype=np.int64)
+    pos = right_start.copy()
+    out_of_range = pos + n > length
+    active = ~out_of_range
+    while active.any():
+        rows = np.flatnonzero(active & (pos + n < length))
+        match = matching_units(reference, chrom, pos[rows], units[rows])
+        active[:] = False
+        rows = rows[match]
+        right[rows] += 1
+        pos[rows] += n
+        out_of_range[rows] |= pos[rows] + n > length
+        active[rows] = ~out_of_range[rows]
+
+    return left, right, out_of_range
+
+
+def build_id83(indels: pd.DataFrame, reference: ReferenceGenome, samples: list[str]) -> pd.DataFrame:
+    '''Build the ID83 matrix classifying indels by length, repeat units and microhomology.'''
+    sample_index = {sample: i for i, sample in enumerate(samples)}
+    sample_codes, type_codes = [], []
+
+    # Insertions and deletions in the MAF format get a placeholder anchor base
+    ref = indels['ref'].str.upper()
+    alt = indels['alt'].str.upper()
+    alt = alt.where(ref != '-', '-' + alt)
+    ref = ref.where(alt != '-', '-' + ref)
+    indels = indels.assign(ref=ref, alt=alt)
+    indels = indels.loc[ref.str.fullmatch('[ACGT-]*') & alt.str.fullmatch('[ACGT-]*') & (ref != alt)]
+
+    for chrom, group in indels.groupby('chrom', sort=False):
+        if chrom not in reference:
+            continue
+        codes = group['sample'].map(sample_index).to_numpy()
+        order = np.lexsort((group['pos'].to_numpy(), codes))
+        group, codes = group.iloc[order], codes[order]
+
+        # Drop consecutive duplicates and indels which do not match the reference
+        duplicate = (group[['sample', 'pos', 'ref', 'alt']] == group[['sample', 'pos', 'ref', 'alt']].shift(1)).all(axis=1)
+        pos = group['pos'].to_numpy()
+        in_range = pos - 1 < len(reference.chromosome(chrom))
+        base = reference.bases(chrom, np.where(in_range, pos - 1, 0))
+        anchor = encode_alleles(group['ref'].str[0], 1)[:, 0]
+        matching = (group['ref'].str[0] == '-').to_numpy() | (anchor == base)
+        deletion = (group['alt'].str.len() == 1).to_numpy()
+        insertion = ~deletion & (group['ref'].str.len() == 1).to_numpy()
+        keep = ~duplicate.to_numpy() & in_range & matching & (deletion | insertion)
+
+        group, codes, deletion = group.loc[keep], codes[keep], deletion[keep]
+        units = group['ref'].str[1:].where(deletion, group['alt'].str[1:])
+        unit_length = units.str.len().to_numpy()
+        pos = group['pos'].to_numpy()
+
+        for n in np.unique(unit_length):
+            rows = unit_length == n
+            unit_codes = encode_alleles(units.loc[rows], n)
+            start = pos[rows]
+            is_deletion = deletion[rows]
+            left, right, out_of_range = count_repeats(reference, chrom, start, unit_codes,
+                                                      np.where(is_deletion, start + n, start))
+            repeats = np.minimum(left + right, 5)
+
+            if n == 1:
+                base_class = np.where((unit_codes[:, 0] == 1) | (unit_codes[:, 0] == 2), 0, 6)
+                type_code = np.where(is_deletion, 0, 12) + base_class + repeats
+            else:
+                type_code = np.where(is_deletion, 24, 48) + (min(n, 5) - 2) * 6 + repeats
+
+                # Microhomology of deletions without repeats (insertions are counted as R:0)
+                offsets = np.arange(n - 1)
+                forward = reference.bases(chrom, (start + n)[:, None] + offsets) == unit_codes[:, :-1]
+                reverse = reference.bases(chrom, (start - 1)[:, None] - offsets) == unit_codes[:, :0:-1]
+                homology = np.maximum(np.cumprod(forward, axis=1).sum(axis=1),
+                                      np.cumprod(reverse, axis=1).sum(axis=1))
+                microhomology = is_deletion & (left + right == 0) & (homology > 0)
+                homology_offset = {2: 0, 3: 1, 4: 3}.get(min(n, 5), 6)
+                type_code = np.where(microhomology, 72 + homology_offset + np.minimum(homology, 5) - 1, type_code)
+
+            sample_codes.append(codes[rows][~out_of_range])
+            type_codes.append(type_code[~out_of_range])
+
+    return count_matrix(np.concatenate(sample_codes or [np.empty(0, np.int64)]).astype(np.int64),
+                        np.concatenate(type_codes or [np.empty(0, np.int64)]).astype(np.int64),
+                        samples, ID83_TYPES)
+
+
+def generate_native_matrices(data: pd.DataFrame,
+                             output_dir: str | None = 'data/mutational_matrices',
+                             reference_dir: str | None = None,
+                             contexts: list[str] = NATIVE_CONTEXTS,
+                             project: str = 'MutSigMA') -> dict[str, pd.DataFrame]:
+    '''
+    Build SBS96/DBS78/ID83 mutational matrices directly from the filtered mutations dataframe.
+
+    Matrices are returned as a {context: dataframe} dictionary and, unless output_dir is None, saved
+    in the SigProfilerMatrixGenerator layout (output_dir/SBS/MutSigMA.SBS96.all, ...).
+    '''
+    reference = ReferenceGenome(reference_dir or default_reference_dir())
+    matrices = build_native_matrices(data, reference, contexts)
+    if output_dir is not None:
+        save_all_matrices(matrices, output_dir, project)
+
+    return matrices
+
+
+def build_native_matrices(data: pd.DataFrame, reference: ReferenceGenome,
+                          contexts: list[str] = NATIVE_CONTEXTS) -> dict[str, pd.DataFrame]:
+    '''Build {context: dataframe} mutational matrices of the patients in a mutations dataframe.'''
+    samples = sorted(data['case_barcode'].astype(str).unique())
+    snvs, indels = split_mutations(data)
+
+    builders = {
+        'SBS96': lambda: build_sbs96(snvs, reference, samples),
+        'DBS78': lambda: build_dbs78(snvs, reference, samples),
+        'ID83': lambda: build_id83(indels, reference, samples)
+    }
+
+    return {context: builders[context]() for context in contexts}
+
+
+def stream_native_matrices(chunks: Iterable[pd.DataFrame],
+                           output_dir: str | None = 'data/mutational_matrices',
+                           reference_dir: str | None = None,
+                           contexts: list[str] = NATIVE_CONTEXTS,
+                           project: str = 'MutSigMA') -> dict[str, pd.DataFrame]:
+    '''
+    Build the matrices of generate_native_matrices from chunks of mutations, adding up per-patient counts.
+
+    Every patient and chromosome has to be complete within one chunk (see utils.iter_patient_chunks),
+    only one chunk and the per-patient counts are held in memory.
+    '''
+    reference = ReferenceGenome(reference_dir or default_reference_dir())
+    counts = {context: {} for context in contexts}
+
+    for chunk in chunks:
+        for context, matrix in build_native_matrices(chunk, reference, contexts).items():
+            context_counts = counts[context]
+            for sample, sample_counts in zip(matrix.columns, matrix.to_numpy().T):
+                if sample in context_counts:
+                    context_counts[sample] += sample_counts
+                else:
+                    context_counts[sample] = sample_counts.copy()
+
+    types = {'SBS96': SBS96_TYPES, 'DBS78': DBS78_TYPES, 'ID83': ID83_TYPES}
+    matrices = {}
+    for context, context_counts in counts.items():
+        samples = sorted(context_counts)
+        values = (np.column_stack([context_counts[sample] for sample in samples]) if samples
+                  else np.zeros((len(types[context]), 0), dtype=np.int64))
+        matrices[context] = pd.DataFrame(values, index=pd.Index(types[context], name='MutationType'), columns=samples)
+
+    if output_dir is not None:
+        save_all_matrices(matrices, output_dir, project)
+
+    return matrices
+
+
+def save_all_matrices(matrices: dict[str, pd.DataFrame], output_dir: str, project: str = 'MutSigMA'):
+    '''Save {context: dataframe} mutational matrices in the SigProfilerMatrixGenerator layout.'''
+    for context, matrix in matrices.items():
+        file_path = matrix_filepath(output_dir, context, project)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        save_matrix(matrix, file_path)
+
+
+def matrix_filepath(output_dir: str, context: str, project: str = 'MutSigMA') -> str:
+    '''Return the SigProfilerMatrixGenerator path of a context matrix, eg. output_dir/SBS/MutSigMA.SBS96.all.'''
+    signature_type = ''.join([c for c in context if not c.isdigit()])
+    return os.path.join(output_dir, signature_type, f'{project}.{context}.all')
+
+
+def load_matrix(output_dir: str, context: str, project: str = 'MutSigMA') -> pd.DataFrame:
+    '''Load a mutational matrix saved in the SigProfilerMatrixGenerator layout.'''
+    return pd.read_csv(matrix_filepath(output_dir, context, project), sep='\t', index_col=0)
+
+
+def save_matrix(matrix: pd.DataFrame, file_path: str):
+    '''Save mutational matrix in the SigProfilerMatrixGenerator text format.'''
+    matrix.to_csv(file_path, sep='\t')
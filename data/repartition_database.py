@@ -0,0 +1,28 @@
+import argparse
+
+if __name__ == '__main__':
+    # Add parser
+    parser = argparse.ArgumentParser(
+        prog='repartition_database.py',
+        description='Rewrite the mutations database as a partitioned, indexed dataset for faster filtering.'
+    )
+
+    # Add console arguments
+    parser.add_argument('-d', '--database-filepath',
+                        default='data/mutations.parquet.gzip',
+                        help='Path to the mutations database')
+    parser.add_argument('-o', '--output-dir',
+                        default='data/mutations_partitioned',
+                        help='Output directory of the partitioned database')
+    parser.add_argument('-g', '--row-group-size',
+                        type=int,
+                        default=100_000,
+                        help='Maximum number of records per parquet row group')
+    args = parser.parse_args()
+
+
+from utils import repartition_database
+
+
+if __name__ == '__main__':
+    repartition_database(**vars(args))
@@ -1,91 +1,449 @@
+import functools
+import operator
 import os
+import tempfile
+import warnings
+from collections.abc import Iterable, Iterator
+from multiprocessing import Pool
+from urllib.parse import quote
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
+# Database columns used by the VCF extraction
+VCF_SOURCE_COLUMNS = ['Chromosome', 'Start_Position', 'case_barcode', 'Reference_Allele', 'Tumor_Seq_Allele2']
+
+# Database columns filtered by each request parameter
+REQUEST_COLUMNS = {
+    'project_names': 'project_short_name',
+    'patient_ids': 'case_barcode',
+    'primary_sites': 'primary_site',
+    'chromosomes': 'Chromosome'
+}
+
+# Partitioned database layout (see repartition_database)
+PARTITION_SCHEMA = pa.schema([('project_short_name', pa.string()), ('Chromosome', pa.string())])
+PARTITION_INDEX_FILENAME = '_patient_index.parquet'
+
+# VCF output format
+VCF_COLUMNS = ["Chromosome", "Position", "ID", "Ref", "Alt", "Qual", "Filter", "Info", "Motif", "Strand"]
+VCF_HEADER = """##fileformat=VCFv4.2
+##source=CustomConversionScript
+##reference=GRCh38
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tMOTIF\tSTRAND
+"""
+
+# Patient shards per VCF writing worker (smaller shards keep the progress bar moving)
+VCF_SHARDS_PER_WORKER = 8
+
+NO_RECORDS_MESSAGE = 'There are no records matching the chosen parameters. Check for typing errors in the request.'
+
+# Records per streamed batch (see iter_filtered_batches)
+STREAM_CHUNK_ROWS = 500_000
+
+
+def build_filter_expression(project_names: list[str] | None = None,
+                            patient_ids: list[str] | None = None,
+                            primary_sites: list[str] | None = None,
+                            chromosomes: list[str] | None = None) -> ds.Expression | None:
+    '''Combine requested parameters into a single pyarrow filter expression (None if nothing requested).'''
+    requests = {
+        'project_short_name': project_names,
+        'case_barcode': patient_ids,
+        'primary_site': primary_sites,
+        'Chromosome': chromosomes
+    }
+
+    expression = None
+    for column, values in requests.items():
+        if values:
+            condition = ds.field(column).isin(values)
+            expression = condition if expression is None else expression & condition
+
+    return expression
+
+
 def filter_database(project_names: list[str] | None = None,
                     patient_ids: list[str] | None = None,
                     primary_sites: list[str] | None = None,
                     chromosomes: list[str] | None = None,
-                    database_filepath: str = 'data/mutations.parquet.gzip') -> pd.DataFrame:
-    '''Filter mutations data based on user requests (list format).'''
-    # Load mutations database
+                    database_filepath: str = 'data/mutations.parquet.gzip',
+                    columns: list[str] | None = VCF_SOURCE_COLUMNS) -> pd.DataFrame:
+    '''
+    Filter mutations data based on user requests (list format).
+
+    Requested parameters are pushed down into the parquet scan, so only matching row groups
+    and the selected columns (all columns if None) are read from disk.
+    '''
+    dataset, expression = open_filtered_dataset(project_names, patient_ids, primary_sites, chromosomes, database_filepath)
+    data = dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+    # Check if there are any records matching all the parameters
+    assert not data.empty, NO_RECORDS_MESSAGE
+
+    return data
+
+
+def filter_database_requests(requests: list[dict[str, list[str] | None]],
+                             database_filepath: str = 'data/mutations.parquet.gzip',
+                             columns: list[str] | None = VCF_SOURCE_COLUMNS) -> list[pd.DataFrame | None]:
+    '''
+    Filter mutations data for several requests (parameter dictionaries of filter_database) in a single scan.
+
+    Records matching any request are read once, with the columns the requests filter on, and each request's records
+    are selected from them in memory. Returns one dataframe per request, None if no records match the request.
+    '''
     print('Loading mutational database...')
-    data = pd.read_parquet(database_filepath)
-    
+    dataset = open_database(database_filepath, requests)
+
+    print('Locating requested records...')
+    expressions = [build_filter_expression(**request) for request in requests]
+    # A request without parameters selects the whole database
+    expression = (None if any(request_expression is None for request_expression in expressions)
+                  else functools.reduce(operator.or_, expressions))
+    columns = columns or dataset.schema.names
+    filter_columns = [column for parameter, column in REQUEST_COLUMNS.items()
+                      if column not in columns and any(request.get(parameter) for request in requests)]
+    table = dataset.to_table(columns=columns + filter_columns, filter=expression)
+
+    selections = []
+    for request_expression in expressions:
+        selected = table if request_expression is None else table.filter(request_expression)
+        selections.append(selected.select(columns).to_pandas() if selected.num_rows else None)
+
+    return selections
+
+
+def iter_filtered_batches(project_names: list[str] | None = None,
+                          patient_ids: list[str] | None = None,
+                          primary_sites: list[str] | None = None,
+                          chromosomes: list[str] | None = None,
+                          database_filepath: str = 'data/mutations.parquet.gzip',
+                          columns: list[str] | None = VCF_SOURCE_COLUMNS,
+                          chunk_rows: int = STREAM_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    '''
+    Stream the records filter_database would return as dataframes of chunk_rows records (the last one may be smaller),
+    in database order.
+
+    Read-ahead is limited to a single batch, so memory is bounded by chunk_rows and the decoded parquet row group.
+    '''
+    dataset, expression = open_filtered_dataset(project_names, patient_ids, primary_sites, chromosomes, database_filepath)
+    buffered, buffered_rows, empty = [], 0, True
+
+    # Scanned batches end at row group boundaries, they are merged and split into chunks of chunk_rows records
+    for batch in dataset.to_batches(columns=columns, filter=expression, batch_size=chunk_rows,
+                                    batch_readahead=1, fragment_readahead=1):
+        buffered.append(batch)
+        buffered_rows += batch.num_rows
+        while buffered_rows >= chunk_rows:
+            empty = False
+            table = pa.Table.from_batches(buffered)
+            yield table.slice(0, chunk_rows).to_pandas()
+            rest = table.slice(chunk_rows)
+            buffered, buffered_rows = rest.to_batches(), rest.num_rows
+
+    if buffered_rows:
+        empty = False
+        yield pa.Table.from_batches(buffered).to_pandas()
+
+    # Check if there are any records matching all the parameters
+    assert not empty, NO_RECORDS_MESSAGE
+
+
+def open_filtered_dataset(project_names: list[str] | None = None,
+                          patient_ids: list[str] | None = None,
+                          primary_sites: list[str] | None = None,
+                          chromosomes: list[str] | None = None,
+                          database_filepath: str = 'data/mutations.parquet.gzip') -> tuple[ds.Dataset, ds.Expression | None]:
+    '''Open the mutations database lazily, return the dataset and the filter expression of the requested parameters.'''
+    # Open mutations database lazily
+    print('Loading mutational database...')
+    dataset = open_database(database_filepath, [{'project_names': project_names, 'patient_ids': patient_ids,
+                                                 'primary_sites': primary_sites, 'chromosomes': chromosomes}])
+
     # Filter database by requested parameters
     print('Locating requested records...')
+    return dataset, build_filter_expression(project_names, patient_ids, primary_sites, chromosomes)
+
+
+def open_database(database_filepath: str, requests: list[dict[str, list[str] | None]]) -> ds.Dataset:
+    '''Open the mutations database lazily, a partitioned one only in the partition files holding records of requests.'''
+    if not is_partitioned_database(database_filepath):
+        return ds.dataset(database_filepath, format='parquet')
+
+    # Open only the partition files holding the requested records
+    partition_files = sorted({file_path for request in requests
+                              for file_path in locate_partition_files(database_filepath, **request)})
+    assert partition_files, NO_RECORDS_MESSAGE
+    return ds.dataset(partition_files,
+                      format='parquet',
+                      partitioning=ds.partitioning(PARTITION_SCHEMA, flavor='hive'),
+                      partition_base_dir=database_filepath)
+
+
+def is_partitioned_database(database_filepath: str) -> bool:
+    '''Check if the database is a partitioned dataset created by repartition_database.'''
+    return os.path.isfile(os.path.join(database_filepath, PARTITION_INDEX_FILENAME))
+
+
+def locate_partition_files(database_dir: str,
+                           project_names: list[str] | None = None,
+                           patient_ids: list[str] | None = None,
+                           primary_sites: list[str] | None = None,
+                           chromosomes: list[str] | None = None) -> list[str]:
+    '''Find partition files containing the requested records using the sidecar patient index.'''
+    index = pd.read_parquet(os.path.join(database_dir, PARTITION_INDEX_FILENAME))
+
     if project_names:
-        data = data.loc[data['project_short_name'].isin(project_names)]
+        index = index.loc[index['project_short_name'].isin(project_names)]
     if patient_ids:
-        data = data.loc[data['case_barcode'].isin(patient_ids)]
+        index = index.loc[index['case_barcode'].isin(patient_ids)]
     if primary_sites:
-        data = data.loc[data['primary_site'].isin(primary_sites)]
+        index = index.loc[index['primary_site'].isin(primary_sites)]
     if chromosomes:
-        data = data.loc[data['Chromosome'].isin(chromosomes)]
+        index = index.loc[index['Chromosome'].isin(chromosomes)]
 
-    # Check if there are any records matching all the parameters
-    assert not data.empty, 'There are no records matching the chosen parameters. Check for typing errors in the request.'
+    return [os.path.join(database_dir, path) for path in sorted(index['path'].unique())]
 
-    return data
 
+def repartition_database(database_filepath: str, output_dir: str, row_group_size: int = 100_000):
+    '''
+    Rewrite the mutations database as a Hive-partitioned parquet dataset.
+
+    Records are partitioned by project_short_name and Chromosome and sorted by case_barcode, so
+    row-group statistics can skip other patients. A sidecar index maps every patient (and primary site)
+    to the partition files holding their records. The database is read once to stage the records of every
+    project, then projects are processed one at a time.
+    '''
+    dataset = ds.dataset(database_filepath, format='parquet')
+    os.makedirs(output_dir, exist_ok=True)
+    index_parts = []
+    written_rows = 0
+
+    with tempfile.TemporaryDirectory(dir=output_dir) as staging_dir:
+        # Single pass over the database, routing the records of every batch to a staging file per project.
+        # Read-ahead is limited to a single batch, as in iter_filtered_batches
+        staged_files, writers = {}, {}
+        try:
+            has_partition = ds.field('project_short_name').is_valid() & ds.field('Chromosome').is_valid()
+            for batch in dataset.to_batches(filter=has_partition, batch_readahead=1, fragment_readahead=1):
+                if batch.num_rows == 0:
+                    continue
+                table = pa.Table.from_batches([batch])
+                table = table.take(pc.sort_indices(table['project_short_name']))
+                projects = table['project_short_name'].to_numpy(zero_copy_only=False)
+                starts = np.flatnonzero(np.r_[True, projects[1:] != projects[:-1]])
+                for start, end in zip(starts, np.r_[starts[1:], len(projects)]):
+                    project = projects[start]
+                    if project not in writers:
+                        staged_files[project] = os.path.join(staging_dir, f'{len(staged_files)}.parquet')
+                        writers[project] = pq.ParquetWriter(staged_files[project], dataset.schema)
+                    writers[project].write_table(table.slice(start, end - start))
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        for project, staged_file in tqdm(sorted(staged_files.items()), desc='Repartitioning database...'):
+            table = pq.read_table(staged_file)
+            project_chromosomes = pc.unique(table['Chromosome']).to_pylist()
+
+            for chromosome in sorted(project_chromosomes):
+                partition = table.filter(pc.equal(table['Chromosome'], chromosome)).sort_by('case_barcode')
+
+                # Partition values are kept in the directory names only
+                partition_path = os.path.join(f'project_short_name={quote(project, safe="")}',
+                                              f'Chromosome={quote(chromosome, safe="")}',
+                                              'part-0.parquet')
+                os.makedirs(os.path.join(output_dir, os.path.dirname(partition_path)), exist_ok=True)
+                pq.write_table(partition.drop_columns(PARTITION_SCHEMA.names),
+                               os.path.join(output_dir, partition_path),
+                               row_group_size=row_group_size,
+                               write_statistics=True)
+                written_rows += partition.num_rows
+
+                # Patients (and their primary sites) present in this partition
+                patients = partition.select(['case_barcode', 'primary_site']).to_pandas().drop_duplicates()
+                patients['project_short_name'] = project
+                patients['Chromosome'] = chromosome
+                patients['path'] = partition_path
+                index_parts.append(patients)
+
+    skipped = dataset.count_rows() - written_rows
+    if skipped:
+        print(f'Skipped {skipped} records without a project name or chromosome.')
+
+    # Write sidecar patient index
+    index = pd.concat(index_parts, ignore_index=True)
+    index.to_parquet(os.path.join(output_dir, PARTITION_INDEX_FILENAME), index=False)
+    print(f'Partitioned database saved in {output_dir} ({len(index_parts)} partitions).')
 
-def extract_vcf(data: pd.DataFrame):
+
+def convert_to_vcf(data: pd.DataFrame) -> pd.DataFrame:
+    '''Convert mutations dataframe into vcf-friendly format (column-wise).'''
+    df_vcf = pd.DataFrame({
+        'Chromosome': data['Chromosome'].str.replace('chr', '', regex=False),
+        'Position': data['Start_Position'],
+        'ID': data['case_barcode'],
+        'Ref': data['Reference_Allele'],
+        'Alt': data['Tumor_Seq_Allele2'],
+        'Qual': '.',
+        'Filter': 'Simulations',
+        'Info': 'GRCh38',
+        'Motif': data['Reference_Allele'],
+        'Strand': '+1'
+    })
+
+    return df_vcf[VCF_COLUMNS].reset_index(drop=True)
+
+
+def format_vcf_lines(df_vcf: pd.DataFrame) -> pd.Series:
+    '''Format every VCF dataframe row into a tab-separated VCF record line.'''
+    lines = df_vcf[VCF_COLUMNS[0]].astype(str)
+    for column in VCF_COLUMNS[1:]:
+        lines = lines + '\t' + df_vcf[column].astype(str)
+
+    return lines + '\n'
+
+
+def extract_vcf(data: pd.DataFrame, workers: int = 1, output_dir: str = 'data/VCF'):
     '''Extract and save VCF files from dataframe into a specified folder.'''
-    # Convert dataframe into vcf-friendly format
-    df_vcf = data.apply(
-        lambda row: [
-            row['Chromosome'].replace('chr', ''),
-            row['Start_Position'],
-            row['case_barcode'],
-            row['Reference_Allele'],
-            row['Tumor_Seq_Allele2'],
-            '.',
-            'Simulations',
-            'GRCh38',
-            row['Reference_Allele'],
-            '+1'
-        ],
-        axis=1
-    )
-
-    # Create new VCF dataframe
-    columns_vcf = [
-        "Chromosome", "Position", "ID", "Ref", "Alt", "Qual", "Filter", "Info", "Motif", "Strand"
-    ]
-    df_vcf = pd.DataFrame(df_vcf.tolist(), columns=columns_vcf)
-
-    # Group by 'case_barcode' (patient ID)
-    grouped = df_vcf.groupby("ID")
+    # Convert dataframe into vcf-friendly format, sorted by 'case_barcode' (patient ID)
+    df_vcf = convert_to_vcf(data)
+    df_vcf = df_vcf.iloc[df_vcf['ID'].argsort(kind='stable')].reset_index(drop=True)
+
+    # Locate each patient's contiguous block of records
+    bounds = patient_bounds(df_vcf['ID'].to_numpy())
+    n_patients = len(bounds) - 1
 
     # Save each patient's data into a separate VCF file
-    output_dir = "data/VCF"  # directory for VCF storage
     os.makedirs(output_dir, exist_ok=True)
+    shard_size = max(1, -(-n_patients // (workers * VCF_SHARDS_PER_WORKER)))
 
-    vcf_file_paths = []
+    # Every shard carries only its own patients' records
+    shards = [(output_dir, df_vcf.iloc[bounds[first]:bounds[min(first + shard_size, n_patients)]], frozenset())
+              for first in range(0, n_patients, shard_size)]
 
-    for file_gdc_id, group in tqdm(grouped, desc='VCF files extraction...'):
-        vcf_file_name = f"{file_gdc_id}.vcf"
-        vcf_file_path = os.path.join(output_dir, vcf_file_name)
-        save_to_vcf(group, vcf_file_path)
-        vcf_file_paths.append(vcf_file_path)
+    with tqdm(total=n_patients, desc='VCF files extraction...') as progress_bar:
+        if workers > 1:
+            with Pool(min(workers, len(shards))) as pool:
+                for written in pool.imap_unordered(save_vcf_shard, shards):
+                    progress_bar.update(written)
+        else:
+            for shard in shards:
+                progress_bar.update(save_vcf_shard(shard))
 
 
-def save_to_vcf(group, file_path):
-    '''Save patient data into a VCF file.'''
+def stream_vcf(batches: Iterable[pd.DataFrame], workers: int = 1, output_dir: str = 'data/VCF') -> int:
+    '''
+    Append VCF records of streamed mutation batches to per-patient VCF files, one batch in memory at a time.
+
+    Files get the same records in the same order as extract_vcf on the whole selection.
+    Returns the number of patients written.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    started = set()
+    pool = Pool(workers) if workers > 1 else None
+
+    try:
+        with tqdm(desc='VCF files extraction...', unit=' records') as progress_bar:
+            for batch in batches:
+                df_vcf = convert_to_vcf(batch)
+                df_vcf = df_vcf.iloc[df_vcf['ID'].argsort(kind='stable')].reset_index(drop=True)
+                bounds = patient_bounds(df_vcf['ID'].to_numpy())
+                n_patients = len(bounds) - 1
+
+                # Patients with a file from an earlier batch get their records appended
+                existing = frozenset(started)
+                shard_size = max(1, -(-n_patients // (workers * VCF_SHARDS_PER_WORKER)))
+                shards = [(output_dir, df_vcf.iloc[bounds[first]:bounds[min(first + shard_size, n_patients)]], existing)
+                          for first in range(0, n_patients, shard_size)]
+                if pool is not None:
+                    list(pool.imap_unordered(save_vcf_shard, shards))
+                else:
+                    for shard in shards:
+                        save_vcf_shard(shard)
+
+                started.update(df_vcf['ID'].to_numpy()[bounds[:-1]])
+                progress_bar.update(len(df_vcf))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return len(started)
+
+
+def iter_patient_chunks(batches: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+    '''
+    Regroup streamed mutation batches into chunks holding complete runs of records of a patient and chromosome.
+
+    A run cut by a batch boundary is carried over to the next chunk, so doublets and duplicate records of a
+    patient are always detected within one chunk. Databases ordered by patient (or partitioned by
+    repartition_database) have a single run per patient and chromosome, otherwise a warning is shown.
+    '''
+    pending = None
+    finished = set()
+    warned = False
+
+    def check_runs(patients: np.ndarray, chromosomes: np.ndarray):
+        '''Warn once if one of the runs (given by their patients and chromosomes) was finished in an earlier chunk.'''
+        nonlocal warned
+        runs = set(zip(patients, chromosomes))
+        if not warned and not finished.isdisjoint(runs):
+            warnings.warn('The database is not grouped by patient and chromosome: doublets and duplicate records split '
+                          'between chunks are not detected. Repartition the database or run without streaming.')
+            warned = True
+        finished.update(runs)
+
+    for batch in batches:
+        data = batch if pending is None else pd.concat([pending, batch], ignore_index=True)
+
+        # Starts of patient and chromosome runs, the last run may continue in the next batch
+        patients = data['case_barcode'].to_numpy()
+        chromosomes = data['Chromosome'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, (patients[1:] != patients[:-1]) | (chromosomes[1:] != chromosomes[:-1])])
+        last_run = starts[-1]
+
+        if last_run:
+            check_runs(patients[starts[:-1]], chromosomes[starts[:-1]])
+            yield data.iloc[:last_run]
+        pending = data.iloc[last_run:]
+
+    if pending is not None and len(pending):
+        check_runs(pending['case_barcode'].to_numpy()[:1], pending['Chromosome'].to_numpy()[:1])
+        yield pending
+
+
+def patient_bounds(patient_ids: np.ndarray) -> np.ndarray:
+    '''Return start offsets of each patient's block in sorted patient IDs, followed by the total length.'''
+    starts = np.flatnonzero(np.r_[True, patient_ids[1:] != patient_ids[:-1]])
+
+    return np.r_[starts, len(patient_ids)]
+
+
+def save_vcf_shard(shard: tuple[str, pd.DataFrame, frozenset[str]]) -> int:
+    '''
+    Save VCF files of a shard of patients (sorted by patient ID) and return the number of files written.
+
+    Records of patients in the shard's set of existing patients are appended to their files.
+    '''
+    output_dir, df_vcf, existing = shard
+    vcf_lines = format_vcf_lines(df_vcf).to_numpy(dtype=object)
+    patient_ids = df_vcf['ID'].to_numpy()
+    bounds = patient_bounds(patient_ids)
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        vcf_file_path = os.path.join(output_dir, f"{patient_ids[start]}.vcf")
+        save_to_vcf(vcf_lines[start:end], vcf_file_path, append=patient_ids[start] in existing)
+
+    return len(bounds) - 1
 
-    # Create a VCF file header
-    vcf_header = """##fileformat=VCFv4.2
-##source=CustomConversionScript
-##reference=GRCh38
-#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tMOTIF\tSTRAND
-"""
 
-    # Write every patient's VCF file
-    with open(file_path, "w") as vcf_file:
-        vcf_file.write(vcf_header)
-        for _, row in group.iterrows():
-            vcf_file.write(
-                f"{row['Chromosome']}\t{row['Position']}\t{row['ID']}\t"
-                f"{row['Ref']}\t{row['Alt']}\t{row['Qual']}\t{row['Filter']}\t{row['Info']}\t"
-                f"{row['Motif']}\t{row['Strand']}\n"
-            )
+def save_to_vcf(lines: np.ndarray, file_path: str, append: bool = False):
+    '''Save patient's VCF record lines into a VCF file in a single write (appending records without the header).'''
+    with open(file_path, "a" if append else "w") as vcf_file:
+        vcf_file.write(('' if append else VCF_HEADER) + ''.join(lines))
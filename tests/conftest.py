@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Pipeline modules live next to this folder
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+for stage_dir in ['data', 'assign', 'benchmarks', 'visualization']:
+    sys.path.insert(0, os.path.join(REPO_DIR, stage_dir))
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
@@ -0,0 +1,80 @@
+import argparse
+import os
+import shutil
+import sys
+import pandas as pd
+import pytest
+from conftest import FIXTURES_DIR
+import assigner
+from assigner import MINIMAL_OUTPUT_FILENAME, assign_matrices, assign_matrix, assignment_cache_key, worker_count
+
+MATRIX_PATH = os.path.join(FIXTURES_DIR, 'assignment', 'MutSigMA.SBS96.all')
+
+
+def write_matrix(tmp_path, name, n_samples):
+    '''Write the first n_samples columns of the fixture SBS96 matrix to tmp_path/name.'''
+    file_path = str(tmp_path / name)
+    pd.read_csv(MATRIX_PATH, sep='\t', index_col=0).iloc[:, :n_samples].to_csv(file_path, sep='\t')
+    return file_path
+
+
+def assignment_args(inputs, engine='sigprofiler', sample_shards=0):
+    '''Parsed assigner arguments relevant to the worker count.'''
+    return argparse.Namespace(input=inputs, engine=engine, sample_shards=sample_shards)
+
+
+@pytest.mark.parametrize('sizes, engine, expected', [
+    ([10], 'sigprofiler', 0),            # too few samples to shard, fitted in process
+    ([100], 'sigprofiler', 4),           # 4 shards of 25 samples
+    ([60], 'sigprofiler', 2),            # 2 shards of 30 samples
+    ([60, 10], 'sigprofiler', 2),        # the small matrix is fitted in process
+    ([100], 'native', 0),                # the native engine fits a whole matrix in process
+    ([10, 10], 'native', 2),             # one worker per matrix
+    ([10] * 6, 'sigprofiler', 4),        # as many matrices as cores, one worker per core
+])
+def test_worker_count(tmp_path, monkeypatch, sizes, engine, expected):
+    monkeypatch.setattr(assigner, 'cpu_count', lambda: 4)
+    inputs = [write_matrix(tmp_path, f'MutSigMA_{i}.SBS96.all', size) for i, size in enumerate(sizes)]
+
+    assert worker_count(assignment_args(inputs, engine)) == expected
+
+
+def test_worker_count_of_server_keeps_one_worker_per_core(monkeypatch):
+    monkeypatch.setattr(assigner, 'cpu_count', lambda: 4)
+
+    assert worker_count(assignment_args(None)) == 4
+
+
+def test_assign_matrices_fits_single_native_matrix_in_process(tmp_path, monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError('a single native matrix is fitted without a worker pool')
+
+    monkeypatch.setattr(assigner, 'Pool', no_pool)
+    matrix = pd.read_csv(MATRIX_PATH, sep='\t', index_col=0).iloc[:, :5]
+    [activities] = assign_matrices([matrix], [str(tmp_path / 'SBS96')], ['SBS'], engine='native', cache_dir=None)
+
+    assert activities.index.tolist() == matrix.columns.tolist()
+    assert (activities.sum(axis=1).to_numpy() == matrix.sum().to_numpy()).all()
+
+
+def test_cache_hit_replaces_previous_output(tmp_path):
+    matrix = pd.read_csv(MATRIX_PATH, sep='\t', index_col=0).iloc[:, :5]
+    output, cache_dir = str(tmp_path / 'SBS96'), str(tmp_path / 'cache')
+    expected = assign_matrix(matrix, output, engine='native', minimal_output=True, cache_dir=cache_dir)
+
+    # A full output tree of an earlier run with bootstrap intervals
+    other_output = str(tmp_path / 'other')
+    assign_matrix(matrix, other_output, engine='native', bootstrap=5, cache_dir=None)
+    shutil.rmtree(output)
+    shutil.copytree(other_output, output)
+    activities = assign_matrix(matrix, output, engine='native', minimal_output=True, incremental=True, cache_dir=cache_dir)
+
+    assert sorted(os.listdir(output)) == [MINIMAL_OUTPUT_FILENAME]
+    pd.testing.assert_frame_equal(activities, expected)
+
+
+def test_native_cache_key_does_not_import_sigprofiler(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'SigProfilerAssignment', None)
+    matrix = pd.read_csv(MATRIX_PATH, sep='\t', index_col=0)
+
+    assert assignment_cache_key(matrix, 'SBS', None, False, None, engine='native')
@@ -0,0 +1,111 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import FIXTURES_DIR
+from matrices import (DBS78_TYPES, ID83_TYPES, SBS96_TYPES, ReferenceGenome, build_native_matrices,
+                      generate_native_matrices, matrix_filepath, stream_native_matrices)
+from utils import iter_patient_chunks
+
+# Expected matrices were written by SigProfilerMatrixGenerator 1.4.0 from fixtures/matrix_mutations.tsv,
+# with fixtures/reference installed as its GRCh38 chromosomes
+REFERENCE_DIR = os.path.join(FIXTURES_DIR, 'reference')
+EXPECTED_DIR = os.path.join(FIXTURES_DIR, 'matrices')
+
+# Hand-made chromosome 1, blocks of 10 bases (1-based positions of the mutated bases in brackets)
+HAND_SEQUENCE = (
+    'TTACGATTGA'  # A[C]G at 4
+    'TTCGTATTGA'  # C[G]T at 14
+    'GATTAGCATG'  # T[T]A at 24
+    'GATCCAGTAG'  # T[CC]A at 34-35
+    'CATGGACTAG'  # T[GG]A at 44-45
+    'ATCCCCCATG'  # CCCCC at 53-57
+    'GATTTACGAG'  # TTT at 63-65
+    'TTTACGACTT'  # T[ACG]ACT at 74-76
+    'GATCGATCGA'  # C at 84
+    'GGCATGCATG'
+)
+
+HAND_MUTATIONS = [
+    ('TCGA-A', 'chr1', 4, 'C', 'T'),      # A[C>T]G
+    ('TCGA-A', 'chr1', 4, 'C', 'T'),      # duplicate record, dropped
+    ('TCGA-A', 'chr1', 14, 'G', 'A'),     # A[C>T]G on the pyrimidine strand
+    ('TCGA-A', 'chr1', 24, 'T', 'G'),     # T[T>G]A
+    ('TCGA-A', 'chr1', 34, 'CC', 'TT'),   # CC>TT, also T[C>T]C and C[C>T]A
+    ('TCGA-A', 'chr1', 44, 'G', 'A'),     # GG>AA from two records is CC>TT, also C[C>T]A
+    ('TCGA-A', 'chr1', 45, 'G', 'A'),     # and T[C>T]C
+    ('TCGA-A', 'chr1', 53, 'C', '-'),     # one C of five deleted, 1:Del:C:4
+    ('TCGA-A', 'chr1', 62, '-', 'T'),     # T inserted before TTT, 1:Ins:T:3
+    ('TCGA-A', 'chr1', 73, 'ACG', '-'),   # ACG deleted before ACT, 3:Del:M:2
+    ('TCGA-A', 'chr1', 84, 'A', 'T'),     # reference mismatch, dropped
+    ('TCGA-B', 'chr1', 24, 'T', 'G')      # T[T>G]A
+]
+
+HAND_COUNTS = {
+    'SBS96': {('A[C>T]G', 'TCGA-A'): 2, ('C[C>T]A', 'TCGA-A'): 2, ('T[C>T]C', 'TCGA-A'): 2,
+              ('T[T>G]A', 'TCGA-A'): 1, ('T[T>G]A', 'TCGA-B'): 1},
+    'DBS78': {('CC>TT', 'TCGA-A'): 2},
+    'ID83': {('1:Del:C:4', 'TCGA-A'): 1, ('1:Ins:T:3', 'TCGA-A'): 1, ('3:Del:M:2', 'TCGA-A'): 1}
+}
+
+
+def read_mutations(file_path):
+    '''Read a mutations table fixture, keeping '-' alleles as strings.'''
+    return pd.read_csv(file_path, sep='\t', keep_default_na=False)
+
+
+@pytest.fixture
+def hand_reference(tmp_path):
+    '''Reference directory holding HAND_SEQUENCE as chromosome 1.'''
+    (tmp_path / '1.txt').write_text(HAND_SEQUENCE)
+    return str(tmp_path)
+
+
+def nonzero_counts(matrix):
+    '''Return {(mutation type, sample): count} of the non-zero cells of a matrix.'''
+    counts = matrix.stack()
+    return {key: int(count) for key, count in counts[counts > 0].items()}
+
+
+def test_reference_genome_reads_letters_and_strand_codes(tmp_path):
+    (tmp_path / '1.txt').write_text('ACGTNacgt')
+    # SigProfilerMatrixGenerator bytes: base + 4 * transcriptional strand, 16-19 for N
+    np.array([0, 5, 10, 15, 16, 4, 9, 14, 19], dtype=np.uint8).tofile(tmp_path / '2.txt')
+    reference = ReferenceGenome(str(tmp_path))
+
+    assert '1' in reference and 'X' not in reference
+    assert reference.bases('1', np.arange(-1, 10)).tolist() == [3, 0, 1, 2, 3, 4, 0, 1, 2, 3, 4]
+    assert reference.bases('2', np.arange(9)).tolist() == [0, 1, 2, 3, 4, 0, 1, 2, 4]
+
+
+def test_hand_placed_mutations(hand_reference):
+    data = pd.DataFrame(HAND_MUTATIONS, columns=['case_barcode', 'Chromosome', 'Start_Position',
+                                                 'Reference_Allele', 'Tumor_Seq_Allele2'])
+    matrices = build_native_matrices(data, ReferenceGenome(hand_reference))
+
+    for context, mutation_types in [('SBS96', SBS96_TYPES), ('DBS78', DBS78_TYPES), ('ID83', ID83_TYPES)]:
+        assert matrices[context].index.tolist() == mutation_types
+        assert matrices[context].columns.tolist() == ['TCGA-A', 'TCGA-B']
+        assert nonzero_counts(matrices[context]) == HAND_COUNTS[context]
+
+
+def test_generate_native_matrices_matches_sigprofiler_files(tmp_path):
+    data = read_mutations(os.path.join(FIXTURES_DIR, 'matrix_mutations.tsv'))
+    generate_native_matrices(data, output_dir=str(tmp_path), reference_dir=REFERENCE_DIR)
+
+    for context in ['SBS96', 'DBS78', 'ID83']:
+        with open(matrix_filepath(str(tmp_path), context), 'rb') as written, \
+                open(matrix_filepath(EXPECTED_DIR, context), 'rb') as expected:
+            assert written.read() == expected.read(), context
+
+
+def test_stream_native_matrices_matches_sigprofiler_files(tmp_path):
+    data = read_mutations(os.path.join(FIXTURES_DIR, 'matrix_mutations.tsv'))
+    data = data.sort_values(['case_barcode', 'Chromosome'], kind='stable').reset_index(drop=True)
+    batches = (data.iloc[start:start + 50] for start in range(0, len(data), 50))
+    stream_native_matrices(iter_patient_chunks(batches), output_dir=str(tmp_path), reference_dir=REFERENCE_DIR)
+
+    for context in ['SBS96', 'DBS78', 'ID83']:
+        with open(matrix_filepath(str(tmp_path), context), 'rb') as written, \
+                open(matrix_filepath(EXPECTED_DIR, context), 'rb') as expected:
+            assert written.read() == expected.read(), context
@@ -0,0 +1,118 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.optimize import nnls
+from conftest import FIXTURES_DIR
+import native_fit as native_fit_module
+from native_fit import batched_nnls, bootstrap_intervals, fit_exposures, load_signatures, native_fit, remove_signatures
+
+# Native matrices of `benchmarks/synthetic_cohort.py -n 100` and the activities SigProfilerAssignment 1.1.5 cosmic_fit assigned to them
+ASSIGNMENT_DIR = os.path.join(FIXTURES_DIR, 'assignment')
+
+# Agreement required of the native engine with cosmic_fit
+MIN_SAMPLE_COSINE = 0.95
+MIN_MEAN_COSINE = 0.99
+MIN_MEAN_JACCARD = 0.95
+
+
+def read_fixture(context):
+    '''Read the fixture matrix and cosmic_fit activities of context.'''
+    matrix = pd.read_csv(os.path.join(ASSIGNMENT_DIR, f'MutSigMA.{context}.all'), sep='\t', index_col=0)
+    expected = pd.read_csv(os.path.join(ASSIGNMENT_DIR, f'cosmic_fit_{context}_activities.txt'), sep='\t', index_col=0)
+    return matrix, expected
+
+
+@pytest.mark.parametrize('context', ['SBS96', 'DBS78', 'ID83'])
+def test_native_fit_agrees_with_cosmic_fit(tmp_path, context):
+    matrix, expected = read_fixture(context)
+    activities = native_fit(matrix, str(tmp_path), context[:-2])
+
+    assert activities.index.tolist() == expected.index.tolist()
+    totals = matrix[activities.index].sum().to_numpy()
+    activities = activities[expected.columns].to_numpy(dtype=float)
+    expected = expected.to_numpy(dtype=float)
+    cosine = (activities * expected).sum(axis=1) / (np.linalg.norm(activities, axis=1) * np.linalg.norm(expected, axis=1))
+    jaccard = ((activities > 0) & (expected > 0)).sum(axis=1) / ((activities > 0) | (expected > 0)).sum(axis=1)
+
+    assert cosine.min() >= MIN_SAMPLE_COSINE
+    assert cosine.mean() >= MIN_MEAN_COSINE
+    assert jaccard.mean() >= MIN_MEAN_JACCARD
+    # Every mutation of a sample is assigned
+    assert (activities.sum(axis=1) == totals).all()
+
+
+@pytest.mark.filterwarnings('error')
+def test_fit_exposures_leaves_empty_samples_unassigned():
+    matrix, _ = read_fixture('SBS96')
+    signatures = load_signatures(matrix.index, 'SBS')
+    counts = matrix.iloc[:, :3].to_numpy(dtype=float)
+    counts[:, 1] = 0
+
+    exposures = fit_exposures(signatures, counts, 'SBS')
+
+    assert (exposures[:, 1] == 0).all()
+    assert (exposures[:, [0, 2]].sum(axis=0) == counts[:, [0, 2]].sum(axis=0)).all()
+
+
+def test_batched_nnls_matches_scipy():
+    rng = np.random.default_rng(0)
+    signatures = rng.random((96, 12))
+    counts = rng.random((96, 40)) * 100
+    allowed = rng.random((40, 12)) < 0.7
+
+    weights = batched_nnls(signatures.T @ signatures, (signatures.T @ counts).T, allowed)
+
+    for problem in range(counts.shape[1]):
+        expected = np.zeros(12)
+        expected[allowed[problem]] = nnls(signatures[:, allowed[problem]], counts[:, problem])[0]
+        np.testing.assert_allclose(weights[problem], expected, atol=1e-6)
+
+
+def test_fit_exposures_with_many_added_candidates(monkeypatch):
+    matrix, _ = read_fixture('SBS96')
+    signatures = load_signatures(matrix.index, 'SBS')
+    counts = matrix.iloc[:, :20].to_numpy(dtype=float)
+    removals = []
+
+    def record_removal(signatures, gram, counts, exposures, errors, kept, penalty):
+        removals.append((len(counts), kept.shape))
+        return remove_signatures(signatures, gram, counts, exposures, errors, kept, penalty)
+
+    # Every candidate signature is added, each one goes through the removal with the base fits
+    monkeypatch.setattr(native_fit_module, 'ADD_PENALTY', -1)
+    monkeypatch.setattr(native_fit_module, 'remove_signatures', record_removal)
+    exposures = fit_exposures(signatures, counts, 'SBS')
+
+    assert max(problems for problems, _ in removals) > 10 * counts.shape[1]
+    assert all(shape == (2,) for _, shape in removals[1:])
+    assert (exposures.sum(axis=0) == counts.sum(axis=0)).all()
+
+
+def test_bootstrap_intervals_match_nnls_refits():
+    matrix, _ = read_fixture('SBS96')
+    signatures_df = load_signatures(matrix.index, 'SBS')
+    signatures = signatures_df.to_numpy()
+    # Few mutations per sample, so that many replicates have negative least squares exposures
+    rng = np.random.default_rng(0)
+    counts = matrix.iloc[:, :10].to_numpy(dtype=float)
+    counts = np.stack([rng.multinomial(30, column / column.sum()) for column in counts.T], axis=1).astype(float)
+    counts[:, 3] = 0
+    exposures = fit_exposures(signatures_df, counts)
+    seed_sequences = np.random.SeedSequence(0).spawn(counts.shape[1])
+
+    lower, upper = bootstrap_intervals(signatures, counts, exposures, 200, seed_sequences)
+
+    expected_lower, expected_upper = np.zeros(exposures.shape), np.zeros(exposures.shape)
+    for i, seed_sequence in enumerate(seed_sequences):
+        total, active = counts[:, i].sum(), np.flatnonzero(exposures[:, i] > 0)
+        if total == 0:
+            continue
+        resampled = np.random.default_rng(seed_sequence).multinomial(int(total), counts[:, i] / total, size=200)
+        fitted = np.array([nnls(signatures[:, active], replicate.astype(float))[0] for replicate in resampled])
+        fitted *= total / fitted.sum(axis=1, keepdims=True)
+        expected_lower[active, i], expected_upper[active, i] = np.quantile(fitted, [0.025, 0.975], axis=0)
+
+    np.testing.assert_allclose(lower, expected_lower, atol=1e-6)
+    np.testing.assert_allclose(upper, expected_upper, atol=1e-6)
+    assert (lower[:, 3] == 0).all() and (upper[:, 3] == 0).all()
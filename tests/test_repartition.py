@@ -0,0 +1,42 @@
+import os
+import numpy as np
+import pandas as pd
+from utils import PARTITION_INDEX_FILENAME, locate_partition_files, repartition_database
+
+
+def write_database(file_path, n_records=2000, seed=0):
+    '''Write a shuffled mutations database of several projects, with records missing a project name or chromosome.'''
+    rng = np.random.default_rng(seed)
+    patients = [f'TCGA-{i:02d}' for i in range(40)]
+    projects = dict(zip(patients, rng.choice(['TCGA-BRCA', 'TCGA-LUAD', 'TCGA C/D'], len(patients))))
+    data = pd.DataFrame({'case_barcode': rng.choice(patients, n_records),
+                         'Chromosome': rng.choice(['chr1', 'chr2', 'chrX'], n_records),
+                         'Start_Position': rng.integers(1, 10**6, n_records)})
+    data.insert(0, 'project_short_name', data['case_barcode'].map(projects))
+    data['primary_site'] = data['project_short_name'].str[5:]
+    data.loc[rng.choice(n_records, 10, replace=False), 'project_short_name'] = None
+    data.loc[rng.choice(n_records, 10, replace=False), 'Chromosome'] = None
+    # Small row groups, so that the database is read in several batches
+    data.to_parquet(file_path, row_group_size=300)
+    return data
+
+
+def test_repartition_database(tmp_path):
+    data = write_database(tmp_path / 'mutations.parquet')
+    output_dir = tmp_path / 'partitioned'
+    repartition_database(str(tmp_path / 'mutations.parquet'), str(output_dir), row_group_size=100)
+
+    kept = data.dropna(subset=['project_short_name', 'Chromosome'])
+    index = pd.read_parquet(output_dir / PARTITION_INDEX_FILENAME)
+    assert sorted(os.listdir(output_dir)) == sorted(['project_short_name=TCGA-BRCA', 'project_short_name=TCGA-LUAD',
+                                                     'project_short_name=TCGA%20C%2FD', PARTITION_INDEX_FILENAME])
+    assert len(index['path'].unique()) == len(kept.groupby(['project_short_name', 'Chromosome']))
+
+    for (project, chromosome), records in kept.groupby(['project_short_name', 'Chromosome']):
+        [file_path] = locate_partition_files(str(output_dir), project_names=[project], chromosomes=[chromosome])
+        # Records of a patient keep the database order
+        expected = records.sort_values('case_barcode', kind='stable').drop(columns=['project_short_name', 'Chromosome'])
+        pd.testing.assert_frame_equal(pd.read_parquet(file_path), expected.reset_index(drop=True))
+
+        patients = index[(index['project_short_name'] == project) & (index['Chromosome'] == chromosome)]
+        assert sorted(patients['case_barcode']) == sorted(records['case_barcode'].unique())
@@ -0,0 +1,36 @@
+import os
+import pandas as pd
+import pytest
+from conftest import FIXTURES_DIR
+from utils import extract_vcf, stream_vcf
+
+# Expected files were written by the original row-wise extract_vcf on fixtures/mutations.tsv
+EXPECTED_DIR = os.path.join(FIXTURES_DIR, 'vcf')
+
+
+@pytest.fixture
+def mutations():
+    '''Mutations of three interleaved patients, with indels ('-' alleles), a duplicate record and chrX/chrM.'''
+    return pd.read_csv(os.path.join(FIXTURES_DIR, 'mutations.tsv'), sep='\t', keep_default_na=False)
+
+
+def assert_matches_expected(output_dir):
+    '''Check that output_dir holds exactly the expected VCF files, byte for byte.'''
+    assert sorted(os.listdir(output_dir)) == sorted(os.listdir(EXPECTED_DIR))
+    for file_name in os.listdir(EXPECTED_DIR):
+        with open(os.path.join(output_dir, file_name), 'rb') as written, \
+                open(os.path.join(EXPECTED_DIR, file_name), 'rb') as expected:
+            assert written.read() == expected.read(), file_name
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_extract_vcf_matches_baseline_writer(mutations, tmp_path, workers):
+    extract_vcf(mutations, workers=workers, output_dir=str(tmp_path))
+    assert_matches_expected(tmp_path)
+
+
+@pytest.mark.parametrize('batch_size', [1, 4])
+def test_stream_vcf_matches_baseline_writer(mutations, tmp_path, batch_size):
+    batches = (mutations.iloc[start:start + batch_size] for start in range(0, len(mutations), batch_size))
+    assert stream_vcf(batches, output_dir=str(tmp_path)) == 3
+    assert_matches_expected(tmp_path)
@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import pandas as pd
+from visualizer import aggregate_sample_clusters, cluster_signatures
+
+
+def random_activities(n_samples=200, seed=0):
+    '''Activities of n_samples samples with a constant non-zero signature (SBS5) and an inactive one (SBS40a).'''
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame(rng.poisson(20, (n_samples, 4)) * (rng.random((n_samples, 4)) < 0.6),
+                        columns=['SBS1', 'SBS2', 'SBS13', 'SBS18'], index=[f'S{i}' for i in range(n_samples)])
+    data['SBS5'] = 7
+    data['SBS40a'] = 0
+    return data
+
+
+def test_centroid_clustermap_leaves_out_constant_signatures(tmp_path):
+    data = random_activities()
+    cluster_signatures(data, str(tmp_path), 'activities.txt', mode='centroids')
+
+    assert os.path.exists(tmp_path / 'activities_signature_clustermap.png')
+    labels = pd.read_csv(tmp_path / 'activities_sample_clusters.txt', sep='\t', index_col=0)
+    assert labels.index.tolist() == data.index.tolist()
+
+
+def test_centroid_clustermap_without_varying_signatures(tmp_path):
+    data = pd.DataFrame({'SBS1': [3] * 10, 'SBS5': [7] * 10})
+    cluster_signatures(data, str(tmp_path), 'activities.txt', mode='centroids')
+
+    assert not os.path.exists(tmp_path / 'activities_signature_clustermap.png')
+
+
+def test_aggregate_sample_clusters_with_a_single_cluster():
+    data = random_activities().iloc[:, :4]
+    zscores = (data - data.mean()) / data.std()
+    cluster_means, row_linkage, sample_labels = aggregate_sample_clusters(zscores, n_clusters=1)
+
+    assert row_linkage is None
+    assert cluster_means.index.tolist() == [f'C1 (n={len(data)})']
+    np.testing.assert_allclose(cluster_means.to_numpy()[0], zscores.mean().to_numpy(), atol=1e-12)
+    assert (sample_labels == 1).all()
@@ -2,10 +2,22 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import argparse
+import base64
+import html
+import json
 import sys
 import os
 from pathlib import Path
 import warnings
+import numpy as np
+import pyarrow.feather as feather
+from matplotlib.backends.backend_pdf import PdfPages
+from multiprocessing import Pool
+from scipy.cluster.hierarchy import linkage
+
+# Run log helpers are shared with the database scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+from instrumentation import configure_run_log, stage
 warnings.filterwarnings("ignore")
 
 
@@ -67,14 +79,52 @@ SIGNATURE_ETIOLOGY = {
     'ID22': 'Unknown',
 }
 
+# Patient pie charts per page (rows, columns) and page resolution of the grid and pdf pie layouts
+PIE_PAGE_SHAPE = (4, 5)
+PIE_PAGE_DPI = 150
+
+# Sample count above which the clustering heatmap switches from one row per sample to k-means clusters of samples
+CLUSTER_SAMPLE_THRESHOLD = 2000
+# Number of k-means clusters (heatmap rows) and subsampled samples of the scalable clustering modes
+CLUSTER_GROUPS = 200
+CLUSTER_SUBSAMPLE = 1000
+# Rows per float32 chunk of sample-centroid similarities
+CLUSTER_CHUNK_ROWS = 65536
+
+# Page of the interactive HTML report, with __TITLE__ and __MUTSIGMA_DATA__ placeholders
+HTML_REPORT_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report_template.html')
+
+def etiology_indicator(signatures):
+    """ Signature x etiology indicator matrix (signatures missing from SIGNATURE_ETIOLOGY are Unknown) """
+    etiologies = pd.Series(SIGNATURE_ETIOLOGY, dtype=object).reindex(signatures).fillna('Unknown')
+    return pd.get_dummies(etiologies, dtype=int)
+
+def patient_etiology_counts(data):
+    """ Number of active signatures of each etiology per patient (patients x etiologies), > 0 marks presence """
+    indicator = etiology_indicator(data.columns)
+    counts = (data.to_numpy() > 0).astype(int) @ indicator.to_numpy()
+    return pd.DataFrame(counts, index=data.index, columns=indicator.columns)
+
 def find_input_file(input_path):
-    """ Find the Assignment_Solution_Activities.txt file """
+    """
+    Find the Assignment_Solution_Activities.txt file, preferring the minimal output parquet table
+    and the feather copy of the activities (if it is not older than the text table)
+    """
     if os.path.isfile(input_path):
         return input_path, extract_dataset_name(input_path)
 
+    minimal_output_file = os.path.join(input_path, "Assignment_Solution.parquet")
+    if os.path.exists(minimal_output_file):
+        return minimal_output_file, extract_dataset_name(input_path)
+
     activities_file = os.path.join(input_path, "Assignment_Solution", "Activities",
                                    "Assignment_Solution_Activities.txt")
 
+    activities_feather = os.path.splitext(activities_file)[0] + ".feather"
+    if os.path.exists(activities_feather) and (not os.path.exists(activities_file) or
+                                               os.path.getmtime(activities_feather) >= os.path.getmtime(activities_file)):
+        return activities_feather, extract_dataset_name(input_path)
+
     if os.path.exists(activities_file):
         dataset_name = extract_dataset_name(input_path)
         return activities_file, dataset_name
@@ -91,8 +141,14 @@ def extract_dataset_name(path):
 def load_data(input_file):
     """ Load mutational signatures data """
     try:
-        data = pd.read_csv(input_file, sep='\t', index_col=0)
-        data = data.apply(pd.to_numeric, errors='coerce').fillna(0)
+        if input_file.endswith('.feather'):
+            # Typed columns written by the assigner, read from the memory-mapped file without parsing
+            data = feather.read_table(input_file, memory_map=True).to_pandas()
+        elif input_file.endswith('.parquet'):
+            data = pd.read_parquet(input_file)['Activities']
+        else:
+            data = pd.read_csv(input_file, sep='\t', index_col=0)
+            data = data.apply(pd.to_numeric, errors='coerce').fillna(0)
         print(f"Successfully loaded data: {data.shape[0]} samples, {data.shape[1]} signatures")
         return data
     except Exception as e:
@@ -177,22 +233,22 @@ def create_barplot_active_signatures(data, output_dir, dataset_name, show_only=F
         print(f"Active signatures barplot saved: {output_path}")
     plt.close()
 
-def create_etiology_piechart(data, output_dir, dataset_name, sample_id=None, show_only=False):
-    """ Create pie chart of signature etiologies based on prevalence or signature count """
+def create_etiology_piechart(data, output_dir, dataset_name, sample_id=None, show_only=False, etiology_counts=None):
+    """
+    Create pie chart of signature etiologies based on prevalence or signature count
+    (etiology_counts - optional precomputed patient_etiology_counts of data)
+    """
     if sample_id and sample_id not in data.index:
         print(f"Error: Sample {sample_id} not found in data.")
         return
 
-    etiology_counts = {}
+    if etiology_counts is None:
+        etiology_counts = patient_etiology_counts(data.loc[[sample_id]] if sample_id else data)
 
     if sample_id:
         # For single patient: count active signatures per etiology
-        patient_data = data.loc[sample_id]
-        active_signatures = patient_data[patient_data > 0].index
-
-        for sig in active_signatures:
-            etiology = SIGNATURE_ETIOLOGY.get(sig, 'Unknown')
-            etiology_counts[etiology] = etiology_counts.get(etiology, 0) + 1
+        patient_counts = etiology_counts.loc[sample_id]
+        etiology_counts = patient_counts[patient_counts > 0].to_dict()
 
         title_text = f'Active Signature Etiologies - Patient {sample_id}'
         filename = f"{dataset_name}_etiology_piechart_{sample_id}.png"
@@ -200,19 +256,8 @@ def create_etiology_piechart(data, output_dir, dataset_name, sample_id=None, sho
 
     else:
         # For all patients: count in how many patients each etiology appears
-        for etiology_name in set(SIGNATURE_ETIOLOGY.values()) | {'Unknown'}:
-            etiology_signatures = [sig for sig, etiol in SIGNATURE_ETIOLOGY.items() if etiol == etiology_name]
-            if etiology_name == 'Unknown':
-                all_mapped_sigs = set(SIGNATURE_ETIOLOGY.keys())
-                unknown_sigs = set(data.columns) - all_mapped_sigs
-                etiology_signatures.extend(unknown_sigs)
-
-            # Count patients with at least one active signature with this etiology
-            etiology_signatures_in_data = [sig for sig in etiology_signatures if sig in data.columns]
-            if etiology_signatures_in_data:
-                patients_with_etiology = (data[etiology_signatures_in_data] > 0).any(axis=1).sum()
-                if patients_with_etiology > 0:
-                    etiology_counts[etiology_name] = patients_with_etiology
+        patients_with_etiology = (etiology_counts > 0).sum()
+        etiology_counts = patients_with_etiology[patients_with_etiology > 0].to_dict()
 
         title_text = 'Etiology Prevalence - All Patients'
         filename = f"{dataset_name}_etiology_piechart_overall.png"
@@ -253,8 +298,124 @@ def create_etiology_piechart(data, output_dir, dataset_name, sample_id=None, sho
         print(f"Etiology pie chart saved: {output_path}")
     plt.close()
 
-def cluster_signatures(data, output_dir=None, dataset_name=None, method='complete', show_only=False):
-    """Cluster signatures hierarchically and visualize as a heatmap with dendrograms."""
+def create_etiology_pie_pages(data, output_dir, dataset_name, sample_ids, layout='pdf', etiology_counts=None, first_page=1):
+    """
+    Pack per-patient etiology pie charts into pages of PIE_PAGE_SHAPE grids, saved as PNG files (layout='grid')
+    or as one multipage PDF (layout='pdf'). One figure is drawn once and only wedge angles and titles change per patient.
+    """
+    # Etiologies of all pages are given when pages are split between jobs
+    if etiology_counts is None:
+        etiology_counts = patient_etiology_counts(data.loc[sample_ids])
+        etiology_counts = etiology_counts.loc[:, etiology_counts.sum() > 0]
+    etiology_counts = etiology_counts.loc[sample_ids]
+    if etiology_counts.shape[1] == 0:
+        print("No active signatures found for pie charts.")
+        return
+
+    # Wedge start and end angles (counterclockwise from 90 degrees) of every etiology per patient
+    totals = etiology_counts.sum(axis=1).to_numpy()
+    shares = etiology_counts.to_numpy() / np.maximum(totals, 1)[:, np.newaxis]
+    end_angles = 90 + 360 * np.cumsum(shares, axis=1)
+    start_angles = end_angles - 360 * shares
+
+    # One wedge per etiology in every grid cell, same colors on all pages
+    n_rows, n_columns = PIE_PAGE_SHAPE
+    fig, axes = plt.subplots(n_rows, n_columns, figsize=(3 * n_columns, 3 * n_rows + 1))
+    colors = plt.cm.tab20(np.linspace(0, 1, 20))[np.arange(etiology_counts.shape[1]) % 20]
+    cells = []
+    for ax in axes.flat:
+        wedges, _ = ax.pie(np.ones(etiology_counts.shape[1]), colors=colors, startangle=90)
+        cells.append((ax, wedges, ax.set_title('', fontsize=9)))
+    fig.legend(cells[0][1], etiology_counts.columns, title='Etiologies', loc='lower center',
+               ncol=min(6, etiology_counts.shape[1]))
+    fig.suptitle('Active Signature Etiologies per Patient', fontweight='bold', fontsize=14)
+
+    page_size = n_rows * n_columns
+    n_pages = -(-len(sample_ids) // page_size)
+    pdf_path = os.path.join(output_dir, f"{dataset_name}_etiology_piecharts.pdf")
+    pdf = PdfPages(pdf_path) if layout == 'pdf' else None
+    for page in range(n_pages):
+        for cell, i in enumerate(range(page * page_size, (page + 1) * page_size)):
+            ax, wedges, title = cells[cell]
+            ax.set_visible(i < len(sample_ids))
+            if i >= len(sample_ids):
+                continue
+            for wedge, start, end in zip(wedges, start_angles[i], end_angles[i]):
+                wedge.set_theta1(start)
+                wedge.set_theta2(end)
+            title.set_text(f"{sample_ids[i]} ({totals[i]} signatures)")
+
+        if pdf:
+            pdf.savefig(fig)
+        else:
+            output_path = os.path.join(output_dir, f"{dataset_name}_etiology_piecharts_page{first_page + page}.png")
+            fig.savefig(output_path, dpi=PIE_PAGE_DPI)
+
+    if pdf:
+        pdf.close()
+        print(f"Etiology pie charts of {len(sample_ids)} patients saved: {pdf_path}")
+    else:
+        print(f"Etiology pie charts of {len(sample_ids)} patients saved: {n_pages} page(s) in {output_dir}")
+    plt.close(fig)
+
+def unit_rows(values):
+    """ Scale rows to unit L2 norm (float32), so that dot products are cosine similarities """
+    values = np.asarray(values, dtype=np.float32)
+    norms = np.linalg.norm(values, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return values / norms
+
+def nearest_centroids(points, centroids, chunk_rows=CLUSTER_CHUNK_ROWS):
+    """ Index of the most cosine-similar centroid of every unit-norm point, computed in float32 chunks of rows """
+    labels = np.empty(len(points), dtype=np.int64)
+    for start in range(0, len(points), chunk_rows):
+        labels[start:start + chunk_rows] = np.argmax(points[start:start + chunk_rows] @ centroids.T, axis=1)
+    return labels
+
+def minibatch_kmeans(points, n_clusters, batch_size=1024, n_iter=100, seed=0):
+    """ Spherical mini-batch k-means of unit-norm points, returns the centroids and the labels of all points """
+    rng = np.random.default_rng(seed)
+    centroids = points[rng.choice(len(points), n_clusters, replace=False)].copy()
+    counts = np.zeros(n_clusters, dtype=np.float32)
+
+    for _ in range(n_iter):
+        batch = points[rng.choice(len(points), min(batch_size, len(points)), replace=False)]
+        labels = nearest_centroids(batch, centroids)
+
+        # Move each centroid towards the mean of its batch points with a per-centroid learning rate of 1/count
+        batch_counts = np.bincount(labels, minlength=n_clusters).astype(np.float32)
+        batch_sums = np.zeros_like(centroids)
+        np.add.at(batch_sums, labels, batch)
+        counts += batch_counts
+        updated = batch_counts > 0
+        centroids[updated] += (batch_sums[updated] - batch_counts[updated, None] * centroids[updated]) / counts[updated, None]
+        centroids = unit_rows(centroids)
+
+    return centroids, nearest_centroids(points, centroids)
+
+def aggregate_sample_clusters(zscores, n_clusters=CLUSTER_GROUPS, method='complete'):
+    """ Group samples with mini-batch k-means, returns mean z-scores per cluster, their row linkage (None for a single cluster) and sample labels """
+    centroids, labels = minibatch_kmeans(unit_rows(zscores), min(n_clusters, len(zscores)))
+
+    # Average z-scored activities of every non-empty cluster
+    sizes = np.bincount(labels, minlength=len(centroids))
+    sums = np.zeros((len(centroids), zscores.shape[1]))
+    np.add.at(sums, labels, zscores.to_numpy())
+    kept = np.flatnonzero(sizes)
+    cluster_means = pd.DataFrame(sums[kept] / sizes[kept, None], columns=zscores.columns,
+                                 index=[f"C{i + 1} (n={sizes[k]})" for i, k in enumerate(kept)])
+
+    row_linkage = linkage(cluster_means, metric='cosine', method=method) if len(kept) > 1 else None
+    sample_labels = pd.Series(np.searchsorted(kept, labels) + 1, index=zscores.index, name='Cluster')
+    return cluster_means, row_linkage, sample_labels
+
+def cluster_signatures(data, output_dir=None, dataset_name=None, method='complete', show_only=False, mode='auto',
+                       threshold=CLUSTER_SAMPLE_THRESHOLD):
+    """Cluster signatures hierarchically and visualize as a heatmap with dendrograms.
+
+    mode - full (one row per sample), subsample (CLUSTER_SUBSAMPLE random samples), centroids (one row per
+           k-means cluster of samples) or auto (full up to threshold samples, centroids above)
+    """
     
     # Filter out signatures with all zeros
     active_data = data.loc[:, (data != 0).any(axis=0)]
@@ -265,21 +426,54 @@ def cluster_signatures(data, output_dir=None, dataset_name=None, method='complet
     # Remove .txt extension if present
     clean_name = dataset_name.replace('.txt', '') if dataset_name else 'heatmap'
 
-    # Create clustermap (z-score normalization by signature for better visualization)
-    cg = sns.clustermap(
-        active_data,
-        metric='cosine',
-        method=method,
-        cmap='viridis',
-        figsize=(max(12, active_data.shape[1] * 0.5), 10),
-        z_score=1,  # normalize by signature (column)
-        linewidths=0.1,
-        cbar_kws={'label': 'Z-score Activity'},
-        cbar_pos=(1.02, 0.2, 0.01, 0.6)
-    )
+    if mode == 'auto':
+        mode = 'centroids' if len(active_data) > threshold else 'full'
+    if mode == 'subsample' and len(active_data) > CLUSTER_SUBSAMPLE:
+        active_data = active_data.sample(n=CLUSTER_SUBSAMPLE, random_state=0)
+        active_data = active_data.loc[:, (active_data != 0).any(axis=0)]
+
+    if mode == 'centroids':
+        # Cluster signatures on all samples, but draw one aggregated row per cluster of samples.
+        # Signatures with the same activity in every sample have no z-scores and are left out
+        std = active_data.std()
+        varying = std.to_numpy() > 0
+        if not varying.any():
+            print("No signatures with varying activity found for clustering heatmap.")
+            return
+        zscores = (active_data.loc[:, varying] - active_data.mean()[varying]) / std[varying]
+        cluster_means, row_linkage, sample_labels = aggregate_sample_clusters(zscores, method=method)
+        col_linkage = (linkage(zscores.to_numpy(dtype=np.float32).T, metric='cosine', method=method)
+                       if zscores.shape[1] > 1 else None)
+        cg = sns.clustermap(
+            cluster_means,
+            row_cluster=row_linkage is not None,
+            col_cluster=col_linkage is not None,
+            row_linkage=row_linkage,
+            col_linkage=col_linkage,
+            cmap='viridis',
+            figsize=(max(12, zscores.shape[1] * 0.5), 10),
+            linewidths=0.1,
+            cbar_kws={'label': 'Mean Z-score Activity'},
+            cbar_pos=(1.02, 0.2, 0.01, 0.6)
+        )
+        ylabel = f'Sample clusters ({len(active_data)} samples)'
+    else:
+        # Create clustermap (z-score normalization by signature for better visualization)
+        cg = sns.clustermap(
+            active_data,
+            metric='cosine',
+            method=method,
+            cmap='viridis',
+            figsize=(max(12, active_data.shape[1] * 0.5), 10),
+            z_score=1,  # normalize by signature (column)
+            linewidths=0.1,
+            cbar_kws={'label': 'Z-score Activity'},
+            cbar_pos=(1.02, 0.2, 0.01, 0.6)
+        )
+        ylabel = 'Samples' if mode == 'full' else f'Samples (random {len(active_data)} of {len(data)})'
 
     cg.ax_heatmap.set_xlabel('Mutational Signatures', fontsize=14)
-    cg.ax_heatmap.set_ylabel('Samples', fontsize=14)
+    cg.ax_heatmap.set_ylabel(ylabel, fontsize=14)
     cg.ax_heatmap.set_title('Hierarchical Clustering of Mutational Signatures', fontsize=16, fontweight='bold')
 
     if show_only:
@@ -292,6 +486,10 @@ def cluster_signatures(data, output_dir=None, dataset_name=None, method='complet
         output_path = os.path.join(output_dir, f"{clean_name}_signature_clustermap.png")
         plt.savefig(output_path, dpi=300, bbox_inches='tight')
         print(f"Signature clustering heatmap saved: {output_path}")
+        if mode == 'centroids':
+            clusters_path = os.path.join(output_dir, f"{clean_name}_sample_clusters.txt")
+            sample_labels.to_csv(clusters_path, sep='\t')
+            print(f"Sample clusters of the heatmap rows saved: {clusters_path}")
     plt.close()
 
 def generate_summary_report(data, output_dir, dataset_name):
@@ -317,11 +515,9 @@ def generate_summary_report(data, output_dir, dataset_name):
         f.write("\n")
 
         # Etiology distribution
-        etiology_counts = {}
-        for sig, activity in data.sum().items():
-            if activity > 0:
-                etiology = SIGNATURE_ETIOLOGY.get(sig, 'Unknown')
-                etiology_counts[etiology] = etiology_counts.get(etiology, 0) + 1
+        active_signatures = (data.sum() > 0).astype(int)
+        etiology_counts = active_signatures @ etiology_indicator(data.columns)
+        etiology_counts = etiology_counts[etiology_counts > 0].to_dict()
 
         f.write("Etiology Distribution:\n")
         f.write("-" * 40 + "\n")
@@ -330,20 +526,9 @@ def generate_summary_report(data, output_dir, dataset_name):
             f.write(f"- {etiology}: {count} signatures\n")
 
         f.write("\nBy patient prevalence (how many patients have each etiology):\n")
-        etiology_prevalence = {}
-        for etiology_name in set(SIGNATURE_ETIOLOGY.values()) | {'Unknown'}:
-            etiology_signatures = [sig for sig, etiol in SIGNATURE_ETIOLOGY.items() if etiol == etiology_name]
-            if etiology_name == 'Unknown':
-                all_mapped_sigs = set(SIGNATURE_ETIOLOGY.keys())
-                unknown_sigs = set(data.columns) - all_mapped_sigs
-                etiology_signatures.extend(unknown_sigs)
-
-            # Count patients with at least one active signature from this etiology
-            etiology_signatures_in_data = [sig for sig in etiology_signatures if sig in data.columns]
-            if etiology_signatures_in_data:
-                patients_with_etiology = (data[etiology_signatures_in_data] > 0).any(axis=1).sum()
-                if patients_with_etiology > 0:
-                    etiology_prevalence[etiology_name] = patients_with_etiology
+        # Count patients with at least one active signature from each etiology
+        etiology_prevalence = (patient_etiology_counts(data) > 0).sum()
+        etiology_prevalence = etiology_prevalence[etiology_prevalence > 0].to_dict()
 
         for etiology, count in sorted(etiology_prevalence.items(), key=lambda x: x[1], reverse=True):
             percentage = (count / data.shape[0]) * 100
@@ -351,6 +536,144 @@ def generate_summary_report(data, output_dir, dataset_name):
 
     print(f"Summary report saved: {report_path}")
 
+def encode_array(values, dtype):
+    """ Base64 of the little-endian binary data of an array, decoded into a typed array by the HTML report """
+    return base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode('ascii')
+
+def create_html_report(data, output_dir, dataset_name):
+    """
+    Write a self-contained interactive HTML report (no external resources). Activities are embedded as a
+    sparse samples x signatures table and the summary, plots and per-patient views are drawn in the browser.
+    """
+    values = data.to_numpy(dtype=np.float32)
+    rows, columns = np.nonzero(values)
+    indicator = etiology_indicator(data.columns)
+
+    report_data = {
+        'samples': [str(sample) for sample in data.index],
+        'signatures': [str(signature) for signature in data.columns],
+        'etiologies': list(indicator.columns),
+        'signature_etiology': indicator.to_numpy().argmax(axis=1).tolist(),
+        'indptr': encode_array(np.concatenate([[0], np.cumsum(np.count_nonzero(values, axis=1))]), '<u4'),
+        'indices': encode_array(columns, '<u2'),
+        'values': encode_array(values[rows, columns], '<f4')
+    }
+
+    with open(HTML_REPORT_TEMPLATE) as f:
+        page = f.read()
+    # Escape "</" so sample IDs can never close the data script element
+    page = page.replace('__TITLE__', html.escape(dataset_name))
+    page = page.replace('__MUTSIGMA_DATA__', json.dumps(report_data, separators=(',', ':')).replace('</', '<\\/'))
+
+    report_path = os.path.join(output_dir, f"{dataset_name}_report.html")
+    with open(report_path, 'w') as f:
+        f.write(page)
+    print(f"Interactive HTML report saved: {report_path}")
+
+
+# Activities dataframe shared with plot worker processes
+plot_data = None
+
+def init_plot_worker(data):
+    """ Plot worker initializer keeping the activities dataframe (inherited, not copied, when forked) """
+    global plot_data
+    plot_data = data
+    plt.switch_backend('Agg')
+
+def render_plot(task, data=None):
+    """ Render one plot task (plotting function and its keyword arguments) of data or the shared activities dataframe """
+    plot_function, kwargs = task
+    data = plot_data if data is None else data
+    with stage(plot_function.__name__, rows_in=len(data)):
+        plot_function(data, **kwargs)
+
+def visualize(data, dataset_name, output='plots', boxplot=False, no_outliers=False, barplot=False, piechart=False,
+              sample_id=None, first_n=0, all_plots=False, report=False, show=False, clustermap=False, jobs=1,
+              pie_layout='files', cluster_mode='auto', cluster_threshold=CLUSTER_SAMPLE_THRESHOLD, html_report=False):
+    """ Generate selected visualizations of a loaded activities dataframe (arguments as in main) """
+    # Create output directory if not --show arg
+    if not show:
+        os.makedirs(output, exist_ok=True)
+        print(f"Output directory: {output}")
+
+    # Collect independent plots first, then render them in order or in a pool of jobs
+    plot_tasks = []
+    plot_args = {'output_dir': output, 'dataset_name': dataset_name, 'show_only': show}
+
+    if all_plots or boxplot:
+        print("\nGenerating boxplot...")
+        if all_plots:
+            # If -all, generate both
+            plot_tasks.append((create_boxplot, {**plot_args, 'show_outliers': True}))
+            plot_tasks.append((create_boxplot, {**plot_args, 'show_outliers': False}))
+        else:
+            # If --boxplot: only with outliers, if --boxplot --no_outliers: only no outliers
+            plot_tasks.append((create_boxplot, {**plot_args, 'show_outliers': not no_outliers}))
+
+    if all_plots or barplot:
+        print("\nGenerating barplot...")
+        plot_tasks.append((create_barplot_active_signatures, plot_args))
+
+    if all_plots or piechart:
+        print("\nGenerating pie chart...")
+
+        # If --piechart --first_n: generate only individual patient charts
+        if first_n > 0:
+            sample_list = data.index[:first_n]
+            etiology_counts = patient_etiology_counts(data.loc[sample_list])
+            etiology_counts = etiology_counts.loc[:, etiology_counts.sum() > 0]
+            if pie_layout == 'pdf' and not show:
+                plot_tasks.append((create_etiology_pie_pages, {'output_dir': output, 'dataset_name': dataset_name,
+                                                               'sample_ids': list(sample_list), 'layout': 'pdf',
+                                                               'etiology_counts': etiology_counts}))
+            elif pie_layout == 'grid' and not show:
+                # Pages are independent, split them between jobs
+                page_size = PIE_PAGE_SHAPE[0] * PIE_PAGE_SHAPE[1]
+                n_pages = -(-len(sample_list) // page_size)
+                for pages in np.array_split(np.arange(n_pages), min(max(jobs, 1), n_pages)):
+                    chunk = list(sample_list[pages[0] * page_size:(pages[-1] + 1) * page_size])
+                    plot_tasks.append((create_etiology_pie_pages, {'output_dir': output, 'dataset_name': dataset_name,
+                                                                   'sample_ids': chunk, 'layout': 'grid',
+                                                                   'etiology_counts': etiology_counts,
+                                                                   'first_page': pages[0] + 1}))
+            else:
+                for sample in sample_list:
+                    plot_tasks.append((create_etiology_piechart,
+                                       {**plot_args, 'sample_id': sample, 'etiology_counts': etiology_counts.loc[[sample]]}))
+        elif sample_id:
+            # If --piechart --id: generate piechart for specific sample ID
+            plot_tasks.append((create_etiology_piechart, {**plot_args, 'sample_id': sample_id}))
+        else:
+            # If --piechart: generate chart for all patients (default)
+            plot_tasks.append((create_etiology_piechart, {**plot_args, 'sample_id': None}))
+    if all_plots or clustermap:
+        print("\nGenerating cluster heatmap...")
+        plot_tasks.append((cluster_signatures, {**plot_args, 'mode': cluster_mode, 'threshold': cluster_threshold}))
+
+    # Displayed plots are rendered one by one in this process
+    with stage('plots', rows_in=len(data), outputs=[output]) as record:
+        record['plots'] = len(plot_tasks)
+        if jobs > 1 and not show and len(plot_tasks) > 1:
+            with Pool(processes=min(jobs, len(plot_tasks)), initializer=init_plot_worker, initargs=(data,)) as pool:
+                list(pool.imap_unordered(render_plot, plot_tasks))
+        else:
+            for task in plot_tasks:
+                render_plot(task, data)
+
+    if (all_plots or report) and not show:
+        print("\nGenerating summary report...")
+        with stage('summary_report', rows_in=len(data), outputs=[output]):
+            generate_summary_report(data, output, dataset_name)
+
+    if (all_plots or html_report) and not show:
+        print("\nGenerating HTML report...")
+        with stage('html_report', rows_in=len(data), outputs=[output]):
+            create_html_report(data, output, dataset_name)
+
+    if not any([boxplot, barplot, piechart, all_plots, report, clustermap, html_report]):
+        print("No visualization option selected. Use --help for available options.")
+        print("Quick start: python visualizer.py -i output_folder/output_file --all")
+
 
 def main():
     '''
@@ -367,8 +690,15 @@ def main():
       -f, --first_n                          Generate pie charts for first N patients (default: 0)
       -a, --all                              Generate all visualizations
       -t, --report                           Generate summary report
+      -w, --html                             Generate interactive HTML report
       -s, --show                             Display plots only (no saving)
       -c, --cluster_signatures               Generate clustering heatmap of signatures
+      -j, --jobs                             Number of processes rendering plots (default: 1)
+      -l, --pie_layout                       Layout of --first_n pie charts: files, grid pages or one pdf (default: files)
+      -m, --cluster_mode                     Heatmap rows: auto, full, subsample or centroids (default: auto)
+      --cluster_threshold                    Sample count above which auto mode clusters centroids (default: 2000)
+      --run_log                              Append time, memory, rows and files written of every stage to a JSON-lines file
+      --profile                              Profile these stages (load, plots, a plot function name, or all)
     '''
 
     parser = argparse.ArgumentParser(description=
@@ -384,10 +714,29 @@ def main():
     parser.add_argument('-f', '--first_n', type=int, default=0, help='Generate pie charts for first N patients (default: 0)')
     parser.add_argument('-a', '--all', action='store_true', help='Generate all visualizations')
     parser.add_argument('-t', '--report', action='store_true', help='Generate summary report')
+    parser.add_argument('-w', '--html', action='store_true',
+                        help='Generate self-contained interactive HTML report (works offline)')
     parser.add_argument('-s', '--show', action='store_true', help='Display plots only (no saving)')
     parser.add_argument('-c', '--cluster_signatures', action='store_true', help='Generate clustering heatmap of signatures')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes rendering plots (default: 1)')
+    parser.add_argument('-l', '--pie_layout', choices=['files', 'grid', 'pdf'], default='files',
+                        help='Layout of --first_n pie charts: one file per patient, grid pages or one multipage pdf (default: files)')
+    parser.add_argument('-m', '--cluster_mode', choices=['auto', 'full', 'subsample', 'centroids'], default='auto',
+                        help='Clustering heatmap rows: every sample, a random subsample or k-means clusters of samples '
+                             '(default: auto, centroids above --cluster_threshold samples)')
+    parser.add_argument('--cluster_threshold', type=int, default=CLUSTER_SAMPLE_THRESHOLD,
+                        help=f'Sample count above which auto cluster mode clusters centroids (default: {CLUSTER_SAMPLE_THRESHOLD})')
+    parser.add_argument('--run_log', default=None,
+                        help='Append wall time, CPU time, peak memory, rows and files written of every stage to this JSON-lines file')
+    parser.add_argument('--profile', nargs='+', default=None, metavar='STAGE',
+                        help='Profile these stages (load, plots, summary_report, html_report, a plot function name, or all) '
+                             'into <run log>.<stage>.<pid>.<n>.prof files')
 
     args = parser.parse_args()
+    if args.profile and not args.run_log:
+        parser.error('--profile requires --run_log')
+    if args.run_log:
+        configure_run_log(args.run_log, args.profile)
 
     # Find input file
     input_file, dataset_name = find_input_file(args.input)
@@ -398,54 +747,17 @@ def main():
     print(f"Dataset name: {dataset_name}")
 
     # Load data
-    data = load_data(input_file)
+    with stage('load') as record:
+        data = load_data(input_file)
+        record['rows_out'] = None if data is None else len(data)
     if data is None:
         sys.exit(1)
 
-    # Create output directory if not --show arg
-    if not args.show:
-        os.makedirs(args.output, exist_ok=True)
-        print(f"Output directory: {args.output}")
-
-    if args.all or args.boxplot:
-        print("\nGenerating boxplot...")
-        if args.all:
-            # If -all, generate both
-            create_boxplot(data, args.output, dataset_name, show_outliers=True, show_only=args.show)
-            create_boxplot(data, args.output, dataset_name, show_outliers=False, show_only=args.show)
-        else:
-            # If --boxplot: only with outliers, if --boxplot --no_outliers: only no outliers
-            create_boxplot(data, args.output, dataset_name, show_outliers=not args.no_outliers, show_only=args.show)
-
-    if args.all or args.barplot:
-        print("\nGenerating barplot...")
-        create_barplot_active_signatures(data, args.output, dataset_name, show_only=args.show)
-
-    if args.all or args.piechart:
-        print("\nGenerating pie chart...")
-
-        # If --piechart --first_n: generate only individual patient charts
-        if args.first_n > 0:
-            sample_list = data.index[:args.first_n]
-            for sample in sample_list:
-                create_etiology_piechart(data, args.output, dataset_name, sample_id=sample, show_only=args.show)
-        elif args.id:
-            # If --piechart --id: generate piechart for specific sample ID
-            create_etiology_piechart(data, args.output, dataset_name, sample_id=args.id, show_only=args.show)
-        else:
-            # If --piechart: generate chart for all patients (default)
-            create_etiology_piechart(data, args.output, dataset_name, sample_id=None, show_only=args.show)
-    if args.all or args.cluster_signatures:
-        print("\nGenerating cluster heatmap...")
-        cluster_signatures(data, args.output, dataset_name, show_only=args.show)
-        
-    if (args.all or args.report) and not args.show:
-        print("\nGenerating summary report...")
-        generate_summary_report(data, args.output, dataset_name)
-
-    if not any([args.boxplot, args.barplot, args.piechart, args.all, args.report, args.cluster_signatures]):
-        print("No visualization option selected. Use --help for available options.")
-        print("Quick start: python visualizer.py -i output_folder/output_file --all")
+    visualize(data, dataset_name, output=args.output, boxplot=args.boxplot, no_outliers=args.no_outliers,
+              barplot=args.barplot, piechart=args.piechart, sample_id=args.id, first_n=args.first_n, all_plots=args.all,
+              report=args.report, show=args.show, clustermap=args.cluster_signatures, jobs=args.jobs,
+              pie_layout=args.pie_layout, cluster_mode=args.cluster_mode, cluster_threshold=args.cluster_threshold,
+              html_report=args.html)
 
 
 if __name__ == "__main__":